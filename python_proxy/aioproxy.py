@@ -0,0 +1,387 @@
+ # aioproxy.py - An asyncio version of proxy.py's request handling, selected with --mode asyncio.
+ # Every client is a coroutine on one event loop instead of a thread, so thousands of idle or
+ # slow-streaming connections cost only their buffers.
+
+#imports
+import asyncio
+import socket
+import time
+
+import cache
+import metrics
+import resolver
+import upstream
+from httputil import (CHUNKED, MAX_HEADER, ParseError, RequestParser, parse_head, downgrade,
+                      response_length, keep_alive, frame, chunk_size)
+from proxy import (BUFSIZ, KEEPALIVE_TIMEOUT, MAX_REQUESTS, STATS_PATH, log, cachefile, parse_url,
+                   origin_request, stats_response, overloaded_resp, connection_established_resp,
+                   bad_gateway_resp, bad_request_resp, not_implemented_resp)
+from tunnel import TUNNEL_BUFSIZ
+
+async def handle(reader, writer, accepted=None):
+	"""Serve HTTP requests from a client connection, one after another (including
+	pipelined ones): the same flow as proxy.handle()."""
+	parser = RequestParser()
+	for served in range(MAX_REQUESTS):
+		timing = metrics.Timing(None if served else accepted)
+		metrics.current.set(timing)
+		try:
+			request = await asyncio.wait_for(read_request(reader, parser, timing),
+			                                 KEEPALIVE_TIMEOUT if served else None)
+		except asyncio.TimeoutError:
+			return                                   # client went quiet
+		except ParseError as err:
+			log.info("Bad request: %s", err)
+			metrics.registry.count('bad_requests')
+			writer.write(bad_request_resp)
+			await writer.drain()
+			return
+		if request is None:
+			return
+		timing.parsed_now()
+		try:
+			persistent = await handle_request(reader, writer, parser, request,
+			                                  served == MAX_REQUESTS - 1)
+		finally:
+			metrics.registry.finish(timing, request)
+		if not persistent:
+			return
+
+async def read_request(reader, parser, timing):
+	"""Read from the client until parser has a complete request, and return it,
+	or None if the client closed the connection first."""
+	while True:
+		if parser.buffer:
+			timing.start()
+		request = parser.next()
+		if request is not None:
+			return request
+		data = await reader.read(BUFSIZ)
+		if not data:
+			return None
+		timing.start()
+		parser.feed(data)
+
+async def handle_request(reader, writer, parser, request, last=False):
+	"""Handle one HTTP request from a client, relaying the response to the client
+	as it arrives.  Returns whether the connection can carry another request,
+	which it can't if this is the last one it's allowed."""
+	if request.method not in (b'GET', b'CONNECT'):
+		writer.write(not_implemented_resp)
+		await writer.drain()
+		return False
+	persistent = request.keep_alive() and not last
+	if request.target == STATS_PATH:
+		writer.write(stats_response(persistent))
+		await writer.drain()
+		return persistent
+	url, port, path = parse_url(request.target)
+	if request.method == b'CONNECT':
+		await connect_tunnel(reader, writer, bytes(parser.buffer), url, port)
+		return False
+
+	filename = cachefile(request.target)
+	response = cache.memory.get(filename)
+	if response is not None:
+		head, body = response
+		metrics.note(cache='memory')
+		writer.write(frame(head, len(body), persistent)[0] + body)
+		await writer.drain()
+		return persistent
+	entry = await blocking(cache.lookup, filename)
+	try:
+		if entry is not None and entry.fresh():
+			metrics.note(cache='disk')
+			await blocking(cache.memory.add, entry)
+			await send_entry(entry, writer, persistent)
+			return persistent
+
+		# Concurrent misses for the same URL share one fetch, as in proxy.handle_request()
+		flight, leader = cache.join(filename)
+		if not leader:
+			metrics.note(cache='coalesced')
+			sent = await follow(flight, writer, persistent)
+			if sent is not None:
+				return sent
+			flight = None                       # it isn't being cached; fetch our own
+		metrics.note(cache='miss')
+		try:
+			return await fetch(writer, request, url, port, path, filename, entry, flight, persistent)
+		finally:
+			if flight is not None:
+				cache.land(filename, flight)
+	finally:
+		if entry is not None:
+			entry.close()
+
+async def fetch(writer, request, url, port, path, filename, entry, flight, persistent):
+	"""Get a response from the end server and stream it to the client (and into
+	the cache): the asyncio counterpart of proxy.fetch()."""
+	validators = entry.validators() if entry is not None else b''
+	s_request = origin_request(url, path, request.fields, validators, request.body)
+	origin, s_head = await request_origin(url, port, s_request)
+	try:
+		log.debug("%r", s_head)
+		components, headers = parse_head(s_head)
+		metrics.note(status=components[1].decode('latin-1') if len(components) > 1 else '?')
+		length = response_length(components, headers)
+		head = downgrade(s_head, headers)
+		if validators and components[1:2] == [b'304']:
+			await blocking(entry.refresh, head)  # Not Modified: ours is good again
+			metrics.note(cache='revalidated')
+			if flight is not None:
+				flight.update(state='done')
+			await send_entry(entry, writer, persistent)
+		else:
+			# A body whose length we don't know up front ends when we close the connection
+			known = None if length == CHUNKED else length
+			client_head, persistent = frame(head, known, persistent)
+			store = None
+			if cache.storable(s_head):
+				store = await blocking(cache.Writer, filename, flight)
+				if flight is not None:
+					flight.start(head, known, store)
+			elif flight is not None:
+				flight.update(state='failed')    # followers fetch it for themselves
+			await relay(origin.body(length), writer, client_head, head, store)
+	except BaseException:
+		origin.close()
+		raise
+	if length is not None and keep_alive(components, headers):
+		pool.give(origin.key, origin)
+	else:
+		origin.close()
+	return persistent
+
+async def connect_tunnel(reader, writer, initial, host, port):
+	"""Answer a CONNECT request: open a connection to host and port, then relay
+	bytes both ways between it and the client until both sides are done.
+	initial holds bytes the client already sent after its request."""
+	try:
+		s_reader, s_writer = await resolver.open_connection(host.decode(), port)
+	except OSError as err:
+		log.warning("CONNECT to %s failed: %r", host.decode(), err)
+		writer.write(bad_gateway_resp)
+		await writer.drain()
+		return
+	metrics.registry.count('tunnels')
+	try:
+		writer.write(connection_established_resp)
+		s_writer.write(initial)
+		await asyncio.gather(pump(reader, s_writer), pump(s_reader, writer))
+	finally:
+		s_writer.close()
+
+async def pump(reader, writer):
+	"""Copy one direction of a tunnel, passing on the end of the stream."""
+	while True:
+		data = await reader.read(TUNNEL_BUFSIZ)
+		if not data:
+			break
+		writer.write(data)
+		await writer.drain()
+	if writer.can_write_eof():
+		writer.write_eof()
+
+async def blocking(func, *args):
+	"""Call func(*args) in the event loop's executor: for cache file I/O, which
+	would otherwise hold up every other client while the disk is busy."""
+	return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+async def send_entry(entry, writer, persistent=False):
+	"""Send a cached response to the client, the body with sendfile() where the
+	transport allows."""
+	writer.write(entry.framed(persistent))
+	await asyncio.get_running_loop().sendfile(writer.transport, entry.file, len(entry.head),
+	                                          entry.size - len(entry.head))
+
+async def follow(flight, writer, persistent):
+	"""Send the client a response that another client's request is fetching into
+	the cache, as it arrives: the asyncio counterpart of cache.Flight.send()."""
+	loop = asyncio.get_running_loop()
+	changed = asyncio.Event()
+
+	def wake():
+		loop.call_soon_threadsafe(changed.set)
+
+	flight.watch(wake)
+	try:
+		while flight.state == 'pending':
+			await changed.wait()
+			changed.clear()
+		f = await blocking(flight.open)
+		if f is None:
+			entry = await blocking(cache.lookup, flight.filename) if flight.state == 'done' else None
+			if entry is None:
+				return None
+			try:
+				await send_entry(entry, writer, persistent)
+			finally:
+				entry.close()
+			return persistent
+
+		with f:
+			client_head, persistent = frame(flight.head, flight.length, persistent)
+			writer.write(client_head)
+			pos = f.seek(len(flight.head))
+			while True:
+				changed.clear()                  # anything written from here on sets it again
+				data = await blocking(f.read, BUFSIZ)
+				if data:
+					writer.write(data)
+					pos += len(data)
+					await writer.drain()
+					continue
+				if flight.state == 'done' and pos >= flight.written:
+					return persistent
+				if flight.state == 'failed':
+					raise ConnectionError("fetch of the response we were following failed")
+				await changed.wait()
+	finally:
+		flight.unwatch(wake)
+
+async def relay(chunks, writer, client_head, head, store=None):
+	"""Send a response to the client, its body one chunk at a time as it arrives
+	from the end server, saving it (with header block head) to the cache through
+	store once it's complete if a cache.Writer is given."""
+	sent = 0
+	try:
+		writer.write(client_head)
+		if store is not None:
+			await blocking(store.write, head)
+		async for chunk in chunks:
+			writer.write(chunk)
+			sent += len(chunk)
+			if store is not None:
+				await blocking(store.write, chunk)
+			await writer.drain()                  # don't outrun a slow client
+		await writer.drain()
+	except BaseException:
+		if store is not None:
+			store.abort()
+		raise
+	finally:
+		metrics.registry.count('bytes_relayed', sent)
+	if store is not None:
+		await blocking(store.commit)
+
+# CONNECTIONS TO END SERVERS: *****************************************************************
+
+class Origin:
+	"""A connection to an end server: the asyncio counterpart of upstream.Connection."""
+
+	def __init__(self, key, reader, writer):
+		self.key = key
+		self.reader = reader
+		self.writer = writer
+		self.reused = False
+
+	async def read_head(self):
+		"""Read a response's header block, or return None if the connection
+		closed before one arrived."""
+		try:
+			return await self.reader.readuntil(b'\r\n\r\n')
+		except asyncio.IncompleteReadError as err:
+			if err.partial:
+				raise ConnectionError("end server closed the connection mid-header")
+			return None
+
+	async def body(self, length):
+		"""Yield a response body in pieces of up to BUFSIZ bytes, undoing any
+		chunked coding.  length is as returned by httputil.response_length()."""
+		if length == CHUNKED:
+			while True:
+				size = chunk_size(await self.reader.readline())
+				if size == 0:
+					while await self.reader.readline() not in (b'\r\n', b'\n', b''):
+						pass                      # skip any trailer fields
+					return
+				async for data in self.body(size):
+					yield data
+				await self.reader.readline()        # CRLF after the chunk data
+		elif length is None:
+			while True:
+				data = await self.reader.read(BUFSIZ)
+				if not data:
+					return
+				yield data
+		else:
+			while length > 0:
+				data = await self.reader.read(min(length, BUFSIZ))
+				if not data:
+					raise ConnectionError("end server closed the connection mid-response")
+				length -= len(data)
+				yield data
+
+	def close(self):
+		self.writer.close()
+
+async def request_origin(host, port, data):
+	"""Send a request to an end server, reusing a pooled connection if there is
+	one: the asyncio counterpart of upstream.request()."""
+	while True:
+		origin = pool.take((host, port))
+		if origin is None:
+			reader, writer = await resolver.open_connection(host.decode(), port, limit=MAX_HEADER)
+			origin = Origin((host, port), reader, writer)
+		else:
+			origin.reused = True
+		try:
+			origin.writer.write(data)
+			await origin.writer.drain()
+			head = await origin.read_head()
+		except ConnectionError:
+			origin.close()
+			if not origin.reused:
+				raise
+			continue
+		except BaseException:
+			origin.close()
+			raise
+		if head is not None:
+			metrics.mark('first_byte')
+			return origin, head
+		origin.close()
+		if not origin.reused:
+			raise ConnectionError("end server closed the connection without responding")
+
+# Idle connections to end servers, shared by every coroutine
+pool = upstream.Pool()
+
+async def serve(sock, max_conns):
+	"""Accept clients on the listening socket forever, turning away any beyond max_conns."""
+	active = 0
+
+	async def client(reader, writer):
+		nonlocal active
+		accepted = time.monotonic()
+		addr = writer.get_extra_info('peername')
+		if active >= max_conns:
+			metrics.registry.count('shed')
+			writer.write(overloaded_resp)
+			writer.close()
+			return
+		active += 1
+		# asyncio only sets TCP_NODELAY itself for sockets created with IPPROTO_TCP,
+		# and the listening socket wasn't; see proxy.serve_conn()
+		sock = writer.get_extra_info('socket')
+		if sock is not None:
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		metrics.registry.count('connections')
+		metrics.registry.count('active_connections')
+		try:
+			log.debug("Connected to %s", addr)
+			await handle(reader, writer, accepted)
+		except Exception as err:
+			log.warning("Error handling %s: %r", addr, err)
+		finally:
+			active -= 1
+			metrics.registry.count('active_connections', -1)
+			writer.close()
+
+	server = await asyncio.start_server(client, sock=sock, limit=MAX_HEADER)
+	async with server:
+		await server.serve_forever()
+
+def run(sock, max_conns):
+	asyncio.run(serve(sock, max_conns))
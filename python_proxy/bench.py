@@ -0,0 +1,300 @@
+ # bench.py - Benchmarks for the proxy: a stand-in end server that serves objects of any size after
+ # any delay, a load generator with many persistent client connections, and scenarios (cold cache,
+ # warm cache, large streaming) reporting requests/sec, latency percentiles and the proxy's memory.
+ #
+ # Usage: python3 bench.py [cold] [warm] [large] [--mode pool|thread|single|asyncio] [--connections N] ...
+ # The proxy.py next to this file is started in a fresh temporary directory (so its cache starts
+ # empty); pass --proxy host:port to measure one that is already running instead.
+
+#imports
+import argparse
+import http.server
+import os
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+
+# Size of the pieces bodies are written and read in
+BLOCK = 64 * 1024
+
+# ORIGIN: *************************************************************************************
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+	"""Serves /obj/<size>[/<anything>][?delay=<ms>&ttl=<s>&store=0]: size bytes
+	(which may end in K or M), after waiting delay milliseconds, cacheable for
+	ttl seconds (default 3600) unless store=0."""
+
+	protocol_version = 'HTTP/1.1'
+	# Headers and body go out in separate writes: with Nagle's algorithm every response on a
+	# reused connection would wait ~40 ms for a delayed ACK, and that would be all we measured
+	disable_nagle_algorithm = True
+	block = b'x' * BLOCK
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		url = urlsplit(self.path)
+		parts = url.path.split('/')
+		if len(parts) < 3 or parts[1] != 'obj':
+			self.send_error(404)
+			return
+		try:
+			size = parse_size(parts[2])
+		except ValueError:
+			self.send_error(400)
+			return
+		query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+		delay = float(query.get('delay', 0)) / 1000
+		if delay:
+			time.sleep(delay)
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/octet-stream')
+		self.send_header('Content-Length', str(size))
+		if query.get('store') == '0':
+			self.send_header('Cache-Control', 'no-store')
+		else:
+			self.send_header('Cache-Control', 'max-age=' + query.get('ttl', '3600'))
+		self.end_headers()
+		while size > 0:
+			n = min(size, BLOCK)
+			self.wfile.write(self.block[:n])
+			size -= n
+
+def parse_size(text):
+	"""Parse a byte count such as 4096, 16K or 1M."""
+	text = text.upper()
+	for suffix, scale in (('K', 1024), ('M', 1024 * 1024), ('G', 1024 * 1024 * 1024)):
+		if text.endswith(suffix):
+			return int(float(text[:-1]) * scale)
+	return int(text)
+
+def start_origin(port):
+	"""Run the stand-in end server in a background thread."""
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', port), OriginHandler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+# LOAD GENERATOR: *****************************************************************************
+
+class Client:
+	"""A persistent connection to the proxy, reopened whenever the proxy closes it."""
+
+	def __init__(self, host, port):
+		self.addr = (host, port)
+		self.sock = None
+		self.rfile = None
+		self.buf = bytearray(BLOCK)
+
+	def get(self, url):
+		"""Fetch url through the proxy.  Returns (status, body bytes)."""
+		if self.sock is None:
+			self.sock = socket.create_connection(self.addr)
+			self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self.rfile = self.sock.makefile('rb')
+		self.sock.sendall(b'GET ' + url + b' HTTP/1.1\r\nHost: ' + urlsplit(url).netloc + b'\r\n\r\n')
+		status = self.rfile.readline().split()[1]
+		length = None
+		close = False
+		while True:
+			line = self.rfile.readline()
+			if line in (b'\r\n', b'\n', b''):
+				break
+			name, _, value = line.partition(b':')
+			name = name.strip().lower()
+			if name == b'content-length':
+				length = int(value)
+			elif name == b'connection' and value.strip().lower() == b'close':
+				close = True
+		received = 0
+		view = memoryview(self.buf)
+		while length is None or received < length:
+			n = self.rfile.readinto(view if length is None else view[:min(BLOCK, length - received)])
+			if not n:
+				if length is not None:
+					raise ConnectionError("proxy closed the connection mid-response")
+				break
+			received += n
+		if close or length is None:
+			self.close()
+		return status, received
+
+	def close(self):
+		if self.sock is not None:
+			self.rfile.close()
+			self.sock.close()
+			self.sock = self.rfile = None
+
+def load(proxy, urls, connections):
+	"""Fetch every URL in urls through the proxy, over the given number of
+	concurrent connections.  Returns (elapsed seconds, latencies, bytes, errors)."""
+	latencies = []
+	received = [0]
+	errors = [0]
+	lock = threading.Lock()
+	it = iter(urls)
+
+	def worker():
+		client = Client(*proxy)
+		mine = []
+		nbytes = 0
+		nerrors = 0
+		while True:
+			with lock:
+				url = next(it, None)
+			if url is None:
+				break
+			t = time.perf_counter()
+			try:
+				status, n = client.get(url)
+			except (OSError, IndexError):
+				client.close()
+				nerrors += 1
+				continue
+			mine.append(time.perf_counter() - t)
+			nbytes += n
+			if status != b'200':
+				nerrors += 1
+		client.close()
+		with lock:
+			latencies.extend(mine)
+			received[0] += nbytes
+			errors[0] += nerrors
+
+	threads = [threading.Thread(target=worker) for _ in range(connections)]
+	start = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return time.perf_counter() - start, sorted(latencies), received[0], errors[0]
+
+def percentile(ordered, p):
+	if not ordered:
+		return 0.0
+	return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+# SCENARIOS: **********************************************************************************
+
+def memory_kib(pid):
+	"""The current and peak resident set size of process pid in KiB, where /proc has them."""
+	if pid is None:
+		return None, None
+	fields = {}
+	try:
+		with open('/proc/%d/status' % pid) as f:
+			for line in f:
+				name, _, value = line.partition(':')
+				fields[name] = value.split()[:1]
+	except OSError:
+		return None, None
+	return int(fields.get('VmRSS', ['0'])[0]), int(fields.get('VmHWM', ['0'])[0])
+
+SCENARIOS = ('cold', 'warm', 'large')
+
+def scenarios(args):
+	"""The (name, warm-up URLs, measured URLs, connections) of each scenario asked for."""
+	base = b'http://127.0.0.1:%d/obj/' % args.origin_port
+	size = args.size.encode()
+	delay = b'?delay=%d' % args.delay
+	run = b'%x' % int(time.time() * 1000)     # keeps URLs unique across runs against one proxy
+	for name in args.scenarios:
+		if name == 'cold':
+			# Every request is a miss for a new cacheable object
+			urls = [base + size + b'/cold-%s-%d' % (run, i) + delay for i in range(args.requests)]
+			yield name, [], urls, args.connections
+		elif name == 'warm':
+			# A small working set, fetched once beforehand, so requests hit the cache
+			hot = [base + size + b'/warm-%s-%d' % (run, i) + delay for i in range(args.objects)]
+			yield name, hot, [hot[i % len(hot)] for i in range(args.requests)], args.connections
+		elif name == 'large':
+			# A few clients streaming big uncacheable objects
+			large = args.large.encode()
+			urls = [base + large + b'/large-%s-%d?store=0' % (run, i) for i in range(args.large_requests)]
+			yield name, [], urls, args.large_connections
+
+def start_proxy(args):
+	"""Start proxy.py in a fresh directory.  Returns the process, with the
+	directory as its workdir attribute."""
+	workdir = tempfile.mkdtemp(prefix='proxy-bench-')
+	script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'proxy.py')
+	proc = subprocess.Popen([sys.executable, script, str(args.proxy_port), '--mode', args.mode]
+	                        + shlex.split(args.proxy_opts), cwd=workdir,
+	                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	proc.workdir = workdir
+	deadline = time.monotonic() + 10
+	while time.monotonic() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', args.proxy_port)).close()
+			return proc
+		except OSError:
+			if proc.poll() is not None:
+				raise RuntimeError("proxy exited with status %d" % proc.returncode)
+			time.sleep(0.05)
+	proc.kill()
+	raise RuntimeError("proxy didn't start listening")
+
+def report(name, elapsed, latencies, nbytes, errors, rss, peak):
+	n = len(latencies)
+	print('%-6s %7d %6d %9.1f %8.1f %8.2f %8.2f %8.2f %9s %9s' % (
+		name, n, errors, n / elapsed if elapsed else 0, nbytes / elapsed / 1e6 if elapsed else 0,
+		percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+		latencies[-1] * 1000 if latencies else 0,
+		rss if rss is not None else '-', peak if peak is not None else '-'))
+
+# MAIN: ***************************************************************************************
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the proxy")
+	parser.add_argument('scenarios', nargs='*', help="cold, warm and/or large (default: all three)")
+	parser.add_argument('--mode', default='pool', help="proxy --mode (default: %(default)s)")
+	parser.add_argument('--proxy', help="host:port of a proxy that is already running")
+	parser.add_argument('--proxy-port', type=int, default=18181)
+	parser.add_argument('--origin-port', type=int, default=18180)
+	parser.add_argument('--connections', type=int, default=32, help="concurrent clients (default: %(default)s)")
+	parser.add_argument('--requests', type=int, default=2000, help="requests per scenario (default: %(default)s)")
+	parser.add_argument('--size', default='16K', help="object size for cold and warm (default: %(default)s)")
+	parser.add_argument('--delay', type=int, default=0, help="end server delay in ms (default: %(default)s)")
+	parser.add_argument('--objects', type=int, default=100, help="working set of the warm scenario (default: %(default)s)")
+	parser.add_argument('--large', default='64M', help="object size for large (default: %(default)s)")
+	parser.add_argument('--large-requests', type=int, default=16)
+	parser.add_argument('--large-connections', type=int, default=4)
+	parser.add_argument('--proxy-opts', default='', help="more options for proxy.py, e.g. --proxy-opts='--mem-cache 0'")
+	args = parser.parse_args()
+	for name in args.scenarios:
+		if name not in SCENARIOS:
+			parser.error("unknown scenario %r (choose from %s)" % (name, ', '.join(SCENARIOS)))
+	args.scenarios = args.scenarios or list(SCENARIOS)
+
+	origin = start_origin(args.origin_port)
+	proc = None
+	if args.proxy:
+		host, _, port = args.proxy.rpartition(':')
+		proxy = (host, int(port))
+	else:
+		proc = start_proxy(args)
+		proxy = ('127.0.0.1', args.proxy_port)
+	try:
+		print('%-6s %7s %6s %9s %8s %8s %8s %8s %9s %9s' % (
+			'', 'reqs', 'errors', 'req/s', 'MB/s', 'p50 ms', 'p99 ms', 'max ms', 'RSS KiB', 'peak KiB'))
+		for name, warmup, urls, connections in scenarios(args):
+			if warmup:
+				load(proxy, warmup, connections)
+			elapsed, latencies, nbytes, errors = load(proxy, urls, connections)
+			report(name, elapsed, latencies, nbytes, errors, *memory_kib(proc.pid if proc else None))
+	finally:
+		if proc is not None:
+			proc.terminate()
+			proc.wait()
+			shutil.rmtree(proc.workdir, ignore_errors=True)
+		origin.shutdown()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,604 @@
+ # cache.py - Reading back the responses proxy.py stores under cache/, deciding whether they are
+ # still fresh (Cache-Control, Expires, or a Last-Modified heuristic) and revalidating stale ones,
+ # plus an in-memory LRU tier in front of it for small, hot responses and the index that keeps
+ # the directory under its size limit.
+ # Shared by proxy.py and aioproxy.py.
+
+#imports
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from httputil import parse_head, split_head, parse_cache_control, parse_date, frame
+
+# Chunk size for reading back a stored header block, and the most we'll read looking for its end
+READSIZ = 4096
+MAX_HEAD = 64 * 1024
+
+# Without explicit freshness information, a response is considered fresh for this fraction
+# of the time since it was last modified (RFC 9111, section 4.2.2)
+HEURISTIC_FRACTION = 0.1
+
+# Defaults for the in-memory tier: its total size, and the largest response it will hold
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+MAX_MEMORY_ENTRY = 256 * 1024
+
+# Defaults for the disk cache: its total size, and how often its index is saved
+DEFAULT_DISK_BUDGET = 1024 * 1024 * 1024
+SAVE_INTERVAL = 30
+
+# Eviction brings the disk cache down to this fraction of its budget, so it doesn't run
+# again after every write
+LOW_WATER = 0.9
+
+# Headers from a 304 that must not replace the stored ones
+KEEP_ON_REVALIDATE = ('content-length', 'transfer-encoding', 'content-encoding')
+
+def storable(head):
+	"""Whether a response with this header block may be written to the cache.
+
+	Entries are keyed by URL alone, so responses that vary with request headers
+	(Vary, e.g. a gzip body for clients sending Accept-Encoding) aren't stored:
+	another client could be sent one it didn't ask for.
+	"""
+	components, headers = parse_head(head)
+	if len(components) < 2 or components[1] != b'200':
+		return False
+	cc = parse_cache_control(headers.get('cache-control', ''))
+	return 'no-store' not in cc and 'private' not in cc and 'vary' not in headers
+
+class Writer:
+	"""Saves a response to the cache while it streams past.  Chunks go to a
+	temporary file, which only replaces filename once the whole response has
+	been written, so readers never see a partial entry.
+
+	If a Flight is given, its followers are told about each chunk as soon as it
+	is in the temporary file, and about the outcome.
+	"""
+
+	def __init__(self, filename, flight=None):
+		os.makedirs(os.path.dirname(filename), exist_ok=True)  # other threads may be creating it too
+		self.filename = filename
+		self.tmpname = '%s.%x.%x.tmp' % (filename, os.getpid(), id(self))
+		self.file = open(self.tmpname, 'wb')
+		self.flight = flight
+
+	def write(self, chunk):
+		self.file.write(chunk)
+		if self.flight is not None:
+			self.file.flush()
+			self.flight.update(written=self.flight.written + len(chunk))
+
+	def commit(self):
+		"""Finish the entry and make it visible under its real name."""
+		size = self.file.tell()
+		self.file.close()
+		os.replace(self.tmpname, self.filename)
+		memory.discard(self.filename)
+		disk.added(self.filename, size)
+		if self.flight is not None:
+			self.flight.update(state='done')
+
+	def abort(self):
+		"""Throw away a response that didn't arrive in full."""
+		self.file.close()
+		os.unlink(self.tmpname)
+		if self.flight is not None:
+			self.flight.update(state='failed')
+
+def lookup(filename):
+	"""Return the Entry stored in filename, or None if there isn't a usable one.
+	The Entry keeps the file open, and must be closed."""
+	try:
+		f = open(filename, 'rb')
+	except FileNotFoundError:
+		disk.discard(filename)
+		return None
+	try:
+		st = os.fstat(f.fileno())
+		data = b''
+		while True:
+			chunk = f.read(READSIZ)
+			data += chunk
+			head, _ = split_head(data)
+			if head is not None:
+				break
+			if not chunk or len(data) > MAX_HEAD:
+				f.close()
+				return None                   # truncated or not a response
+	except BaseException:
+		f.close()
+		raise
+	entry = Entry(filename, f, head, st.st_mtime, st.st_size)
+	disk.used(filename, entry.size, entry.expires())
+	return entry
+
+class Entry:
+	"""A response stored in the cache: its header block, parsed, the time it was
+	stored (the file's mtime, which is reset when the entry is revalidated) and
+	the size of the whole response in bytes.
+
+	The response is read from the file lookup() opened, not by name, so that it
+	still matches the header block if the entry is replaced in the meantime.
+	"""
+
+	def __init__(self, filename, file, head, stored, size):
+		self.filename = filename
+		self.file = file
+		self.head = head
+		self.components, self.headers = parse_head(head)
+		self.stored = stored
+		self.size = size
+
+	def lifetime(self):
+		"""Seconds the response stays fresh after it was generated."""
+		cc = parse_cache_control(self.headers.get('cache-control', ''))
+		if 'no-cache' in cc:
+			return 0
+		for directive in ('s-maxage', 'max-age'):
+			if directive in cc:
+				try:
+					return max(int(cc[directive]), 0)
+				except ValueError:
+					return 0
+		date = parse_date(self.headers.get('date')) or self.stored
+		if 'expires' in self.headers:
+			expires = parse_date(self.headers['expires'])
+			return max(expires - date, 0) if expires is not None else 0
+		last_modified = parse_date(self.headers.get('last-modified'))
+		if last_modified is not None:
+			return max(date - last_modified, 0) * HEURISTIC_FRACTION
+		return 0
+
+	def age(self, now=None):
+		"""Seconds since the response was generated, as in RFC 9111, section 4.2.3."""
+		if now is None:
+			now = time.time()
+		date = parse_date(self.headers.get('date')) or self.stored
+		try:
+			age_value = int(self.headers.get('age', 0))
+		except ValueError:
+			age_value = 0
+		return max(self.stored - date, age_value, 0) + max(now - self.stored, 0)
+
+	def fresh(self, now=None):
+		"""Whether the entry can be served without asking the end server."""
+		return self.lifetime() > self.age(now)
+
+	def expires(self, now=None):
+		"""The time at which the entry stops being fresh."""
+		if now is None:
+			now = time.time()
+		return now + self.lifetime() - self.age(now)
+
+	def validators(self):
+		"""Header lines for a conditional GET that revalidates this entry."""
+		lines = []
+		if 'etag' in self.headers:
+			lines.append(b'If-None-Match: ' + self.headers['etag'].encode('latin-1') + b'\r\n')
+		if 'last-modified' in self.headers:
+			lines.append(b'If-Modified-Since: ' + self.headers['last-modified'].encode('latin-1') + b'\r\n')
+		return b''.join(lines)
+
+	def body(self):
+		"""Read the stored response's body."""
+		self.file.seek(len(self.head))
+		return self.file.read(self.size - len(self.head))
+
+	def framed(self, persistent):
+		"""The stored header block as sent to a client (see httputil.frame())."""
+		return frame(self.head, self.size - len(self.head), persistent)[0]
+
+	def send(self, conn, persistent=False):
+		"""Send the stored response to a client socket, the body without copying
+		it through Python where the OS supports it."""
+		conn.sendall(self.framed(persistent))
+		conn.sendfile(self.file, len(self.head), self.size - len(self.head))
+
+	def close(self):
+		self.file.close()
+
+	def refresh(self, head):
+		"""Merge the headers of a 304 Not Modified response into the stored
+		response and mark it as stored now, so it is fresh again."""
+		_, updates = parse_head(head)
+		lines = [self.head.split(b'\r\n', 1)[0]]
+		for line in self.head.split(b'\r\n')[1:]:
+			name = line.partition(b':')[0].strip().lower().decode('latin-1')
+			if line and (name not in updates or name in KEEP_ON_REVALIDATE):
+				lines.append(line)
+		for line in head.split(b'\r\n')[1:]:
+			name = line.partition(b':')[0].strip().lower().decode('latin-1')
+			if line and name not in KEEP_ON_REVALIDATE:
+				lines.append(line)
+		newhead = b'\r\n'.join(lines) + b'\r\n\r\n'
+
+		dst = Writer(self.filename)
+		try:
+			self.file.seek(len(self.head))
+			dst.write(newhead)
+			while True:
+				chunk = self.file.read(READSIZ)
+				if not chunk:
+					break
+				dst.write(chunk)
+			f = open(dst.tmpname, 'rb')          # the new entry, whatever replaces it later
+		except BaseException:
+			dst.abort()
+			raise
+		dst.commit()
+
+		self.file.close()
+		self.file = f
+		self.head = newhead
+		self.components, self.headers = parse_head(newhead)
+		st = os.fstat(f.fileno())
+		self.stored, self.size = st.st_mtime, st.st_size
+
+class MemoryCache:
+	"""Whole responses kept in memory, as (header block, body) and keyed by
+	their cachefile() name, so hot ones can be sent with a single socket write.
+
+	Entries are only kept while fresh, and the least recently used are evicted
+	once the total size passes budget bytes.  Responses larger than max_entry
+	bytes are left to the disk cache.  The counters are available from stats().
+	"""
+
+	def __init__(self, budget=DEFAULT_MEMORY_BUDGET, max_entry=MAX_MEMORY_ENTRY):
+		self.budget = budget
+		self.max_entry = max_entry
+		self.entries = OrderedDict()     # filename -> (head, body, expiry time), oldest use first
+		self.size = 0
+		self.lock = threading.Lock()
+		self.hits = self.misses = self.evictions = self.expirations = 0
+
+	def get(self, filename, now=None):
+		"""Return the (head, body) cached under filename, or None if there isn't a fresh one.
+		A hit counts as a use of the disk cache's copy too, so it isn't evicted first."""
+		if now is None:
+			now = time.time()
+		with self.lock:
+			item = self.entries.get(filename)
+			if item is not None and item[2] <= now:
+				self.remove(filename)
+				self.expirations += 1
+				item = None
+			if item is None:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(filename)
+			self.hits += 1
+		disk.touch(filename)
+		return item[:2]
+
+	def put(self, filename, head, body, expires):
+		"""Cache a response until the given expiry time, evicting others to make room."""
+		size = len(head) + len(body)
+		if size > min(self.max_entry, self.budget):
+			return
+		with self.lock:
+			self.remove(filename)
+			self.entries[filename] = (head, body, expires)
+			self.size += size
+			while self.size > self.budget:
+				self.remove(next(iter(self.entries)))
+				self.evictions += 1
+
+	def add(self, entry):
+		"""Copy a fresh disk cache entry into memory, if it is small enough."""
+		if entry.size > min(self.max_entry, self.budget):
+			return
+		self.put(entry.filename, entry.head, entry.body(), entry.expires())
+
+	def discard(self, filename):
+		"""Forget the response cached under filename, e.g. because it was replaced."""
+		with self.lock:
+			self.remove(filename)
+
+	def remove(self, filename):
+		# Caller holds self.lock
+		item = self.entries.pop(filename, None)
+		if item is not None:
+			self.size -= len(item[0]) + len(item[1])
+
+	def stats(self):
+		"""Return the tier's counters and current size as a dict."""
+		with self.lock:
+			return {'hits': self.hits, 'misses': self.misses,
+			        'evictions': self.evictions, 'expirations': self.expirations,
+			        'entries': len(self.entries), 'bytes': self.size}
+
+class DiskCache:
+	"""An index of the responses stored under root, used to keep them within
+	budget bytes.
+
+	Each entry's size, time of last use and expiry time (once known) are kept in
+	least recently used order.  Once the total passes the budget a background
+	thread removes expired entries, then the least recently used, until it is
+	back under LOW_WATER of the budget.
+
+	Entries live in subdirectories named after the first two hex digits of their
+	name (see proxy.cachefile()).  The thread also saves the index to root/index,
+	so at startup only the subdirectories changed since it was saved need to be
+	scanned.
+	"""
+
+	def __init__(self, root='cache', budget=DEFAULT_DISK_BUDGET):
+		self.root = root
+		self.budget = budget
+		self.index = OrderedDict()       # filename -> [size, last use, expiry or None], oldest use first
+		self.size = 0
+		self.lock = threading.Lock()
+		self.wakeup = threading.Event()
+		self.dirty = False
+		self.evictions = 0
+		self.thread = None
+
+	def added(self, filename, size):
+		"""Record a newly written (or rewritten) entry."""
+		with self.lock:
+			self.remove(filename)
+			self.index[filename] = [size, time.time(), None]
+			self.size += size
+			self.dirty = True
+			if self.size > self.budget:
+				self.wakeup.set()
+
+	def used(self, filename, size, expires):
+		"""Record that an entry was just read, and when it goes stale."""
+		with self.lock:
+			item = self.index.get(filename)
+			if item is None:
+				self.index[filename] = [size, time.time(), expires]
+				self.size += size
+			else:
+				item[1:] = [time.time(), expires]
+				self.index.move_to_end(filename)
+			self.dirty = True
+
+	def touch(self, filename):
+		"""Record that an entry was just used (from its copy in memory)."""
+		with self.lock:
+			item = self.index.get(filename)
+			if item is not None:
+				item[1] = time.time()
+				self.index.move_to_end(filename)
+				self.dirty = True
+
+	def discard(self, filename):
+		"""Forget an entry that is no longer on disk."""
+		with self.lock:
+			self.remove(filename)
+
+	def remove(self, filename):
+		# Caller holds self.lock
+		item = self.index.pop(filename, None)
+		if item is not None:
+			self.size -= item[0]
+			self.dirty = True
+
+	def start(self):
+		"""Load the index and start the eviction thread."""
+		self.load()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+		self.wakeup.set()
+
+	def run(self):
+		while True:
+			self.wakeup.wait(SAVE_INTERVAL)
+			self.wakeup.clear()
+			self.evict()
+			if self.dirty:
+				self.save()
+
+	def evict(self):
+		"""Remove entries until the cache fits in LOW_WATER of its budget."""
+		now = time.time()
+		victims = []
+		with self.lock:
+			if self.size <= self.budget:
+				return
+			target = self.budget * LOW_WATER
+			candidates = [name for name, item in self.index.items()
+			              if item[2] is not None and item[2] <= now]
+			candidates.extend(self.index)          # then least recently used first
+			for filename in candidates:
+				if self.size <= target:
+					break
+				if filename in self.index:
+					self.remove(filename)
+					victims.append(filename)
+			self.evictions += len(victims)
+		for filename in victims:
+			memory.discard(filename)
+			try:
+				os.unlink(filename)
+			except FileNotFoundError:
+				pass
+
+	def save(self):
+		"""Write the index to root/index: the time it was taken, then one
+		"name size last-use expiry" line per entry."""
+		with self.lock:
+			lines = ['%f\n' % time.time()]
+			lines.extend('%s %d %.0f %s\n' % (os.path.relpath(filename, self.root), item[0], item[1],
+			                                  '-' if item[2] is None else '%.0f' % item[2])
+			             for filename, item in self.index.items())
+			self.dirty = False
+		os.makedirs(self.root, exist_ok=True)
+		tmpname = os.path.join(self.root, 'index.tmp')
+		with open(tmpname, 'w') as f:
+			f.writelines(lines)
+		os.replace(tmpname, os.path.join(self.root, 'index'))
+
+	def load(self):
+		"""Rebuild the index from root/index plus any subdirectories changed since
+		it was taken.  Entries from before the cache was sharded are moved into
+		their subdirectories."""
+		entries = {}
+		saved = 0
+		try:
+			with open(os.path.join(self.root, 'index')) as f:
+				saved = float(f.readline())
+				for line in f:
+					name, size, used, expires = line.split()
+					entries[os.path.join(self.root, name)] = [int(size), float(used),
+					                                          None if expires == '-' else float(expires)]
+		except FileNotFoundError:
+			pass
+		except ValueError:
+			entries, saved = {}, 0             # damaged; rescan everything
+
+		shards = set()
+		try:
+			with os.scandir(self.root) as it:
+				for d in it:
+					if d.is_dir() and len(d.name) == 2:
+						shards.add(d.name)
+					elif d.is_file() and len(d.name) == 64:
+						os.makedirs(os.path.join(self.root, d.name[:2]), exist_ok=True)
+						os.replace(d.path, os.path.join(self.root, d.name[:2], d.name))
+						shards.add(d.name[:2])
+		except FileNotFoundError:
+			pass
+
+		for name in shards:
+			shard = os.path.join(self.root, name)
+			if os.stat(shard).st_mtime < saved:
+				continue                           # nothing added or removed since
+			with os.scandir(shard) as it:
+				for d in it:
+					if d.name.endswith('.tmp'):
+						os.unlink(d.path)          # left over from a crash
+					elif d.path not in entries:
+						st = d.stat()
+						entries[d.path] = [st.st_size, st.st_mtime, None]
+
+		with self.lock:
+			self.index = OrderedDict(sorted(entries.items(), key=lambda item: item[1][1]))
+			self.size = sum(item[0] for item in self.index.values())
+			self.dirty = True
+
+	def stats(self):
+		"""Return the index's size and eviction count as a dict."""
+		with self.lock:
+			return {'entries': len(self.index), 'bytes': self.size, 'evictions': self.evictions}
+
+# COALESCING: *********************************************************************************
+
+class Flight:
+	"""A response on its way from the end server into the cache, which other
+	clients asking for the same URL at the same time follow instead of each
+	fetching it again.
+
+	The client that started the fetch (the leader) streams the response into a
+	Writer, and its followers read the Writer's temporary file as it grows.
+	state is 'pending' until the response's header block arrives, 'streaming'
+	while it is being cached, then 'done' once it is in the cache or 'failed'
+	if it won't be (an error, or a response that can't be cached), in which case
+	followers that haven't sent anything yet fetch it for themselves.
+	"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.cond = threading.Condition()
+		self.state = 'pending'
+		self.head = None                 # header block as stored
+		self.length = None               # body length, if known up front
+		self.tmpname = None
+		self.written = 0                 # bytes in the temporary file so far
+		self.waiters = []                # callbacks run on every update (for asyncio followers)
+
+	def start(self, head, length, store):
+		"""Called by the leader once the header block has arrived and the
+		response is being written to store."""
+		self.update(head=head, length=length, tmpname=store.tmpname, state='streaming')
+
+	def update(self, **changes):
+		with self.cond:
+			for name, value in changes.items():
+				setattr(self, name, value)
+			self.cond.notify_all()
+			for waiter in self.waiters:
+				waiter()
+
+	def watch(self, callback):
+		"""Have callback() run on every update, from whichever thread makes it."""
+		with self.cond:
+			self.waiters.append(callback)
+
+	def unwatch(self, callback):
+		with self.cond:
+			self.waiters.remove(callback)
+
+	def wait(self, state, written):
+		"""Block until the flight is past state, or has more than written bytes."""
+		with self.cond:
+			self.cond.wait_for(lambda: self.state != state or self.written > written)
+
+	def open(self):
+		"""Open the response being fetched as it stands, or return None if it's no
+		longer streaming (so it is either in the cache or not coming)."""
+		with self.cond:
+			if self.state != 'streaming':
+				return None
+			return open(self.tmpname, 'rb')
+
+	def send(self, conn, persistent):
+		"""Send a follower's client the response, as it arrives.  Returns whether
+		the connection can carry another request, or None if nothing was sent
+		and the caller should fetch the response itself."""
+		self.wait('pending', 0)
+		f = self.open()
+		if f is None:
+			entry = lookup(self.filename) if self.state == 'done' else None
+			if entry is None:
+				return None
+			try:
+				entry.send(conn, persistent)
+			finally:
+				entry.close()
+			return persistent
+
+		with f:
+			client_head, persistent = frame(self.head, self.length, persistent)
+			conn.sendall(client_head)
+			pos = f.seek(len(self.head))
+			while True:
+				data = f.read(READSIZ)
+				if data:
+					conn.sendall(data)
+					pos += len(data)
+					continue
+				if self.state == 'done' and pos >= self.written:
+					return persistent
+				if self.state == 'failed':
+					raise ConnectionError("fetch of the response we were following failed")
+				self.wait('streaming', pos)
+
+flights = {}                             # cache filename -> Flight in progress
+flights_lock = threading.Lock()
+
+def join(filename):
+	"""Return (flight, leader): the Flight fetching filename's response, and
+	whether the caller has just started it and so must fetch it."""
+	with flights_lock:
+		flight = flights.get(filename)
+		if flight is not None:
+			return flight, False
+		flight = flights[filename] = Flight(filename)
+		return flight, True
+
+def land(filename, flight):
+	"""Called by the leader when it is done, however it went."""
+	with flights_lock:
+		if flights.get(filename) is flight:
+			del flights[filename]
+	if flight.state in ('pending', 'streaming'):
+		flight.update(state='failed')
+
+# The in-memory tier and the disk cache's index, shared by every connection
+memory = MemoryCache()
+disk = DiskCache()
@@ -0,0 +1,323 @@
+ # httputil.py - Helpers for picking apart HTTP messages, shared by the proxy engines and the cache.
+
+#imports
+import email.utils
+
+# Headers that only apply to a single connection, which a proxy must not pass on
+# (RFC 9110, section 7.6.1)
+HOP_BY_HOP = ('connection', 'keep-alive', 'proxy-connection', 'te', 'trailer',
+              'transfer-encoding', 'upgrade')
+
+# Largest header block we'll buffer while looking for its end, and largest request body
+MAX_HEADER = 64 * 1024
+MAX_BODY = 1024 * 1024
+
+# response_length() of a body sent with chunked transfer coding
+CHUNKED = -1
+
+HEX_DIGITS = frozenset(b'0123456789abcdefABCDEF')
+
+def parse_head(head):
+	"""Parse an HTTP header block (request or status line plus header lines).
+
+	Returns (components, headers): the first line split on whitespace, and a
+	dict mapping lowercased header names (str) to their values (str).  Repeated
+	headers are joined with commas.
+	"""
+	lines = head.split(b'\n')
+	components = lines[0].split()
+	headers = {}
+	for line in lines[1:]:
+		name, sep, value = line.partition(b':')
+		if not sep:
+			continue
+		name = name.strip().lower().decode('latin-1')
+		value = value.strip().decode('latin-1')
+		if name in headers:
+			headers[name] += ', ' + value
+		else:
+			headers[name] = value
+	return components, headers
+
+def split_head(data):
+	"""Split a message into (header block, rest) at the blank line, or return
+	(None, data) if the header block isn't complete yet."""
+	end = data.find(b'\r\n\r\n')
+	if end == -1:
+		return None, data
+	return data[:end + 4], data[end + 4:]
+
+def parse_cache_control(value):
+	"""Return the directives of a Cache-Control header as a dict of lowercased
+	name -> value (or True for directives without one)."""
+	directives = {}
+	for item in value.split(','):
+		name, sep, arg = item.strip().partition('=')
+		if name:
+			directives[name.lower()] = arg.strip('"') if sep else True
+	return directives
+
+def parse_date(value):
+	"""Convert an HTTP date to a Unix timestamp, or None if it can't be parsed."""
+	try:
+		return email.utils.parsedate_to_datetime(value).timestamp()
+	except (TypeError, ValueError, IndexError):
+		return None
+
+def read_head(rfile):
+	"""Read a header block from a buffered binary file (such as one from
+	socket.makefile()), or return None if it ended before one arrived.  Raises
+	ValueError if the block is larger than MAX_HEADER."""
+	lines = []
+	size = 0
+	while True:
+		line = rfile.readline(MAX_HEADER + 1)
+		size += len(line)
+		if not line:
+			if lines:
+				raise ConnectionError("connection closed mid-header")
+			return None
+		if size > MAX_HEADER:
+			raise ValueError("header block too large")
+		if line in (b'\r\n', b'\n') and not lines:
+			continue                             # stray blank line between messages
+		lines.append(line)
+		if line in (b'\r\n', b'\n'):
+			return b''.join(lines)
+
+def connection_tokens(headers, names=('connection',)):
+	"""The lowercased options listed in a message's Connection header (or the
+	other headers named)."""
+	return [t.strip().lower() for name in names
+	        for t in headers.get(name, '').split(',') if t.strip()]
+
+def strip_hop_by_hop(head, headers):
+	"""Return a header block without its hop-by-hop headers, including any that
+	its Connection header names."""
+	names = set(HOP_BY_HOP).union(connection_tokens(headers))
+	lines = head.split(b'\r\n')
+	kept = [lines[0]]
+	for line in lines[1:]:
+		if line and line.partition(b':')[0].strip().lower().decode('latin-1') not in names:
+			kept.append(line)
+	return b'\r\n'.join(kept) + b'\r\n\r\n'
+
+def downgrade(head, headers):
+	"""Rewrite a response header block from an end server for our HTTP/1.0
+	clients: HTTP/1.0 status line, and no hop-by-hop headers (in particular
+	Transfer-Encoding, as we pass chunked bodies on decoded)."""
+	return b'HTTP/1.0 ' + strip_hop_by_hop(head, headers)[9:]
+
+def response_length(components, headers):
+	"""How the body of a response to a GET is delimited (RFC 9112, section 6.3):
+	its length in bytes (0 if it can't have one), CHUNKED, or None if it runs
+	until the connection closes.  A malformed Content-Length (or repeated ones
+	that disagree) counts as none, so the connection isn't reused after it."""
+	status = components[1] if len(components) > 1 else b''
+	if status[:1] == b'1' or status in (b'204', b'304'):
+		return 0
+	if 'transfer-encoding' in headers:
+		return CHUNKED if headers['transfer-encoding'].lower().endswith('chunked') else None
+	if 'content-length' not in headers:
+		return None
+	try:
+		lengths = set(content_length(value) for value in headers['content-length'].split(','))
+	except ValueError:
+		return None
+	return lengths.pop() if len(lengths) == 1 else None
+
+def keep_alive(components, headers):
+	"""Whether the connection a response arrived on stays open after it."""
+	if components[:1] == [b'HTTP/1.1']:
+		return 'close' not in connection_tokens(headers)
+	return 'keep-alive' in connection_tokens(headers)
+
+def request_keep_alive(components, headers):
+	"""Whether a client wants its connection kept open after this request.  A
+	proxy client may say so with Proxy-Connection as well as Connection."""
+	tokens = connection_tokens(headers, ('connection', 'proxy-connection'))
+	if components[2:3] == [b'HTTP/1.1']:
+		return 'close' not in tokens
+	return 'keep-alive' in tokens
+
+def frame(head, length, persistent):
+	"""Set the framing of a response header block before it goes to a client:
+	Content-Length if the body length is known, and whether the connection is
+	kept open, which it only can be if the length is known.
+
+	Returns the new header block and whether the connection stays open.
+	"""
+	persistent = persistent and length is not None
+	lines = head.split(b'\r\n')
+	kept = [lines[0]]
+	for line in lines[1:]:
+		if line and line.partition(b':')[0].strip().lower() not in (b'content-length', b'connection'):
+			kept.append(line)
+	if length is not None:
+		kept.append(b'Content-Length: %d' % length)
+	kept.append(b'Connection: keep-alive' if persistent else b'Connection: close')
+	return b'\r\n'.join(kept) + b'\r\n\r\n', persistent
+
+def content_length(value):
+	"""Parse a Content-Length value, which must be ASCII digits only (int() would
+	also take signs, underscores and surrounding space).  Raises ValueError if
+	it isn't one."""
+	value = value.strip()
+	if not (value.isascii() and value.isdigit()):
+		raise ValueError("malformed Content-Length: %r" % value)
+	return int(value)
+
+def chunk_size(line):
+	"""Parse the size line that starts each chunk of a chunked body, which must
+	be hex digits only.  Raises ValueError if it isn't one."""
+	size = line.split(b';', 1)[0].strip()
+	if not size or not HEX_DIGITS.issuperset(size):
+		raise ValueError("malformed chunk size: %r" % size)
+	return int(size, 16)
+
+# REQUEST PARSING: ****************************************************************************
+
+class ParseError(ValueError):
+	"""Raised for a request we can't make sense of (or won't buffer)."""
+
+class Request:
+	"""A request from a client, parsed once: the parts of its request line
+	(method, target and version, as bytes), its header fields and its body.
+
+	headers maps lowercased names (str) to values (str), with repeated fields
+	joined by commas; fields keeps each header line as (lowercased name, line)
+	in the order they arrived, for passing them on.
+	"""
+
+	def __init__(self, head):
+		lines = head.split(b'\r\n')
+		components = lines[0].split()
+		if len(components) != 3:
+			raise ParseError("malformed request line")
+		self.method, self.target, self.version = components
+		self.headers = {}
+		self.fields = []
+		for line in lines[1:]:
+			name, sep, value = line.partition(b':')
+			if not sep:
+				continue                         # the blank lines at the end
+			name = name.strip().lower().decode('latin-1')
+			value = value.strip().decode('latin-1')
+			self.fields.append((name, line))
+			if name in self.headers:
+				self.headers[name] += ', ' + value
+			else:
+				self.headers[name] = value
+		self.body = b''
+
+	def keep_alive(self):
+		"""Whether the client wants its connection kept open after this request."""
+		return request_keep_alive([self.method, self.target, self.version], self.headers)
+
+	def body_length(self):
+		"""The length of the body that follows the header block, or CHUNKED."""
+		if 'transfer-encoding' in self.headers:
+			if not self.headers['transfer-encoding'].lower().endswith('chunked'):
+				raise ParseError("unsupported transfer coding")
+			return CHUNKED
+		try:
+			return content_length(self.headers.get('content-length', '0'))
+		except ValueError:
+			raise ParseError("malformed Content-Length") from None
+
+class RequestParser:
+	"""Splits the bytes arriving on a client connection into Requests.
+
+	It does no I/O of its own: feed() it whatever arrives, in pieces of any size,
+	and call next() for each complete request (header block and body, with
+	Content-Length or chunked framing).  Each byte is only scanned once while
+	looking for the end of the header block.  Bytes past the last request taken
+	stay in buffer, e.g. to start a CONNECT tunnel with.
+	"""
+
+	def __init__(self, max_header=MAX_HEADER, max_body=MAX_BODY):
+		self.max_header = max_header
+		self.max_body = max_body
+		self.buffer = bytearray()
+		self.scanned = 0                 # bytes of buffer known not to end the header block
+		self.request = None              # the request whose body we're reading, if any
+		self.state = None                # how that body is framed: 'length', 'size', 'data', 'crlf' or 'trailer'
+		self.remaining = 0
+		self.body = bytearray()
+
+	def feed(self, data):
+		self.buffer += data
+
+	def next(self):
+		"""Return the next complete request, or None if more bytes are needed.
+		Raises ParseError for a malformed or oversized request."""
+		if self.request is None:
+			if not self.read_head():
+				return None
+		if not self.read_body():
+			return None
+		request, self.request = self.request, None
+		request.body = bytes(self.body)
+		self.body = bytearray()
+		return request
+
+	def read_head(self):
+		# Clients may send a stray CRLF after a request's body
+		while self.buffer[:2] == b'\r\n':
+			del self.buffer[:2]
+			self.scanned = 0
+		end = self.buffer.find(b'\r\n\r\n', self.scanned)
+		if end == -1:
+			if len(self.buffer) > self.max_header:
+				raise ParseError("request header block too large")
+			self.scanned = max(len(self.buffer) - 3, 0)
+			return False
+		if end + 4 > self.max_header:
+			raise ParseError("request header block too large")
+		self.request = Request(bytes(self.buffer[:end + 4]))
+		del self.buffer[:end + 4]
+		self.scanned = 0
+
+		length = self.request.body_length()
+		if length == CHUNKED:
+			self.state = 'size'
+		elif length > self.max_body:
+			raise ParseError("request body too large")
+		else:
+			self.state = 'length'
+			self.remaining = length
+		return True
+
+	def read_body(self):
+		# Returns whether the body is complete, consuming as much of it as has arrived
+		while True:
+			if self.state in ('length', 'data'):
+				n = min(self.remaining, len(self.buffer))
+				self.body += self.buffer[:n]
+				del self.buffer[:n]
+				self.remaining -= n
+				if self.remaining:
+					return False
+				if self.state == 'length':
+					return True
+				self.state = 'crlf'
+			else:
+				eol = self.buffer.find(b'\r\n')
+				if eol == -1:
+					if len(self.buffer) > self.max_header:
+						raise ParseError("chunk line too long")
+					return False
+				line = bytes(self.buffer[:eol])
+				del self.buffer[:eol + 2]
+				if self.state == 'size':
+					try:
+						self.remaining = chunk_size(line)
+					except ValueError:
+						raise ParseError("malformed chunk size") from None
+					if len(self.body) + self.remaining > self.max_body:
+						raise ParseError("request body too large")
+					self.state = 'data' if self.remaining else 'trailer'
+				elif self.state == 'crlf':
+					self.state = 'size'
+				elif not line:
+					return True                  # blank line ending the trailer
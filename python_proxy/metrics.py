@@ -0,0 +1,164 @@
+ # metrics.py - Counters, latency histograms and per-request phase timings for the proxy, served
+ # at /stats and logged per request at INFO level.
+ # Shared by proxy.py, aioproxy.py, upstream.py and resolver.py.
+
+#imports
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+
+log = logging.getLogger('proxy')
+
+# Upper bounds of the histogram buckets, in seconds: 100 us doubling up to about 100 s
+BUCKETS = tuple(0.0001 * 2 ** k for k in range(21))
+
+# The phases of a request, in order, each timed from the end of the one before it where
+# they happen at all:
+#   accept     - connection accepted until its first request starts arriving (including any
+#                wait for a worker thread)
+#   parse      - first byte of the request until it has all arrived
+#   dns        - looking up the end server's address (not for cached addresses)
+#   connect    - connecting to the end server (not for pooled connections)
+#   first_byte - request complete until the end server's header block arrives
+#   last_byte  - request complete until the whole response has been sent
+#   total      - first byte of the request until the whole response has been sent
+PHASES = ('accept', 'parse', 'dns', 'connect', 'first_byte', 'last_byte', 'total')
+
+class Histogram:
+	"""Counts of observed durations in exponentially sized buckets, from which
+	percentiles can be estimated (to within a factor of two)."""
+
+	def __init__(self, bounds=BUCKETS):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)   # the last is everything over the top bound
+		self.count = 0
+		self.sum = 0.0
+		self.max = 0.0
+
+	def observe(self, value):
+		i = 0
+		while i < len(self.bounds) and value > self.bounds[i]:
+			i += 1
+		self.counts[i] += 1
+		self.count += 1
+		self.sum += value
+		self.max = max(self.max, value)
+
+	def percentile(self, p):
+		"""The upper bound of the bucket holding the p'th percentile."""
+		if not self.count:
+			return 0.0
+		rank = p / 100 * self.count
+		seen = 0
+		for i, n in enumerate(self.counts):
+			seen += n
+			if seen >= rank:
+				return self.bounds[i] if i < len(self.bounds) else self.max
+		return self.max
+
+	def summary(self):
+		"""count, mean and percentiles, the durations in milliseconds."""
+		if not self.count:
+			return {'count': 0}
+		return {'count': self.count, 'mean': round(self.sum / self.count * 1000, 3),
+		        'p50': round(self.percentile(50) * 1000, 3), 'p90': round(self.percentile(90) * 1000, 3),
+		        'p99': round(self.percentile(99) * 1000, 3), 'max': round(self.max * 1000, 3)}
+
+class Timing:
+	"""What happened to one request: when it started, how long each of its
+	phases took, and notes such as how the cache answered it."""
+
+	def __init__(self, accepted=None):
+		self.accepted = accepted         # when the connection was accepted, for its first request
+		self.started = None
+		self.parsed = None
+		self.phases = {}
+		self.notes = {}
+
+	def start(self):
+		"""Called when the first byte of the request is at hand (only the first
+		call counts)."""
+		if self.started is None:
+			self.started = time.monotonic()
+			if self.accepted is not None:
+				self.phases['accept'] = self.started - self.accepted
+
+	def parsed_now(self):
+		"""Called once the whole request has arrived."""
+		self.parsed = time.monotonic()
+		if self.started is not None:
+			self.phases['parse'] = self.parsed - self.started
+
+	def mark(self, phase):
+		"""Time phase (first_byte or last_byte) from when the request was parsed."""
+		if self.parsed is not None:
+			self.phases[phase] = time.monotonic() - self.parsed
+
+class Registry:
+	"""Counters (such as cache hits or bytes relayed), gauges that go up and
+	down (active connections) and a latency histogram per phase, shared by
+	every connection."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.histograms = {phase: Histogram() for phase in PHASES}
+		self.since = time.time()
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def finish(self, timing, request):
+		"""Record a finished request's phases and notes, and log them."""
+		timing.mark('last_byte')
+		if timing.started is not None:
+			timing.phases['total'] = time.monotonic() - timing.started
+		with self.lock:
+			for phase, seconds in timing.phases.items():
+				self.histograms[phase].observe(seconds)
+			self.counters['requests'] = self.counters.get('requests', 0) + 1
+			cached = timing.notes.get('cache')
+			if cached is not None:
+				name = 'cache_' + cached
+				self.counters[name] = self.counters.get(name, 0) + 1
+		if log.isEnabledFor(logging.INFO):
+			log.info('%s %s %s %s', request.method.decode('latin-1'), request.target.decode('latin-1'),
+			         ' '.join('%s=%s' % item for item in timing.notes.items()),
+			         ' '.join('%s=%.2fms' % (phase, timing.phases[phase] * 1000)
+			                  for phase in PHASES if phase in timing.phases))
+
+	def snapshot(self):
+		with self.lock:
+			return {'uptime': round(time.time() - self.since, 1), 'counters': dict(self.counters),
+			        'latency_ms': {phase: h.summary() for phase, h in self.histograms.items()}}
+
+# The Timing of the request being handled, in each thread or asyncio task
+current = contextvars.ContextVar('timing', default=None)
+
+def note(**notes):
+	"""Note things about the current request (such as cache='hit')."""
+	timing = current.get()
+	if timing is not None:
+		timing.notes.update(notes)
+
+def mark(phase):
+	timing = current.get()
+	if timing is not None:
+		timing.mark(phase)
+
+@contextlib.contextmanager
+def phase(name):
+	"""Time the block as phase name of the current request."""
+	t = time.monotonic()
+	try:
+		yield
+	finally:
+		timing = current.get()
+		if timing is not None:
+			timing.phases[name] = timing.phases.get(name, 0.0) + time.monotonic() - t
+
+# Shared by every connection
+registry = Registry()
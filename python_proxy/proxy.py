@@ -4,18 +4,45 @@
  #!/usr/bin/env python3
 
 #imports
-import sys
 import socket
 import hashlib
-import os
+import argparse
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import metrics
+import resolver
+import tunnel
+import upstream
+from httputil import (CHUNKED, HOP_BY_HOP, ParseError, RequestParser, parse_head, downgrade,
+                      response_length, keep_alive, frame)
 
 # A buffer size.  Use when buffers have sizes.  Recommended over reading entire
 # files or responses into a single bytes object, which may not be particularly
 # good when I'm trying to listen to di.fm using the proxy.
 BUFSIZ = 4096
 
+# How long a client connection may sit idle between requests, and how many
+# requests it may make before we close it
+KEEPALIVE_TIMEOUT = 5
+MAX_REQUESTS = 100
+
 # Hard coded variables
 user_agent_hdr = b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:57.0) Gecko/20100101 Firefox/57.0\r\n"
+connection_established_resp = b"HTTP/1.0 200 Connection Established\r\n\r\n"
+bad_gateway_resp = b"HTTP/1.0 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n"
+bad_request_resp = b"HTTP/1.0 400 Bad Request\r\nContent-Length: 0\r\n\r\n"
+not_implemented_resp = b"HTTP/1.0 501 Not Implemented\r\nContent-Length: 0\r\n\r\n"
+stats_hdr = b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nCache-Control: no-store\r\n\r\n"
+
+# Requests for this path (rather than a URL) are answered with the proxy's statistics
+STATS_PATH = b'/stats'
+
+log = logging.getLogger('proxy')
 
 # Some helper functions
 
@@ -25,57 +52,17 @@ def cachefile(url):
 	Please use this to generate cache filenames, passing it the full URL as
 	given in the client request.  (This will help me write tests for grading.)
 	"""
-	return 'cache/' + hashlib.sha256(url).hexdigest()
-
-	# Handles one HTTP request from client, forwards it to the server,
-	# gets a response from the server, stores the response in cache,
-	# and forwards the response to the client.
-def handle(conn):
-	# Recieve request and turn it into string
-	c_total_data = conn.recv(BUFSIZ)
-	c_size = sys.getsizeof(c_total_data)
-	while c_size >= BUFSIZ:
-		cur_data = conn.recv(BUFSIZ)
-		c_total_data += cur_data
-		c_size = sys.getsizeof(cur_data)
-
-	c_total_data = c_total_data.split(b'\r\n\r\n')      # Split headers from payload
-	c_total_data[0] = c_total_data[0] + b'\r\n\r\n'     # Add carrige return back on 
-
-	c_list_of_lines = c_total_data[0].split(b'\n')      # we send c_total_data[0] along later
-	# PARSING AND PREPARING HEADERS TO SEND TO SERVER -----------------------
-	
-	header_line = c_list_of_lines[0]                  # Retrieve the header line from the c_total_data recieved
-	print(header_line)
-	header_line_components = header_line.split()    # Split header line into "GET URL HTTP/1.1"
-
-	# # CACHE Fetching:
-	# filename = cachefile(header_line_components[1])
-	# dirpath = os.getcwd()
-	# full_path = dirpath + "/" + filename
-	# if os.path.isfile(full_path):
-	# 	fileDir = os.path.dirname(os.path.realpath('__file__'))
-	# 	filename = os.path.join(fileDir, filename)
-	# 	f = open(filename, "rb")
-	# 	contents = f.read()
-	# 	conn.sendall(contents)
-	# 	return
-
-
-	c_list_of_lines.pop(0)                            # Get rid of the header line from the list
-
-	if (header_line_components[0] != b'GET' and
-	 header_line_components[0] != b'CONNECT'):          #Is it a GET request?
-		print("\nERROR 501: "+ header_line_components[0].decode() + " requests are Not Implemented")
-		print("Proxy does not implement this method\n")
-		return
-
-	if header_line_components[1].find(b'http://') != -1:
-		url = header_line_components[1][7:]             #Get url without http:// beginning
+	digest = hashlib.sha256(url).hexdigest()
+	return 'cache/' + digest[:2] + '/' + digest  # sharded to keep directories small
+
+def parse_url(target):
+	"""Split a request target such as b'http://host:port/path' into
+	(host, port, path), with host and path as bytes and port as an int."""
+	if target.find(b'http://') != -1:
+		url = target[7:]             #Get url without http:// beginning
 	else:
-		url = header_line_components[1]
+		url = target
 
-	print(url)
 	path_start = url.find(b"/")                      # Separate URL from path
 	if path_start == -1:
 		path = b"/"
@@ -85,104 +72,366 @@ def handle(conn):
 
 	colon_location = url.find(b":")                  # Separate URL from port
 	if colon_location == -1:
-		port = b'80'
+		port = 80
 	else:
-		port = url[colon_location+1:]
+		port = int(url[colon_location+1:])
 		url = url[:colon_location]
 
-	print(url)
-													# url, port, and path have been parsed
-	header = (b"GET "+path+b" HTTP/1.0\r\n")
-	print(header)
-	host_hdr = b"Host: " + url + b"\r\n"
-
-	# Check cache for saved responses and send response back to client if available
-
-	# If response is not available then 
-	# Open a connection with the end server
-	ss = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	ss.connect((url, int(port.decode())))
-
-										# Send Header line and hard coded headers to end server
-	ss.sendall(header)
-	ss.sendall(host_hdr)
-	ss.sendall(user_agent_hdr)
-	print(host_hdr)
-	print(user_agent_hdr)
-
-	
-	 # Forward the rest of the request headers to the End Server
-	for line in c_list_of_lines:
-		if (line.find(b'Host:') != -1 or line.find(b'User-Agent:') != -1):
-			pass
-		else:
-			line = line + b'\n'
-			ss.sendall(line)
+	return url, port, path
 
-	ss.sendall(c_total_data[1])       # send the payload of the request to the end server too
-	
+def origin_request(host, path, fields, extra=b'', body=b''):
+	"""Build the request sent to the end server: our own request line, Host and
+	User-Agent, followed by the rest of the client's header fields (as in
+	httputil.Request.fields) except for hop-by-hop ones such as Connection, then
+	the body.
 
-	# RESPONSE FROM SERVER ***************************************************************
-	s_total_data = ss.recv(BUFSIZ)
-	s_size = sys.getsizeof(s_total_data)
-	while s_size >= BUFSIZ:
-		cur_data = conn.recv(BUFSIZ)
-		s_total_data += cur_data
-		s_size = sys.getsizeof(cur_data)
+	extra holds more header lines of our own (such as the validators of a stale
+	cache entry), which replace any the client sent with the same names.  The
+	body is framed with a Content-Length of our own, as the client's framing
+	(which may have been chunked) isn't passed on.
+	"""
+	header = (b"GET "+path+b" HTTP/1.1\r\n")
+	host_hdr = b"Host: " + host + b"\r\n"
+	lines = [header, host_hdr, user_agent_hdr, extra]
+	skip = set(HOP_BY_HOP)
+	skip.update(('host', 'user-agent', 'content-length'))
+	skip.update(line.partition(b':')[0].lower().decode('latin-1')
+	            for line in extra.split(b'\r\n') if line)
+	for name, line in fields:
+		if name not in skip:
+			lines.append(line + b'\r\n')
+	if body:
+		lines.append(b'Content-Length: %d\r\n' % len(body))
+	lines.append(b'\r\n')
+	lines.append(body)
+	return b''.join(lines)
+
+def relay(chunks, conn, client_head, head, store=None):
+	"""Send a response to the client, its body one chunk at a time as it
+	arrives from the end server, so memory use stays bounded however long it is.
+
+	client_head is the header block as sent to the client, head as it is stored.  If
+	a cache.Writer is given the response is also saved to the cache, which only
+	happens once it has arrived in full.
+	"""
+	sent = 0
+	try:
+		conn.sendall(client_head)
+		if store is not None:
+			store.write(head)
+		for chunk in chunks:
+			conn.sendall(chunk)
+			sent += len(chunk)
+			if store is not None:
+				store.write(chunk)
+	except BaseException:
+		if store is not None:
+			store.abort()
+		raise
+	finally:
+		metrics.registry.count('bytes_relayed', sent)
+	if store is not None:
+		store.commit()
+
+def handle(conn, accepted=None):
+	"""Serve HTTP requests from a client connection, one after another (including
+	pipelined ones), until the client closes it or a response can't be framed for
+	a persistent connection.  accepted is when the connection was accepted."""
+	parser = RequestParser()
+	for served in range(MAX_REQUESTS):
+		timing = metrics.Timing(None if served else accepted)
+		metrics.current.set(timing)
+		# Between requests, give up on a client that stays quiet for too long
+		conn.settimeout(KEEPALIVE_TIMEOUT if served else None)
+		try:
+			request = read_request(conn, parser, timing)
+		except socket.timeout:
+			return
+		except ParseError as err:
+			log.info("Bad request: %s", err)
+			metrics.registry.count('bad_requests')
+			conn.sendall(bad_request_resp)
+			return
+		conn.settimeout(None)
+		if request is None:
+			return
+		timing.parsed_now()
+		try:
+			persistent = handle_request(conn, parser, request, served == MAX_REQUESTS - 1)
+		finally:
+			metrics.registry.finish(timing, request)
+		if not persistent:
+			return
+
+def read_request(conn, parser, timing):
+	"""Receive from the client until parser has a complete request, and return
+	it, or None if the client closed the connection first."""
+	while True:
+		if parser.buffer:
+			timing.start()
+		request = parser.next()
+		if request is not None:
+			return request
+		data = conn.recv(BUFSIZ)
+		if not data:
+			return None
+		timing.start()
+		parser.feed(data)
+
+def connect_tunnel(conn, parser, host, port):
+	"""Answer a CONNECT request: open a connection to host and port, then relay
+	bytes both ways between it and the client until they are done."""
+	try:
+		ss = resolver.create_connection(host.decode(), port)
+	except OSError as err:
+		log.warning("CONNECT to %s failed: %r", host.decode(), err)
+		conn.sendall(bad_gateway_resp)
+		return
+	metrics.registry.count('tunnels')
+	with ss:
+		conn.sendall(connection_established_resp)
+		# The client may not have waited for our answer before starting (say) its
+		# TLS handshake, in which case the parser already holds some of it
+		tunnel.relay(conn, ss, bytes(parser.buffer))
 
-	s_total_data = b'HTTP/1.0 ' + s_total_data[9:]
-	conn.sendall(s_total_data)
-	print(s_total_data)
+	# Handles one HTTP request from client, forwards it to the server,
+	# and streams the server's response to the client, storing it in cache.
+	# Returns whether the connection can carry another request; it can't after the
+	# last one it's allowed, which is answered with Connection: close.
+def handle_request(conn, parser, request, last=False):
+	persistent = request.keep_alive() and not last
+	log.debug("%s %s", request.method.decode('latin-1'), request.target.decode('latin-1'))
+
+	if (request.method != b'GET' and
+	 request.method != b'CONNECT'):          #Is it a GET request?
+		log.info("ERROR 501: %s requests are Not Implemented", request.method.decode('latin-1'))
+		conn.sendall(not_implemented_resp)
+		return False
+
+	if request.target == STATS_PATH:
+		conn.sendall(stats_response(persistent))
+		return persistent
+
+	url, port, path = parse_url(request.target)
+													# url, port, and path have been parsed
 
-	if not os.path.exists('cache'):
-		os.mkdir('cache')
+	if request.method == b'CONNECT':
+		connect_tunnel(conn, parser, url, port)
+		return False
 
-	filename = cachefile(header_line_components[1])
+	# Check cache for saved responses and send response back to client if available
+	filename = cachefile(request.target)
+	response = cache.memory.get(filename)
+	if response is not None:
+		head, body = response
+		metrics.note(cache='memory')
+		conn.sendall(frame(head, len(body), persistent)[0] + body)
+		return persistent
+	entry = cache.lookup(filename)
+	try:
+		if entry is not None and entry.fresh():
+			metrics.note(cache='disk')
+			cache.memory.add(entry)
+			entry.send(conn, persistent)
+			return persistent
+
+		# Concurrent misses for the same URL share one fetch: the first to miss fetches
+		# the response and the others follow it as it is written to the cache
+		flight, leader = cache.join(filename)
+		if not leader:
+			metrics.note(cache='coalesced')
+			sent = flight.send(conn, persistent)
+			if sent is not None:
+				return sent
+			flight = None                       # it isn't being cached; fetch our own
+		metrics.note(cache='miss')
+		try:
+			return fetch(conn, request, url, port, path, filename, entry, flight, persistent)
+		finally:
+			if flight is not None:
+				cache.land(filename, flight)
+	finally:
+		if entry is not None:
+			entry.close()
+
+def fetch(conn, request, url, port, path, filename, entry, flight, persistent):
+	"""Get a response from the end server and stream it to the client (and into
+	the cache under filename, for flight's followers too).  entry is the stale
+	cache entry, if there is one.  Returns whether the connection can carry
+	another request."""
+	# Send Header line, hard coded headers, the rest of the client's headers and
+	# the payload of the request to the end server, over a pooled connection if
+	# we have one.  A stale entry is revalidated with a conditional GET.
+	validators = entry.validators() if entry is not None else b''
+	s_request = origin_request(url, path, request.fields, validators, request.body)
+	origin, s_head = upstream.request(url, port, s_request)
 
-	fileDir = os.path.dirname(os.path.realpath('__file__'))
-	filename = os.path.join(fileDir, filename)
+	# RESPONSE FROM SERVER ***************************************************************
+	try:
+		log.debug("%r", s_head)
+		components, headers = parse_head(s_head)
+		metrics.note(status=components[1].decode('latin-1') if len(components) > 1 else '?')
+		length = response_length(components, headers)
+		head = downgrade(s_head, headers)
+
+		if validators and components[1:2] == [b'304']:
+			entry.refresh(head)                     # Not Modified: ours is good again
+			metrics.note(cache='revalidated')
+			if flight is not None:
+				flight.update(state='done')
+			entry.send(conn, persistent)
+		else:
+			# A body whose length we don't know up front ends when we close the connection
+			known = None if length == CHUNKED else length
+			client_head, persistent = frame(head, known, persistent)
+			store = None
+			if cache.storable(s_head):
+				store = cache.Writer(filename, flight)
+				if flight is not None:
+					flight.start(head, known, store)
+			elif flight is not None:
+				flight.update(state='failed')       # followers fetch it for themselves
+			relay(origin.body(length), conn, client_head, head, store)
+	except BaseException:
+		origin.close()
+		raise
+	upstream.release(origin, length is not None and keep_alive(components, headers))
+	return persistent
+
+def stats():
+	"""Everything the proxy counts, as a dict."""
+	return {'proxy': metrics.registry.snapshot(), 'memory_cache': cache.memory.stats(),
+	        'disk_cache': cache.disk.stats(), 'dns': resolver.hosts.stats()}
+
+def stats_response(persistent):
+	"""The response to a request for STATS_PATH: stats() as JSON."""
+	body = json.dumps(stats(), indent=1).encode() + b'\n'
+	return frame(stats_hdr, len(body), persistent)[0] + body
+
+# CONCURRENCY: ********************************************************************************
+
+# Ways of serving clients, chosen with --mode:
+#   single - handle each connection inline in the accept loop (one client at a time)
+#   thread - start a new thread for every connection
+#   pool   - hand connections to a fixed-size pool of worker threads
+#   asyncio - serve every connection from one asyncio event loop (see aioproxy.py)
+MODES = ('pool', 'thread', 'single', 'asyncio')
+DEFAULT_WORKERS = 32
+DEFAULT_MAX_CONNS = 256
+
+# Sent to clients that arrive while max_conns connections are already in flight
+overloaded_resp = b"HTTP/1.0 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n"
+
+def serve_conn(conn, addr, slots=None, accepted=None):
+	"""Handle one client connection, then close it and free its slot."""
+	# A response's header block and body go out in separate writes, and with Nagle's
+	# algorithm the body would wait for the client's (delayed) ACK of the header block
+	conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	metrics.registry.count('connections')
+	metrics.registry.count('active_connections')
+	try:
+		log.debug("Connected to %s", addr)
+		handle(conn, accepted)
+	except Exception as err:
+		# One bad client or origin shouldn't take the whole proxy down
+		log.warning("Error handling %s: %r", addr, err)
+	finally:
+		metrics.registry.count('active_connections', -1)
+		conn.close()
+		if slots is not None:
+			slots.release()
+
+def shed(conn):
+	"""Turn a client away because the proxy is at its connection limit."""
+	metrics.registry.count('shed')
+	try:
+		conn.sendall(overloaded_resp)
+	except OSError:
+		pass
+	conn.close()
+
+def serve(cs, mode='pool', workers=DEFAULT_WORKERS, max_conns=DEFAULT_MAX_CONNS):
+	"""Accept connections on the listening socket cs forever.
+
+	In the thread and pool modes at most max_conns connections are in flight
+	(running or waiting for a worker); any more are answered with a 503 and
+	closed straight away instead of piling up.
+	"""
+	if mode == 'asyncio':
+		import aioproxy
+		aioproxy.run(cs, max_conns)
+		return
 
-	f = open(filename, "wb")
-	f.write(s_total_data)
-	f.close()
+	if mode == 'single':
+		while True:
+			conn, addr = cs.accept()
+			serve_conn(conn, addr, accepted=time.monotonic())
+
+	slots = threading.BoundedSemaphore(max_conns)
+	pool = None
+	if mode == 'pool':
+		pool = ThreadPoolExecutor(max_workers=workers)
+	try:
+		while True:
+			conn, addr = cs.accept()
+			accepted = time.monotonic()
+			if not slots.acquire(blocking=False):
+				shed(conn)
+				continue
+			if pool is not None:
+				pool.submit(serve_conn, conn, addr, slots, accepted)
+			else:
+				threading.Thread(target=serve_conn, args=(conn, addr, slots, accepted),
+				                 daemon=True).start()
+	finally:
+		if pool is not None:
+			pool.shutdown(wait=False)
 
 # MAIN: ***************************************************************************************
 
-# /* Check command line args */
-if len(sys.argv) != 2:
-	print("usage: " + sys.argv[0] + " <port>")
-	exit()
-
-# make sure given port number is valid
-try: 
-	port = int(sys.argv[1])
-except ValueError:
-	print("Invalid Port Number")
-	exit()
-
-# create a socket, cs
-try: 
-	cs = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-except socket.error as err: 
-	print ("socket creation failed with error " + str(err))
-
-# work around for making sure there is no "socket is use" error
-cs.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-
-host = '' # more flexible than hardcoding a host in
-cs.bind((host, port))         
-try:
-	cs.listen()      
-except KeyboardInterrupt:
-	exit()
-
-# Establish connection w/ client
-try:
-	while True:   
-		conn, addr = cs.accept()      
-		print ("Connected to " +  str(addr)) 
-		handle(conn)
-except KeyboardInterrupt:
-	exit()
-
-conn.close()
+def main():
+	parser = argparse.ArgumentParser(description="HTTP proxy")
+	parser.add_argument('port', type=int, help="port to listen on")
+	parser.add_argument('--mode', choices=MODES, default='pool',
+	                    help="how to serve concurrent clients (default: pool)")
+	parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+	                    help="worker threads in pool mode (default: %(default)s)")
+	parser.add_argument('--max-conns', type=int, default=DEFAULT_MAX_CONNS,
+	                    help="connections in flight before new ones get a 503 (default: %(default)s)")
+	parser.add_argument('--disk-cache', type=int, default=cache.DEFAULT_DISK_BUDGET,
+	                    help="bytes of responses to keep under cache/ (default: %(default)s)")
+	parser.add_argument('--mem-cache', type=int, default=cache.DEFAULT_MEMORY_BUDGET,
+	                    help="bytes of small responses to keep in memory, 0 to disable (default: %(default)s)")
+	parser.add_argument('--log-level', choices=('debug', 'info', 'warning', 'error'), default='warning',
+	                    help="info logs every request with its timings, debug also the headers (default: %(default)s)")
+	args = parser.parse_args()
+	logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+	cache.memory.budget = args.mem_cache
+	cache.disk.budget = args.disk_cache
+	cache.disk.start()
+
+	# create a socket, cs
+	try:
+		cs = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	except socket.error as err:
+		log.error("socket creation failed with error %s", err)
+		exit()
+
+	# work around for making sure there is no "socket is use" error
+	cs.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+	host = '' # more flexible than hardcoding a host in
+	cs.bind((host, args.port))
+
+	# Establish connection w/ client
+	try:
+		cs.listen()
+		serve(cs, args.mode, args.workers, args.max_conns)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		cs.close()
+		print(json.dumps(stats(), indent=1))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,224 @@
+ # resolver.py - Looking up end servers' addresses once and remembering them for a while, and
+ # connecting to them "happy eyeballs" style (RFC 8305): when a name has several addresses, the
+ # next one is tried if the last hasn't connected within a short delay, and the first to connect wins.
+ # Shared by proxy.py, upstream.py and aioproxy.py.
+
+#imports
+import asyncio
+import errno
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+# getaddrinfo() doesn't tell us the records' TTLs, so successful lookups are kept for a fixed
+# time, and failed ones (so a mistyped host doesn't cost a lookup per request) for a shorter one
+POSITIVE_TTL = 60
+NEGATIVE_TTL = 10
+MAX_ENTRIES = 1024
+
+# How long a connection attempt gets before the next address is tried alongside it
+# (RFC 8305, section 5)
+CONNECT_DELAY = 0.25
+
+class Resolver:
+	"""A cache of getaddrinfo() results keyed by (host, port), least recently
+	used first out once it holds max_entries.  Failed lookups are cached too,
+	and raise a socket.gaierror like the original again until they expire."""
+
+	def __init__(self, ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL, max_entries=MAX_ENTRIES):
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.max_entries = max_entries
+		self.entries = OrderedDict()     # (host, port) -> (expiry time, addrinfo list or gaierror)
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def cached(self, host, port):
+		"""Return the cached addresses of host, or None if there aren't any."""
+		now = time.monotonic()
+		with self.lock:
+			entry = self.entries.get((host, port))
+			if entry is None or entry[0] <= now:
+				self.misses += 1
+				return None
+			self.entries.move_to_end((host, port))
+			self.hits += 1
+		if isinstance(entry[1], Exception):
+			# A fresh exception each time: raising the stored one would pile each
+			# hit's traceback onto it, keeping those frames alive until it expires
+			raise socket.gaierror(*entry[1].args)
+		return entry[1]
+
+	def store(self, host, port, result):
+		"""Remember a lookup's result: a list of addrinfo tuples, or the error."""
+		ttl = self.ttl
+		if isinstance(result, Exception):
+			ttl = self.negative_ttl
+			result = socket.gaierror(*result.args)   # without the traceback of the failed lookup
+		with self.lock:
+			self.entries[(host, port)] = (time.monotonic() + ttl, result)
+			self.entries.move_to_end((host, port))
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+	def forget(self, host, port):
+		"""Drop host's addresses, e.g. because none of them could be connected to."""
+		with self.lock:
+			self.entries.pop((host, port), None)
+
+	def resolve(self, host, port):
+		"""Return host's addresses for TCP connections to port, looking them up
+		(blocking the calling thread) if they aren't cached."""
+		infos = self.cached(host, port)
+		if infos is None:
+			try:
+				with metrics.phase('dns'):
+					infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+			except socket.gaierror as err:
+				self.store(host, port, err)
+				raise
+			self.store(host, port, infos)
+		return infos
+
+	async def resolve_async(self, host, port):
+		"""resolve() for coroutines: a lookup runs in the event loop's executor."""
+		infos = self.cached(host, port)
+		if infos is None:
+			try:
+				with metrics.phase('dns'):
+					infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+			except socket.gaierror as err:
+				self.store(host, port, err)
+				raise
+			self.store(host, port, infos)
+		return infos
+
+	def stats(self):
+		with self.lock:
+			return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+def interleave(infos):
+	"""Order addresses for connecting to, alternating between address families
+	starting with the first one getaddrinfo() returned (RFC 8305, section 4)."""
+	families = OrderedDict()
+	for info in infos:
+		families.setdefault(info[0], []).append(info)
+	ordered = []
+	while families:
+		for family in list(families):
+			ordered.append(families[family].pop(0))
+			if not families[family]:
+				del families[family]
+	return ordered
+
+def connect(infos):
+	"""Connect to the first of the addresses that will accept a connection,
+	starting another attempt every CONNECT_DELAY seconds while earlier ones are
+	still pending.  Returns a blocking socket; raises the last error if no
+	address can be connected to."""
+	addrs = interleave(infos)
+	pending = {}                         # socket -> address it is connecting to
+	errors = []
+	sel = selectors.DefaultSelector()
+	try:
+		while addrs or pending:
+			if addrs:
+				family, type, proto, _, sockaddr = addrs.pop(0)
+				sock = socket.socket(family, type, proto)
+				sock.setblocking(False)
+				err = sock.connect_ex(sockaddr)
+				if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+					errors.append(OSError(err, "connect to %s failed" % (sockaddr,)))
+					sock.close()
+					continue
+				sel.register(sock, selectors.EVENT_WRITE)
+				pending[sock] = sockaddr
+			for key, _ in sel.select(CONNECT_DELAY if addrs else None):
+				sock = key.fileobj
+				sel.unregister(sock)
+				sockaddr = pending.pop(sock)
+				err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+				if err == 0:
+					sock.setblocking(True)
+					return sock
+				errors.append(OSError(err, "connect to %s failed" % (sockaddr,)))
+				sock.close()
+		raise errors[-1] if errors else OSError("no addresses to connect to")
+	finally:
+		sel.close()
+		for sock in pending:
+			sock.close()
+
+async def connect_async(infos):
+	"""connect() for coroutines.  Returns a non-blocking socket."""
+	loop = asyncio.get_running_loop()
+
+	async def attempt(info):
+		family, type, proto, _, sockaddr = info
+		sock = socket.socket(family, type, proto)
+		sock.setblocking(False)
+		try:
+			await loop.sock_connect(sock, sockaddr)
+		except BaseException:
+			sock.close()
+			raise
+		return sock
+
+	addrs = interleave(infos)
+	pending = set()
+	errors = []
+	winner = None
+	try:
+		while addrs or pending:
+			if addrs:
+				pending.add(loop.create_task(attempt(addrs.pop(0))))
+			done, pending = await asyncio.wait(pending, timeout=CONNECT_DELAY if addrs else None,
+			                                   return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				if task.exception() is not None:
+					errors.append(task.exception())
+				elif winner is None:
+					winner = task.result()
+				else:
+					task.result().close()        # connected at the same time as the winner
+			if winner is not None:
+				return winner
+		raise errors[-1] if errors else OSError("no addresses to connect to")
+	finally:
+		for task in pending:
+			task.cancel()
+
+def create_connection(host, port):
+	"""Open a connection to host (str) and port, like socket.create_connection()
+	but with cached addresses.  Addresses that can't be connected to are
+	forgotten, so the next attempt looks them up again."""
+	try:
+		infos = hosts.resolve(host, port)
+		with metrics.phase('connect'):
+			return connect(infos)
+	except socket.gaierror:
+		raise
+	except OSError:
+		hosts.forget(host, port)
+		raise
+
+async def open_connection(host, port, **kwds):
+	"""asyncio.open_connection() with cached addresses: returns (reader, writer)."""
+	try:
+		infos = await hosts.resolve_async(host, port)
+		with metrics.phase('connect'):
+			sock = await connect_async(infos)
+	except socket.gaierror:
+		raise
+	except OSError:
+		hosts.forget(host, port)
+		raise
+	return await asyncio.open_connection(sock=sock, **kwds)
+
+# Addresses shared by every connection
+hosts = Resolver()
@@ -0,0 +1,374 @@
+ # test_cache.py - Tests for which responses cache.py stores, for reading back and revalidating
+ # stored entries, for the in-memory tier, for the disk cache's index and for coalescing fetches.
+ #
+ # Usage: python3 -m pytest test_cache.py (or python3 test_cache.py)
+
+#imports
+import email.utils
+import os.path
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cache
+from cache import storable, Entry
+
+def date(t):
+	return email.utils.formatdate(t, usegmt=True)
+
+class CacheDirTest(unittest.TestCase):
+	# Gives each test an empty cache directory, and its own memory tier and disk index
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.root)
+		for name, value in (('memory', cache.MemoryCache()), ('disk', cache.DiskCache(self.root))):
+			patcher = mock.patch.object(cache, name, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def store(self, name, head, body):
+		filename = os.path.join(self.root, name[:2], name)
+		w = cache.Writer(filename)
+		w.write(head + body)
+		w.commit()
+		return filename
+
+	def lookup(self, filename):
+		entry = cache.lookup(filename)
+		self.addCleanup(entry.close)
+		return entry
+
+class A_StorableTest(unittest.TestCase):
+	def test_01_storable(self):
+		"""Plain 200 responses are stored"""
+		self.assertTrue(storable(b'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n\r\n'))
+
+	def test_02_not_storable(self):
+		"""Other statuses, no-store, private and any Vary aren't"""
+		for head in (b'HTTP/1.1 404 Not Found\r\n\r\n',
+		             b'HTTP/1.1 200 OK\r\nCache-Control: no-store\r\n\r\n',
+		             b'HTTP/1.1 200 OK\r\nCache-Control: private, max-age=60\r\n\r\n',
+		             b'HTTP/1.1 200 OK\r\nVary: *\r\n\r\n',
+		             b'HTTP/1.1 200 OK\r\nVary: Accept-Encoding\r\n\r\n'):
+			self.assertFalse(storable(head), head)
+
+class B_FreshnessTest(unittest.TestCase):
+	def entry(self, *headers, stored=1000000.0):
+		head = b'HTTP/1.1 200 OK\r\n' + b''.join(h.encode() + b'\r\n' for h in headers) + b'\r\n'
+		return Entry('x', None, head, stored, len(head))
+
+	def test_01_lifetime(self):
+		"""s-maxage, then max-age, then Expires, then the Last-Modified heuristic say how long it's fresh"""
+		t = 1000000.0
+		self.assertEqual(self.entry('Cache-Control: max-age=60').lifetime(), 60)
+		self.assertEqual(self.entry('Cache-Control: max-age=60, s-maxage=5').lifetime(), 5)
+		self.assertEqual(self.entry('Cache-Control: no-cache, max-age=60').lifetime(), 0)
+		self.assertEqual(self.entry('Cache-Control: max-age=x').lifetime(), 0)
+		self.assertEqual(self.entry('Date: ' + date(t), 'Expires: ' + date(t + 300)).lifetime(), 300)
+		self.assertEqual(self.entry('Expires: 0').lifetime(), 0)
+		self.assertEqual(self.entry('Date: ' + date(t), 'Last-Modified: ' + date(t - 1000)).lifetime(), 100)
+		self.assertEqual(self.entry().lifetime(), 0)
+
+	def test_02_age(self):
+		"""Age counts the time before it was stored (by Date or Age) plus the time since"""
+		t = 1000000.0
+		self.assertEqual(self.entry(stored=t).age(t + 10), 10)
+		self.assertEqual(self.entry('Date: ' + date(t - 30), stored=t).age(t + 10), 40)
+		self.assertEqual(self.entry('Age: 50', 'Date: ' + date(t - 30), stored=t).age(t + 10), 60)
+		self.assertEqual(self.entry('Age: x', stored=t).age(t), 0)
+
+	def test_03_fresh(self):
+		"""An entry is fresh while its age is under its lifetime, and expires when they meet"""
+		t = 1000000.0
+		entry = self.entry('Cache-Control: max-age=60', 'Age: 10', stored=t)
+		self.assertTrue(entry.fresh(t + 49))
+		self.assertFalse(entry.fresh(t + 50))
+		self.assertEqual(entry.expires(t + 20), t + 50)
+
+class C_EntryTest(CacheDirTest):
+	HEAD = b'HTTP/1.1 200 OK\r\nETag: "a"\r\nContent-Length: 8\r\nCache-Control: max-age=0\r\n\r\n'
+
+	def test_01_lookup(self):
+		"""A stored response reads back with its header block, size and body"""
+		filename = self.store('ab' * 32, self.HEAD, b'OLD-BODY')
+		entry = self.lookup(filename)
+		self.assertEqual(entry.head, self.HEAD)
+		self.assertEqual(entry.size, len(self.HEAD) + 8)
+		self.assertEqual(entry.body(), b'OLD-BODY')
+		self.assertEqual(entry.validators(), b'If-None-Match: "a"\r\n')
+		self.assertIsNone(cache.lookup(filename + 'x'))
+
+	def test_02_refresh(self):
+		"""A 304's headers replace the stored ones, except those describing the body"""
+		filename = self.store('ab' * 32, self.HEAD, b'OLD-BODY')
+		entry = self.lookup(filename)
+		self.assertFalse(entry.fresh())
+		entry.refresh(b'HTTP/1.1 304 Not Modified\r\nETag: "b"\r\nContent-Length: 0\r\n'
+		              b'Cache-Control: max-age=60\r\n\r\n')
+		self.assertTrue(entry.fresh())
+		self.assertEqual(entry.headers['etag'], '"b"')
+		self.assertEqual(entry.headers['content-length'], '8')
+		self.assertEqual(entry.body(), b'OLD-BODY')
+		again = self.lookup(filename)
+		self.assertEqual((again.head, again.body()), (entry.head, b'OLD-BODY'))
+
+	def test_03_replaced(self):
+		"""An entry replaced after lookup() is still read as it was when looked up"""
+		filename = self.store('ab' * 32, self.HEAD, b'OLD-BODY')
+		entry = self.lookup(filename)
+		self.store('ab' * 32, b'HTTP/1.1 200 OK\r\nETag: "a-much-longer-validator"\r\n\r\n', b'NEW-BODY')
+		self.assertEqual(entry.body(), b'OLD-BODY')
+		cache.memory.add(entry)
+		self.assertEqual(cache.memory.get(filename, 0), (self.HEAD, b'OLD-BODY'))
+		a, b = socket.socketpair()
+		with a, b:
+			entry.send(a)
+			a.shutdown(socket.SHUT_WR)
+			received = b''.join(iter(lambda: b.recv(4096), b''))
+		self.assertTrue(received.endswith(b'Content-Length: 8\r\nConnection: close\r\n\r\nOLD-BODY'))
+
+class D_MemoryCacheTest(unittest.TestCase):
+	def test_01_get(self):
+		"""Cached responses come back until they expire, and expiry counts as an expiration"""
+		memory = cache.MemoryCache()
+		memory.put('a', b'H', b'body', 100)
+		self.assertEqual(memory.get('a', 99), (b'H', b'body'))
+		self.assertIsNone(memory.get('b', 99))
+		self.assertIsNone(memory.get('a', 100))
+		self.assertNotIn('a', memory.entries)
+		self.assertEqual(memory.stats(), {'hits': 1, 'misses': 2, 'evictions': 0, 'expirations': 1,
+		                                  'entries': 0, 'bytes': 0})
+
+	def test_02_lru(self):
+		"""Past the budget the least recently used go first, and are counted"""
+		memory = cache.MemoryCache(budget=30)
+		for name in 'abc':
+			memory.put(name, b'H', b'x' * 9, 100)
+		memory.get('a', 0)                       # now b is the least recently used
+		memory.put('d', b'H', b'x' * 9, 100)
+		self.assertEqual(list(memory.entries), ['c', 'a', 'd'])
+		self.assertEqual(memory.size, 30)
+		memory.put('e', b'H', b'x' * 19, 100)
+		self.assertEqual(list(memory.entries), ['d', 'e'])
+		self.assertEqual(memory.evictions, 3)
+
+	def test_03_replace(self):
+		"""Putting a response again replaces it, and discard() drops it"""
+		memory = cache.MemoryCache()
+		memory.put('a', b'H', b'old', 100)
+		memory.put('a', b'H', b'newer', 100)
+		self.assertEqual((memory.get('a', 0), memory.size), ((b'H', b'newer'), 6))
+		memory.discard('a')
+		memory.discard('a')
+		self.assertEqual((len(memory.entries), memory.size), (0, 0))
+
+	def test_04_max_entry(self):
+		"""Responses over max_entry (or the whole budget) aren't kept"""
+		memory = cache.MemoryCache(budget=100, max_entry=10)
+		memory.put('a', b'H', b'x' * 9, 100)
+		memory.put('b', b'H', b'x' * 10, 100)
+		self.assertEqual(list(memory.entries), ['a'])
+		memory = cache.MemoryCache(budget=5, max_entry=10)
+		memory.put('a', b'H', b'x' * 9, 100)
+		self.assertEqual(memory.entries, {})
+
+class E_MemoryAddTest(CacheDirTest):
+	def test_01_add(self):
+		"""A fresh disk entry is copied in until it expires, unless it's too large"""
+		head = b'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n\r\n'
+		small = self.lookup(self.store('ab' * 32, head, b'x' * 10))
+		large = self.lookup(self.store('cd' * 32, head, b'x' * 100))
+		memory = cache.MemoryCache(max_entry=len(head) + 10)
+		memory.add(small)
+		memory.add(large)
+		self.assertEqual(list(memory.entries), [small.filename])
+		self.assertEqual(memory.get(small.filename), (head, b'x' * 10))
+		self.assertAlmostEqual(memory.entries[small.filename][2], small.expires(), delta=1)
+
+class F_DiskCacheTest(CacheDirTest):
+	HEAD = b'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n\r\n'
+
+	def fill(self, names):
+		# Store a 100-byte response under each of names, in order; return their filenames
+		return [self.store(name * 64, self.HEAD, b'x' * (100 - len(self.HEAD))) for name in names]
+
+	def test_01_evict(self):
+		"""Past its budget the least recently used entries go, down to LOW_WATER of it"""
+		a, b, c, d = self.fill('abcd')
+		cache.disk.budget = 350                  # down to 315 bytes
+		cache.disk.evict()
+		self.assertEqual(list(cache.disk.index), [b, c, d])
+		self.assertFalse(os.path.exists(a))
+		self.assertEqual(cache.disk.stats(), {'entries': 3, 'bytes': 300, 'evictions': 1})
+		cache.disk.evict()                       # under budget: nothing to do
+		self.assertEqual(len(cache.disk.index), 3)
+
+	def test_02_expired_first(self):
+		"""Entries known to be stale go before less recently used ones"""
+		a, b, c, d = self.fill('abcd')
+		cache.disk.used(c, 100, 1.0)
+		cache.disk.budget = 350
+		cache.disk.evict()
+		self.assertEqual(list(cache.disk.index), [a, b, d])
+
+	def test_03_memory_hit(self):
+		"""Hits on the in-memory copy keep an entry from looking least recently used on disk"""
+		a, b, c = self.fill('abc')
+		entry = self.lookup(a)
+		cache.memory.add(entry)
+		self.fill('d')
+		for _ in range(100):
+			self.assertIsNotNone(cache.memory.get(a))
+		self.assertEqual(list(cache.disk.index)[-1], a)
+		cache.disk.budget = 350
+		cache.disk.evict()
+		self.assertIn(a, cache.disk.index)
+		self.assertNotIn(b, cache.disk.index)
+		self.assertIsNotNone(cache.memory.get(a))
+
+	def test_04_save_load(self):
+		"""The index saved to root/index reads back the same"""
+		a, b = self.fill('ab')
+		cache.disk.used(a, 100, 2000000000.0)
+		cache.disk.save()
+		self.assertFalse(cache.disk.dirty)
+		disk = cache.DiskCache(self.root)
+		disk.load()
+		self.assertEqual(list(disk.index), [b, a])
+		self.assertEqual([item[0] for item in disk.index.values()], [100, 100])
+		self.assertEqual((disk.index[a][2], disk.index[b][2]), (2000000000.0, None))
+		self.assertEqual(disk.size, 200)
+
+	def test_05_rescan(self):
+		"""Only subdirectories changed since the index was saved are scanned, and left-over temporary files go"""
+		a, = self.fill('a')
+		cache.disk.discard(a)                    # on disk, but not in the saved index
+		cache.disk.save()
+		saved = os.stat(os.path.join(self.root, 'index')).st_mtime
+		os.utime(os.path.dirname(a), (saved - 10, saved - 10))
+		b, = self.fill('b')
+		tmpname = b + '.1.2.tmp'
+		open(tmpname, 'wb').close()
+		os.utime(os.path.dirname(b), (saved + 10, saved + 10))
+		disk = cache.DiskCache(self.root)
+		disk.load()
+		self.assertEqual(list(disk.index), [b])
+		self.assertFalse(os.path.exists(tmpname))
+
+	def test_06_flat(self):
+		"""Entries stored before the cache was sharded are moved into their subdirectories"""
+		name = 'ef' * 32
+		with open(os.path.join(self.root, name), 'wb') as f:
+			f.write(self.HEAD + b'body')
+		disk = cache.DiskCache(self.root)
+		disk.load()
+		filename = os.path.join(self.root, 'ef', name)
+		self.assertTrue(os.path.exists(filename))
+		self.assertFalse(os.path.exists(os.path.join(self.root, name)))
+		self.assertEqual(list(disk.index), [filename])
+		self.assertEqual(disk.size, len(self.HEAD) + 4)
+
+class Conn:
+	# Stands in for a client socket, keeping what is sent to it
+	def __init__(self):
+		self.data = bytearray()
+
+	def sendall(self, data):
+		self.data += data
+
+	def sendfile(self, f, offset, count):
+		f.seek(offset)
+		self.data += f.read(count)
+
+class G_FlightTest(CacheDirTest):
+	HEAD = b'HTTP/1.0 200 OK\r\nCache-Control: max-age=60\r\n\r\n'
+
+	def setUp(self):
+		super().setUp()
+		self.filename = os.path.join(self.root, 'ab', 'ab' * 32)
+		self.flight, leader = cache.join(self.filename)
+		self.assertTrue(leader)
+		self.addCleanup(cache.land, self.filename, self.flight)
+
+	def follow(self):
+		# Start a follower in a thread; returns its Conn and its outcome, once joined
+		self.assertEqual(cache.join(self.filename), (self.flight, False))
+		conn = Conn()
+		outcome = []
+
+		def run():
+			try:
+				outcome.append(self.flight.send(conn, True))
+			except ConnectionError as err:
+				outcome.append(err)
+		thread = threading.Thread(target=run, daemon=True)
+		thread.start()
+		self.addCleanup(thread.join, 5)
+		return conn, outcome, thread
+
+	def wait_for(self, conn, data):
+		deadline = time.monotonic() + 5
+		while not conn.data.endswith(data):
+			self.assertLess(time.monotonic(), deadline, "follower never got %r" % data)
+			time.sleep(0.001)
+
+	def test_01_streaming(self):
+		"""Followers get the response as the leader writes it to the cache"""
+		conn, outcome, thread = self.follow()
+		store = cache.Writer(self.filename, self.flight)
+		self.flight.start(self.HEAD, 10, store)
+		store.write(self.HEAD)
+		store.write(b'first')
+		self.wait_for(conn, b'first')
+		self.assertEqual(self.flight.state, 'streaming')
+		store.write(b'-last')
+		store.commit()
+		cache.land(self.filename, self.flight)
+		thread.join(5)
+		self.assertEqual(outcome, [True])
+		self.assertTrue(conn.data.startswith(b'HTTP/1.0 200 OK\r\n'))
+		self.assertIn(b'Content-Length: 10\r\nConnection: keep-alive\r\n\r\nfirst-last', conn.data)
+		self.assertNotIn(self.filename, cache.flights)
+
+	def test_02_failed_early(self):
+		"""A follower that hasn't sent anything when the fetch fails is told to fetch it itself"""
+		conn, outcome, thread = self.follow()
+		cache.land(self.filename, self.flight)   # the leader gave up before a response arrived
+		thread.join(5)
+		self.assertEqual((outcome, conn.data), ([None], b''))
+		self.assertEqual(self.flight.state, 'failed')
+		flight, leader = cache.join(self.filename)
+		self.addCleanup(cache.land, self.filename, flight)
+		self.assertIsNot(flight, self.flight)
+		self.assertTrue(leader)
+
+	def test_03_failed_midstream(self):
+		"""A follower that has started sending when the fetch fails raises"""
+		conn, outcome, thread = self.follow()
+		store = cache.Writer(self.filename, self.flight)
+		self.flight.start(self.HEAD, 10, store)
+		store.write(self.HEAD)
+		store.write(b'first')
+		self.wait_for(conn, b'first')
+		store.abort()
+		thread.join(5)
+		self.assertIsInstance(outcome[0], ConnectionError)
+		self.assertFalse(os.path.exists(self.filename))
+
+	def test_04_not_modified(self):
+		"""When the leader's fetch revalidates the stored entry, followers are sent that"""
+		self.store('ab' * 32, self.HEAD, b'cached')
+		conn, outcome, thread = self.follow()
+		self.flight.update(state='done')       # as fetch() does on a 304
+		thread.join(5)
+		self.assertEqual(outcome, [True])
+		self.assertTrue(conn.data.endswith(b'Content-Length: 6\r\nConnection: keep-alive\r\n\r\ncached'))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,179 @@
+ # test_httputil.py - Tests for the request parser and the message helpers in httputil.py, and for
+ # the requests proxy.py builds for end servers.
+ #
+ # Usage: python3 -m pytest test_httputil.py (or python3 test_httputil.py)
+
+#imports
+import os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from httputil import (CHUNKED, ParseError, RequestParser, parse_head, response_length,
+                      request_keep_alive, frame, downgrade)
+from proxy import origin_request
+
+GET = b'GET http://example.com/a HTTP/1.1\r\nHost: example.com\r\n\r\n'
+
+class A_RequestParserTest(unittest.TestCase):
+	def parse(self, data, step=None):
+		# Feed data in pieces of step bytes (all at once by default); return the requests
+		parser = RequestParser()
+		requests = []
+		step = step or len(data)
+		for i in range(0, len(data), step):
+			parser.feed(data[i:i + step])
+			while True:
+				request = parser.next()
+				if request is None:
+					break
+				requests.append(request)
+		return parser, requests
+
+	def test_01_simple(self):
+		"""A request's line and headers are picked apart"""
+		_, [request] = self.parse(GET)
+		self.assertEqual((request.method, request.target, request.version),
+		                 (b'GET', b'http://example.com/a', b'HTTP/1.1'))
+		self.assertEqual(request.headers, {'host': 'example.com'})
+		self.assertEqual(request.fields, [('host', b'Host: example.com')])
+		self.assertEqual(request.body, b'')
+
+	def test_02_incomplete(self):
+		"""Nothing is returned until the header block is complete"""
+		parser, requests = self.parse(GET[:-2])
+		self.assertEqual(requests, [])
+		parser.feed(b'\r\n')
+		self.assertIsNotNone(parser.next())
+
+	def test_03_byte_at_a_time(self):
+		"""Requests split at any point parse the same"""
+		data = GET + b'GET /b HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello'
+		_, requests = self.parse(data, step=1)
+		self.assertEqual([r.target for r in requests], [b'http://example.com/a', b'/b'])
+		self.assertEqual(requests[1].body, b'hello')
+
+	def test_04_pipelined(self):
+		"""Pipelined requests come out one at a time, with stray CRLFs between them skipped"""
+		_, requests = self.parse(GET + b'\r\n' + GET + GET)
+		self.assertEqual(len(requests), 3)
+
+	def test_05_content_length(self):
+		"""A body framed by Content-Length is read"""
+		_, [request] = self.parse(b'GET / HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc')
+		self.assertEqual(request.body, b'abc')
+
+	def test_06_chunked(self):
+		"""A chunked body is decoded, extensions and trailers included"""
+		data = (b'GET / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+		        b'5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n')
+		for step in (None, 1, 7):
+			_, requests = self.parse(data + GET, step)
+			self.assertEqual(len(requests), 2)
+			self.assertEqual(requests[0].body, b'hello world')
+
+	def test_07_leftover(self):
+		"""Bytes after the last request stay in the buffer"""
+		parser, _ = self.parse(b'CONNECT example.com:443 HTTP/1.1\r\n\r\n\x16\x03\x01')
+		self.assertEqual(bytes(parser.buffer), b'\x16\x03\x01')
+
+	def test_08_errors(self):
+		"""Malformed and oversized requests raise ParseError"""
+		bad = [b'GET /\r\n\r\n',
+		       b'GET / HTTP/1.1\r\nContent-Length: x\r\n\r\n',
+		       b'GET / HTTP/1.1\r\nContent-Length: -1\r\n\r\n',
+		       b'GET / HTTP/1.1\r\nContent-Length: +5\r\n\r\n',
+		       b'GET / HTTP/1.1\r\nContent-Length: 1_0\r\n\r\n',
+		       b'GET / HTTP/1.1\r\nContent-Length: 1 0\r\n\r\n',
+		       b'GET / HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\n',
+		       b'GET / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n',
+		       b'GET / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n-3\r\nabc\r\n0\r\n\r\n',
+		       b'GET / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n+5\r\nhello\r\n0\r\n\r\n',
+		       b'GET / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n0x10\r\n',
+		       b'GET / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n1_0\r\n',
+		       b'GET / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n;ext\r\n']
+		for data in bad:
+			with self.assertRaises(ParseError):
+				self.parse(data)
+		with self.assertRaises(ParseError):
+			parser = RequestParser(max_header=100)
+			parser.feed(b'GET / HTTP/1.1\r\nX: ' + b'x' * 200)
+			parser.next()
+		with self.assertRaises(ParseError):
+			parser = RequestParser(max_body=10)
+			parser.feed(b'GET / HTTP/1.1\r\nContent-Length: 11\r\n\r\n')
+			parser.next()
+
+	def test_09_keep_alive(self):
+		"""HTTP/1.1 requests are persistent unless they say close; HTTP/1.0 ones if they say keep-alive"""
+		cases = [(b'GET / HTTP/1.1\r\n\r\n', True),
+		         (b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n', False),
+		         (b'GET / HTTP/1.0\r\n\r\n', False),
+		         (b'GET / HTTP/1.0\r\nProxy-Connection: Keep-Alive\r\n\r\n', True)]
+		for data, expected in cases:
+			_, [request] = self.parse(data)
+			self.assertEqual(request.keep_alive(), expected)
+			components, headers = parse_head(data)
+			self.assertEqual(request_keep_alive(components, headers), expected)
+
+class B_ResponseTest(unittest.TestCase):
+	def length(self, head):
+		return response_length(*parse_head(head))
+
+	def test_01_length(self):
+		"""Response bodies are delimited as RFC 9112 says"""
+		self.assertEqual(self.length(b'HTTP/1.1 200 OK\r\nContent-Length: 12\r\n\r\n'), 12)
+		self.assertEqual(self.length(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'), CHUNKED)
+		self.assertIsNone(self.length(b'HTTP/1.1 200 OK\r\n\r\n'))
+		self.assertEqual(self.length(b'HTTP/1.1 304 Not Modified\r\nContent-Length: 12\r\n\r\n'), 0)
+		self.assertEqual(self.length(b'HTTP/1.1 200 OK\r\nContent-Length: 12, 12\r\n\r\n'), 12)
+
+	def test_02_frame(self):
+		"""Framing replaces Content-Length and Connection, and can't keep a connection without a length"""
+		head = b'HTTP/1.0 200 OK\r\nContent-Length: 1\r\nConnection: close\r\nX: y\r\n\r\n'
+		self.assertEqual(frame(head, 5, True),
+		                 (b'HTTP/1.0 200 OK\r\nX: y\r\nContent-Length: 5\r\nConnection: keep-alive\r\n\r\n', True))
+		self.assertEqual(frame(head, None, True),
+		                 (b'HTTP/1.0 200 OK\r\nX: y\r\nConnection: close\r\n\r\n', False))
+
+	def test_03_downgrade(self):
+		"""Responses go to clients as HTTP/1.0 without hop-by-hop headers"""
+		head = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nConnection: X-Hop\r\n'
+		        b'X-Hop: 1\r\nX-Kept: 2\r\n\r\n')
+		self.assertEqual(downgrade(head, parse_head(head)[1]), b'HTTP/1.0 200 OK\r\nX-Kept: 2\r\n\r\n')
+
+	def test_04_bad_length(self):
+		"""A malformed Content-Length leaves the body running until the connection closes"""
+		for value in (b'-1', b'-3', b'+5', b'1_0', b'0x10', b'x', b'', b'12, 13'):
+			head = b'HTTP/1.1 200 OK\r\nContent-Length: ' + value + b'\r\n\r\n'
+			self.assertIsNone(self.length(head), value)
+
+class C_OriginRequestTest(unittest.TestCase):
+	def test_01_headers(self):
+		"""Hop-by-hop headers are dropped and ours replace the client's"""
+		fields = [('connection', b'Connection: close'), ('accept', b'Accept: */*'),
+		          ('if-none-match', b'If-None-Match: "old"')]
+		request = origin_request(b'example.com', b'/a', fields, b'If-None-Match: "new"\r\n')
+		self.assertTrue(request.startswith(b'GET /a HTTP/1.1\r\nHost: example.com\r\n'))
+		self.assertIn(b'Accept: */*\r\n', request)
+		self.assertIn(b'If-None-Match: "new"\r\n', request)
+		self.assertNotIn(b'old', request)
+		self.assertNotIn(b'Connection', request)
+		self.assertTrue(request.endswith(b'\r\n\r\n'))
+		self.assertNotIn(b'Content-Length', request)
+
+	def test_02_chunked_body(self):
+		"""A body that arrived chunked is sent on with a Content-Length"""
+		parser = RequestParser()
+		parser.feed(b'GET http://example.com/ HTTP/1.1\r\nTransfer-Encoding: chunked\r\n'
+		            b'Content-Length: 99\r\n\r\n5\r\nhello\r\n0\r\n\r\n')
+		client = parser.next()
+		request = origin_request(b'example.com', b'/', client.fields, body=client.body)
+		head, _, body = request.partition(b'\r\n\r\n')
+		components, headers = parse_head(head + b'\r\n\r\n')
+		self.assertNotIn('transfer-encoding', headers)
+		self.assertEqual(headers['content-length'], '5')
+		self.assertEqual(body, b'hello')
+
+if __name__ == '__main__':
+	unittest.main()
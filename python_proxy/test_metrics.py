@@ -0,0 +1,92 @@
+ # test_metrics.py - Tests for the latency histograms and the counters in metrics.py.
+ #
+ # Usage: python3 -m pytest test_metrics.py (or python3 test_metrics.py)
+
+#imports
+import os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import metrics
+from httputil import RequestParser
+
+class A_HistogramTest(unittest.TestCase):
+	def test_01_buckets(self):
+		"""Each value goes in the first bucket whose bound it doesn't exceed, or past the last"""
+		h = metrics.Histogram(bounds=(1, 2, 4))
+		for value in (0, 1, 1.5, 2, 4, 5, 100):
+			h.observe(value)
+		self.assertEqual(h.counts, [2, 2, 1, 2])
+		self.assertEqual((h.count, h.sum, h.max), (7, 113.5, 100))
+
+	def test_02_percentile(self):
+		"""Percentiles are the bound of the bucket they fall in, or the maximum past the last"""
+		h = metrics.Histogram(bounds=(1, 2, 4))
+		self.assertEqual(h.percentile(50), 0.0)
+		for value in [0.5] * 50 + [1.5] * 40 + [3] * 9 + [10]:
+			h.observe(value)
+		self.assertEqual([h.percentile(p) for p in (1, 50, 51, 90, 99, 100)], [1, 1, 2, 2, 4, 10])
+
+	def test_03_summary(self):
+		"""summary() gives the count, and the mean, percentiles and maximum in milliseconds"""
+		h = metrics.Histogram()
+		self.assertEqual(h.summary(), {'count': 0})
+		for value in (0.001, 0.003):
+			h.observe(value)
+		self.assertEqual(h.summary(), {'count': 2, 'mean': 2.0, 'p50': 1.6, 'p90': 3.2,
+		                               'p99': 3.2, 'max': 3.0})
+
+class B_RegistryTest(unittest.TestCase):
+	def request(self):
+		parser = RequestParser()
+		parser.feed(b'GET http://example.com/ HTTP/1.1\r\n\r\n')
+		return parser.next()
+
+	def test_01_finish(self):
+		"""finish() counts the request, its cache note and its phases"""
+		registry = metrics.Registry()
+		for cached in ('hit', 'hit', 'miss', None):
+			timing = metrics.Timing(accepted=0.0)
+			timing.start()
+			timing.parsed_now()
+			if cached is not None:
+				timing.notes['cache'] = cached
+			registry.finish(timing, self.request())
+		snapshot = registry.snapshot()
+		self.assertEqual(snapshot['counters'], {'requests': 4, 'cache_hit': 2, 'cache_miss': 1})
+		for phase in ('accept', 'parse', 'last_byte', 'total'):
+			self.assertEqual(snapshot['latency_ms'][phase]['count'], 4)
+		self.assertEqual(snapshot['latency_ms']['dns'], {'count': 0})
+
+	def test_02_context(self):
+		"""note(), mark() and phase() apply to the current request, and do nothing without one"""
+		metrics.note(cache='hit')
+		metrics.mark('first_byte')
+		with metrics.phase('dns'):
+			pass
+		timing = metrics.Timing()
+		timing.parsed_now()
+		token = metrics.current.set(timing)
+		try:
+			metrics.note(cache='hit')
+			metrics.mark('first_byte')
+			with metrics.phase('dns'):
+				pass
+			with metrics.phase('dns'):
+				pass
+		finally:
+			metrics.current.reset(token)
+		self.assertEqual(timing.notes, {'cache': 'hit'})
+		self.assertEqual(sorted(timing.phases), ['dns', 'first_byte'])
+
+	def test_03_count(self):
+		"""Counters add up"""
+		registry = metrics.Registry()
+		registry.count('tunnels')
+		registry.count('bytes', 10)
+		registry.count('bytes', 5)
+		self.assertEqual(registry.snapshot()['counters'], {'tunnels': 1, 'bytes': 15})
+
+if __name__ == '__main__':
+	unittest.main()
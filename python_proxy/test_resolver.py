@@ -0,0 +1,119 @@
+ # test_resolver.py - Tests for the address cache and the connection helpers in resolver.py.
+ #
+ # Usage: python3 -m pytest test_resolver.py (or python3 test_resolver.py)
+
+#imports
+import os.path
+import socket
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import resolver
+
+V4 = (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 80))
+V6 = (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', 80, 0, 0))
+
+class Clock:
+	# Stands in for the time module, so entries can be aged rather than waited for
+	def __init__(self):
+		self.now = 1000.0
+
+	def monotonic(self):
+		return self.now
+
+class A_ResolverTest(unittest.TestCase):
+	def setUp(self):
+		self.clock = Clock()
+		self.lookups = []
+		self.answers = {'a': [V4], 'b': [V6]}
+		for patcher in (mock.patch.object(resolver, 'time', self.clock),
+		                mock.patch.object(resolver.socket, 'getaddrinfo', self.getaddrinfo)):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def getaddrinfo(self, host, port, **kwds):
+		# Stands in for socket.getaddrinfo(), answering from self.answers
+		self.lookups.append(host)
+		if host not in self.answers:
+			raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+		return self.answers[host]
+
+	def test_01_positive_ttl(self):
+		"""Addresses are looked up once, and again after ttl seconds"""
+		hosts = resolver.Resolver(ttl=60)
+		self.assertEqual(hosts.resolve('a', 80), [V4])
+		self.clock.now += 59
+		self.assertEqual(hosts.resolve('a', 80), [V4])
+		self.assertEqual(self.lookups, ['a'])
+		self.clock.now += 1
+		hosts.resolve('a', 80)
+		self.assertEqual(self.lookups, ['a', 'a'])
+		self.assertEqual(hosts.stats(), {'entries': 1, 'hits': 1, 'misses': 2})
+
+	def test_02_negative_ttl(self):
+		"""A failed lookup fails again without a lookup until negative_ttl seconds have passed"""
+		hosts = resolver.Resolver(negative_ttl=10)
+		for _ in range(3):
+			with self.assertRaises(socket.gaierror) as caught:
+				hosts.resolve('nowhere', 80)
+			self.assertEqual(caught.exception.errno, socket.EAI_NONAME)
+		self.assertEqual(self.lookups, ['nowhere'])
+		self.clock.now += 10
+		self.answers['nowhere'] = [V4]
+		self.assertEqual(hosts.resolve('nowhere', 80), [V4])
+
+	def test_03_fresh_errors(self):
+		"""Each cached failure raises a new exception, so tracebacks don't pile up"""
+		hosts = resolver.Resolver()
+		errors = []
+		for _ in range(3):
+			try:
+				hosts.resolve('nowhere', 80)
+			except socket.gaierror as err:
+				errors.append(err)
+		self.assertEqual(len(set(map(id, errors))), 3)
+		stored = hosts.entries[('nowhere', 80)][1]
+		self.assertNotIn(stored, errors)
+		self.assertIsNone(stored.__traceback__)
+
+	def test_04_lru(self):
+		"""Once max_entries are cached, the least recently used goes first"""
+		self.answers['c'] = [V4]
+		hosts = resolver.Resolver(max_entries=2)
+		hosts.resolve('a', 80)
+		hosts.resolve('b', 80)
+		hosts.resolve('a', 80)                   # now b is the least recently used
+		hosts.resolve('c', 80)
+		self.assertEqual(list(hosts.entries), [('a', 80), ('c', 80)])
+		hosts.resolve('b', 80)
+		self.assertEqual(self.lookups, ['a', 'b', 'c', 'b'])
+
+	def test_05_forget(self):
+		"""Addresses that can't be connected to are forgotten, so the next attempt looks them up"""
+		listener = socket.socket()
+		listener.bind(('127.0.0.1', 0))
+		port = listener.getsockname()[1]
+		listener.close()                         # nothing listens on port now
+		self.answers['gone'] = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+		with mock.patch.object(resolver, 'hosts', resolver.Resolver()):
+			with self.assertRaises(OSError):
+				resolver.create_connection('gone', port)
+			self.assertNotIn(('gone', port), resolver.hosts.entries)
+			with self.assertRaises(OSError):
+				resolver.create_connection('gone', port)
+		self.assertEqual(self.lookups, ['gone', 'gone'])
+
+class B_InterleaveTest(unittest.TestCase):
+	def test_01_interleave(self):
+		"""Address families alternate, starting with the first one returned"""
+		a6, b6, c6 = [(socket.AF_INET6, 0, 0, '', (n, 80, 0, 0)) for n in ('a6', 'b6', 'c6')]
+		a4, b4 = [(socket.AF_INET, 0, 0, '', (n, 80)) for n in ('a4', 'b4')]
+		self.assertEqual(resolver.interleave([a6, b6, c6, a4, b4]), [a6, a4, b6, b4, c6])
+		self.assertEqual(resolver.interleave([a4, a6, b6]), [a4, a6, b6])
+		self.assertEqual(resolver.interleave([a4, b4]), [a4, b4])
+		self.assertEqual(resolver.interleave([]), [])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,130 @@
+ # test_upstream.py - Tests for the pool of connections to end servers in upstream.py.
+ #
+ # Usage: python3 -m pytest test_upstream.py (or python3 test_upstream.py)
+
+#imports
+import os.path
+import socket
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import upstream
+
+class Clock:
+	# Stands in for the time module, so idle times can be set rather than waited for
+	def __init__(self):
+		self.now = 1000.0
+
+	def monotonic(self):
+		return self.now
+
+class Conn:
+	def __init__(self):
+		self.closed = False
+
+	def close(self):
+		self.closed = True
+
+class A_PoolTest(unittest.TestCase):
+	def setUp(self):
+		self.clock = Clock()
+		patcher = mock.patch.object(upstream, 'time', self.clock)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_01_take(self):
+		"""The most recently returned connection is taken first, and only for its own key"""
+		pool = upstream.Pool()
+		a, b = Conn(), Conn()
+		pool.give(('a', 80), a)
+		pool.give(('a', 80), b)
+		self.assertIsNone(pool.take(('b', 80)))
+		self.assertIs(pool.take(('a', 80)), b)
+		self.assertIs(pool.take(('a', 80)), a)
+		self.assertIsNone(pool.take(('a', 80)))
+		self.assertEqual(pool.idle, {})
+
+	def test_02_idle_timeout(self):
+		"""Connections idle for longer than idle_timeout are closed rather than taken"""
+		pool = upstream.Pool(idle_timeout=30)
+		old, new = Conn(), Conn()
+		pool.give(('a', 80), old)
+		self.clock.now += 20
+		pool.give(('a', 80), new)
+		self.clock.now += 15
+		self.assertIs(pool.take(('a', 80)), new)
+		self.assertTrue(old.closed)
+		self.assertFalse(new.closed)
+
+	def test_03_sweep(self):
+		"""Giving a connection back now and then closes stale ones under other keys"""
+		pool = upstream.Pool(idle_timeout=30)
+		stale = Conn()
+		pool.give(('a', 80), stale)
+		self.clock.now += 31
+		pool.give(('b', 80), Conn())
+		self.assertTrue(stale.closed)
+		self.assertNotIn(('a', 80), pool.idle)
+
+	def test_04_max_idle(self):
+		"""No more than max_idle connections are kept per key; the rest are closed"""
+		pool = upstream.Pool(max_idle=2)
+		conns = [Conn() for _ in range(3)]
+		for conn in conns:
+			pool.give(('a', 80), conn)
+		self.assertEqual([c.closed for c in conns], [False, False, True])
+		pool.give(('b', 80), Conn())
+		self.assertEqual(len(pool.idle[('b', 80)]), 1)
+		pool.clear()
+		self.assertTrue(all(c.closed for c in conns))
+		self.assertEqual(pool.idle, {})
+
+class B_RequestTest(unittest.TestCase):
+	def setUp(self):
+		self.server = socket.socket()
+		self.server.bind(('127.0.0.1', 0))
+		self.server.listen()
+		self.addCleanup(self.server.close)
+		self.port = self.server.getsockname()[1]
+		patcher = mock.patch.object(upstream, 'pool', upstream.Pool())
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def serve(self, body):
+		# Accept one connection and answer one request on it, then close it
+		# without saying so, as an end server timing out an idle connection does
+		def run():
+			conn, _ = self.server.accept()
+			with conn:
+				conn.recv(4096)
+				conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n' + body)
+		thread = threading.Thread(target=run, daemon=True)
+		thread.start()
+		return thread
+
+	def get(self):
+		conn, head = upstream.request(b'127.0.0.1', self.port, b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+		return conn, head, b''.join(conn.body(2))
+
+	def test_01_stale(self):
+		"""A pooled connection the server has closed is replaced and the request sent again"""
+		thread = self.serve(b'1.')
+		first, head, body = self.get()
+		self.assertEqual((head, body), (b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n', b'1.'))
+		upstream.release(first, True)
+		thread.join(5)
+		thread = self.serve(b'2.')
+		second, head, body = self.get()
+		self.assertIsNot(second, first)
+		self.assertFalse(second.reused)
+		self.assertEqual(body, b'2.')
+		self.assertEqual(first.sock.fileno(), -1)         # taken from the pool, found dead and closed
+		self.assertIsNone(upstream.pool.take(first.key))
+		second.close()
+		thread.join(5)
+
+if __name__ == '__main__':
+	unittest.main()
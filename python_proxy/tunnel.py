@@ -0,0 +1,127 @@
+ # tunnel.py - Relaying the bytes of a CONNECT tunnel (typically HTTPS) between the client and the
+ # end server.  Where the OS has splice() the bytes are moved through a pipe inside the kernel and
+ # never copied into Python.
+
+#imports
+import os
+import selectors
+import socket
+
+# Most bytes moved in one go, in each direction
+TUNNEL_BUFSIZ = 64 * 1024
+
+# A tunnel with no traffic in either direction for this long is closed
+TUNNEL_IDLE_TIMEOUT = 300
+
+SPLICE = hasattr(os, 'splice')
+
+class Direction:
+	"""One direction of a tunnel: bytes read from src and written to dst.
+
+	Bytes that have been read but not yet written wait in a pipe (with splice())
+	or a buffer, and no more are read until they have all been written.
+	"""
+
+	def __init__(self, src, dst, initial=b''):
+		self.src = src
+		self.dst = dst
+		self.eof = False                 # src has no more to send
+		self.done = False                # ... and dst has been told so
+		if SPLICE:
+			self.rpipe, self.wpipe = os.pipe()
+			os.write(self.wpipe, initial)
+		else:
+			self.buf = bytearray(max(TUNNEL_BUFSIZ, len(initial)))
+			self.buf[:len(initial)] = initial
+			self.start = 0
+		self.pending = len(initial)
+
+	def fill(self):
+		"""Read whatever src has available."""
+		try:
+			if SPLICE:
+				n = os.splice(self.src.fileno(), self.wpipe, TUNNEL_BUFSIZ,
+				              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+			else:
+				n = self.src.recv_into(self.buf)
+				self.start = 0
+		except BlockingIOError:
+			return
+		if n == 0:
+			self.eof = True
+		self.pending = n
+
+	def flush(self):
+		"""Write as much of the pending bytes to dst as it will take."""
+		try:
+			if SPLICE:
+				n = os.splice(self.rpipe, self.dst.fileno(), self.pending,
+				              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+			else:
+				n = self.dst.send(memoryview(self.buf)[self.start:self.start + self.pending])
+				self.start += n
+		except BlockingIOError:
+			return
+		self.pending -= n
+
+	def finish(self):
+		"""Pass on the end of the stream once everything before it is written."""
+		if self.eof and not self.pending and not self.done:
+			self.done = True
+			try:
+				self.dst.shutdown(socket.SHUT_WR)
+			except OSError:
+				pass
+
+	def close(self):
+		if SPLICE:
+			os.close(self.rpipe)
+			os.close(self.wpipe)
+
+def relay(client, server, initial=b''):
+	"""Relay bytes both ways between the client and end server sockets until
+	both have closed their side, either fails, or the tunnel sits idle for
+	TUNNEL_IDLE_TIMEOUT.  initial holds bytes the client sent that were already
+	read from its socket."""
+	client.setblocking(False)
+	server.setblocking(False)
+	directions = [Direction(client, server, initial), Direction(server, client)]
+	sel = selectors.DefaultSelector()
+	registered = {}
+	try:
+		while not all(d.done for d in directions):
+			# Read from a side when its bytes have all been written to the other,
+			# and write to a side while there are bytes waiting for it
+			interest = {client: 0, server: 0}
+			for d in directions:
+				if d.pending:
+					interest[d.dst] |= selectors.EVENT_WRITE
+				elif not d.eof:
+					interest[d.src] |= selectors.EVENT_READ
+			for sock, events in interest.items():
+				old = registered.get(sock, 0)
+				if events == old:
+					continue
+				if not events:
+					sel.unregister(sock)
+				elif old:
+					sel.modify(sock, events)
+				else:
+					sel.register(sock, events)
+				registered[sock] = events
+
+			ready = {key.fileobj: events for key, events in sel.select(TUNNEL_IDLE_TIMEOUT)}
+			if not ready:
+				return                           # idle too long
+			for d in directions:
+				if d.pending and ready.get(d.dst, 0) & selectors.EVENT_WRITE:
+					d.flush()
+				elif not d.pending and ready.get(d.src, 0) & selectors.EVENT_READ:
+					d.fill()
+				d.finish()
+	except ConnectionError:
+		pass                                     # one side reset the connection; tear down
+	finally:
+		sel.close()
+		for d in directions:
+			d.close()
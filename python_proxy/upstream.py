@@ -0,0 +1,168 @@
+ # upstream.py - Persistent HTTP/1.1 connections to end servers, kept in a pool per (host, port)
+ # so repeated requests to the same site skip the TCP handshake and slow start.
+
+#imports
+import threading
+import time
+
+import metrics
+import resolver
+from httputil import CHUNKED, MAX_HEADER, read_head, chunk_size
+
+# How long an idle connection is kept, and how many are kept per (host, port)
+IDLE_TIMEOUT = 30
+MAX_IDLE = 8
+
+# Size of the body pieces we hand on
+READSIZ = 4096
+
+class Pool:
+	"""Idle connections to end servers, keyed by (host, port).
+
+	Connections are anything with a close() method; the pool records when each
+	was put back and closes those that have been idle for longer than
+	idle_timeout, or that don't fit in max_idle per key.
+	"""
+
+	def __init__(self, max_idle=MAX_IDLE, idle_timeout=IDLE_TIMEOUT):
+		self.max_idle = max_idle
+		self.idle_timeout = idle_timeout
+		self.idle = {}                   # (host, port) -> [(idle since, connection)], oldest first
+		self.lock = threading.Lock()
+		self.last_sweep = time.monotonic()
+
+	def take(self, key):
+		"""Return an idle connection for key, or None if there isn't one."""
+		now = time.monotonic()
+		with self.lock:
+			conns = self.idle.get(key, [])
+			stale = self.expire(conns, now)
+			conn = conns.pop()[1] if conns else None
+			if not conns:
+				self.idle.pop(key, None)
+		for old in stale:
+			old.close()
+		return conn
+
+	def give(self, key, conn):
+		"""Put a connection that has finished a response back in the pool."""
+		now = time.monotonic()
+		stale = []
+		with self.lock:
+			conns = self.idle.setdefault(key, [])
+			if len(conns) < self.max_idle:
+				conns.append((now, conn))
+			else:
+				stale.append(conn)
+			if now - self.last_sweep > self.idle_timeout:
+				self.last_sweep = now
+				for k in list(self.idle):
+					stale.extend(self.expire(self.idle[k], now))
+					if not self.idle[k]:
+						del self.idle[k]
+		for old in stale:
+			old.close()
+
+	def expire(self, conns, now):
+		# Caller holds self.lock.  Removes and returns the connections in conns
+		# that have been idle too long.
+		n = 0
+		while n < len(conns) and now - conns[n][0] > self.idle_timeout:
+			n += 1
+		stale = [conn for _, conn in conns[:n]]
+		del conns[:n]
+		return stale
+
+	def clear(self):
+		"""Close every idle connection."""
+		with self.lock:
+			idle, self.idle = self.idle, {}
+		for conns in idle.values():
+			for _, conn in conns:
+				conn.close()
+
+class Connection:
+	"""A connection to an end server, with a buffered reader for its responses."""
+
+	def __init__(self, host, port):
+		self.key = (host, port)
+		self.sock = resolver.create_connection(host.decode(), port)
+		self.rfile = self.sock.makefile('rb')
+		self.reused = False
+
+	def read_head(self):
+		"""Read a response's header block, or return None if the connection
+		closed before one arrived."""
+		return read_head(self.rfile)
+
+	def body(self, length):
+		"""Yield a response body in pieces of up to READSIZ bytes, undoing any
+		chunked coding.  length is as returned by httputil.response_length()."""
+		if length == CHUNKED:
+			while True:
+				size = chunk_size(self.rfile.readline(MAX_HEADER))
+				if size == 0:
+					while self.rfile.readline(MAX_HEADER) not in (b'\r\n', b'\n', b''):
+						pass                     # skip any trailer fields
+					return
+				yield from self.body(size)
+				self.rfile.readline(MAX_HEADER)    # CRLF after the chunk data
+		elif length is None:
+			while True:
+				data = self.rfile.read1(READSIZ)
+				if not data:
+					return
+				yield data
+		else:
+			while length > 0:
+				data = self.rfile.read1(min(length, READSIZ))
+				if not data:
+					raise ConnectionError("end server closed the connection mid-response")
+				length -= len(data)
+				yield data
+
+	def close(self):
+		self.rfile.close()
+		self.sock.close()
+
+def request(host, port, data):
+	"""Send a request to an end server, reusing a pooled connection if there is
+	one.  Returns the connection and the header block of its response.
+
+	A pooled connection the server has since closed is replaced by a new one;
+	only GETs are sent, so repeating the request is safe.
+	"""
+	while True:
+		conn = pool.take((host, port))
+		if conn is None:
+			conn = Connection(host, port)
+		else:
+			conn.reused = True
+		try:
+			conn.sock.sendall(data)
+			head = conn.read_head()
+		except ConnectionError:
+			conn.close()
+			if not conn.reused:
+				raise
+			continue
+		except BaseException:
+			conn.close()
+			raise
+		if head is not None:
+			metrics.mark('first_byte')
+			return conn, head
+		conn.close()
+		if not conn.reused:
+			raise ConnectionError("end server closed the connection without responding")
+
+def release(conn, reusable):
+	"""Return a connection whose response has been read in full to the pool, or
+	close it if it can't carry another request."""
+	if reusable:
+		pool.give(conn.key, conn)
+	else:
+		conn.close()
+
+# Idle connections shared by every thread
+pool = Pool()
@@ -0,0 +1,121 @@
+# !/usr/bin/env python3
+# Project 2 - RDT
+#
+# Purpose: Congestion control algorithms for the RDT protocol. An RDT socket keeps
+# one of these objects per connection and asks it how many segments it may have in
+# flight (cwnd). The socket reports ACKs for new data, losses detected by duplicate
+# ACKs (fast retransmit), and retransmission timeouts; the algorithm adjusts cwnd and
+# ssthresh in response. All windows are counted in segments.
+#
+# To add an algorithm, subclass CongestionControl and override onAck (and onLoss if
+# the reduction differs from Reno's), then set RDTProtocol.CONGESTION or call
+# RDTSocket.setCongestionControl().
+
+from network import now
+
+
+# Base class, which also implements the parts every algorithm here has in common:
+# slow start, and the response to a retransmission timeout.
+class CongestionControl:
+    # Segments a connection may send before its first ACK (RFC 6928)
+    INITIAL_CWND = 10
+
+    # Never shrink the window below this many segments after a loss
+    MIN_SSTHRESH = 2
+
+    def __init__(self):
+        self.cwnd = self.INITIAL_CWND
+        self.ssthresh = float('inf')
+
+    # Called when an ACK acknowledges new data. acked is the number of segments it
+    # acknowledged and srtt the sender's smoothed RTT in seconds (None if unknown).
+    def onAck(self, acked, srtt):
+        if self.cwnd < self.ssthresh:
+            self.slowStart(acked)
+
+    # Called when duplicate ACKs show a segment was lost (at most once per window of
+    # data). inFlight is the number of unacknowledged segments.
+    def onLoss(self, inFlight):
+        self.ssthresh = max(inFlight / 2, self.MIN_SSTHRESH)
+        self.cwnd = self.ssthresh
+
+    # Called when a retransmission timer expires: fall back to slow start
+    def onTimeout(self, inFlight):
+        self.ssthresh = max(inFlight / 2, self.MIN_SSTHRESH)
+        self.cwnd = 1
+
+    # Grows cwnd by one segment per segment ACKed, but no further than ssthresh.
+    # Returns the number of ACKed segments left over for congestion avoidance.
+    def slowStart(self, acked):
+        grow = min(acked, self.ssthresh - self.cwnd)
+        self.cwnd += grow
+        return acked - grow
+
+
+# Classic Reno: additive increase of one segment per RTT, multiplicative decrease by
+# half on loss.
+class Reno(CongestionControl):
+    def onAck(self, acked, srtt):
+        if self.cwnd < self.ssthresh:
+            acked = self.slowStart(acked)
+        if acked > 0:
+            self.cwnd += acked / self.cwnd
+
+
+# CUBIC (RFC 8312). After a loss the window grows along a cubic curve centred on the
+# window size where the loss happened, so it recovers quickly, then probes carefully
+# around the old maximum. Where Reno would be faster (short RTTs, small windows) it
+# follows Reno's growth instead.
+class Cubic(CongestionControl):
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self):
+        super().__init__()
+        self.wMax = 0           # window size just before the last reduction
+        self.epochStart = None  # time the current congestion avoidance epoch began
+        self.k = 0              # seconds until the curve reaches wMax again
+        self.wEst = 0           # window Reno would have in the same time
+
+    def onAck(self, acked, srtt):
+        if self.cwnd < self.ssthresh:
+            acked = self.slowStart(acked)
+            if acked <= 0:
+                return
+
+        t = now()
+        if self.epochStart is None:
+            self.epochStart = t
+            if self.cwnd < self.wMax:
+                self.k = ((self.wMax - self.cwnd) / self.C) ** (1 / 3)
+            else:
+                self.k = 0
+                self.wMax = self.cwnd
+            self.wEst = self.cwnd
+
+        t -= self.epochStart
+        target = self.C * (t - self.k) ** 3 + self.wMax
+
+        # The TCP-friendly estimate grows like Reno with the same average window
+        self.wEst += 3 * (1 - self.BETA) / (1 + self.BETA) * acked / self.cwnd
+        if target < self.wEst:
+            target = self.wEst
+
+        if target > self.cwnd:
+            self.cwnd += min((target - self.cwnd) * acked / self.cwnd, target - self.cwnd)
+        else:
+            self.cwnd += acked / (100 * self.cwnd)
+
+    def onLoss(self, inFlight):
+        self.reduce()
+        self.cwnd = self.ssthresh
+
+    def onTimeout(self, inFlight):
+        self.reduce()
+        self.cwnd = 1
+
+    # Multiplicative decrease by BETA, remembering where the loss happened
+    def reduce(self):
+        self.epochStart = None
+        self.wMax = self.cwnd
+        self.ssthresh = max(self.cwnd * self.BETA, self.MIN_SSTHRESH)
@@ -1,14 +1,191 @@
 #!/usr/bin/env python3
 import sys
 import os
+import heapq
+import itertools
+import math
+import multiprocessing
+import pickle
 import random
 import threading
-from queue import Queue
+import time
+import traceback
+from collections import deque
+from queue import Queue, Empty, Full
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def _trialgen(prob):
-    while True:
-        yield random.random() < prob
+
+class _Batched:
+    """
+    Endless random values which are drawn a batch at a time, with NumPy where
+    it's installed; iterate over one to get them.  A run is reproducible given
+    the seed (and whether NumPy is installed); without one, the seed is drawn
+    from the random module, so that seeding that (as Simulator does) seeds
+    this too.
+    """
+
+    def __init__(self, seed=None, batch=4096):
+        if seed is None:
+            seed = random.getrandbits(64)
+        if numpy is not None:
+            self.rng = numpy.random.default_rng(seed)
+        else:
+            self.rng = random.Random(seed)
+        self.batch = batch
+
+    def __iter__(self):
+        # A generator, as resuming one is cheaper than calling __next__
+        while True:
+            yield from self.draw(self.batch)
+
+    def draw(self, n):
+        """Returns a list of the next n values"""
+        raise NotImplementedError
+
+    def uniform(self, n):
+        """n floats in [0, 1), as an array if NumPy is installed"""
+        if numpy is not None:
+            return self.rng.random(n)
+        rand = self.rng.random
+        return [rand() for i in range(n)]
+
+    def geometric(self, prob):
+        """The number of trials up to and including the first success"""
+        if prob >= 1:
+            return 1
+        if prob <= 0:
+            return math.inf
+        if numpy is not None:
+            return int(self.rng.geometric(prob))
+        return 1 + int(math.log(1.0 - self.rng.random()) / math.log(1.0 - prob))
+
+
+class Bernoulli(_Batched):
+    """Independent trials which each succeed with probability prob"""
+
+    def __init__(self, prob, seed=None, batch=4096):
+        super().__init__(seed, batch)
+        self.prob = prob
+
+    def __iter__(self):
+        if numpy is not None:
+            return super().__iter__()
+        # Without NumPy, batches would only add the cost of building them
+        return self.trials(self.prob, self.rng.random)
+
+    @staticmethod
+    def trials(prob, rand):
+        while True:
+            yield rand() < prob
+
+    def draw(self, n):
+        return (self.uniform(n) < self.prob).tolist()
+
+
+class GilbertElliott(_Batched):
+    """
+    Burst loss: a two-state Markov chain which moves from the good state to
+    the bad one with probability p after each packet, and back again with
+    probability r, and loses packets with probability loss_good or loss_bad
+    depending on its state.  With the defaults bursts average 1/r packets, and
+    the long-run loss rate is p / (p + r).
+    """
+
+    def __init__(self, p, r, loss_good=0.0, loss_bad=1.0, seed=None, batch=4096):
+        super().__init__(seed, batch)
+        self.p = p
+        self.r = r
+        self.loss_good = loss_good
+        self.loss_bad = loss_bad
+        self.bad = True  # so that the first run is a good one
+        self.left = 0  # packets left in the current run of one state
+
+    def draw(self, n):
+        # A run of one state lasts a geometrically distributed number of
+        # packets, so the chain is drawn a run at a time, not a packet at a time
+        states = []
+        while len(states) < n:
+            if not self.left:
+                self.bad = not self.bad
+                self.left = self.geometric(self.r if self.bad else self.p)
+            k = min(self.left, n - len(states))
+            states.extend([self.bad] * k)
+            self.left -= k
+        if numpy is not None:
+            probs = numpy.where(states, self.loss_bad, self.loss_good)
+            return (self.uniform(n) < probs).tolist()
+        good, bad = self.loss_good, self.loss_bad
+        return [u < (bad if s else good) for u, s in zip(self.uniform(n), states)]
+
+
+class PacketErrors:
+    """
+    Corrupts a packet with probability per (or when the iterable per yields
+    True) by changing one byte to a random value
+    """
+
+    def __init__(self, per, seed=None):
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.rng = random.Random(seed)
+        if isinstance(per, (int, float)):
+            per = Bernoulli(per, self.rng.getrandbits(64))
+        self.trials = iter(per)
+
+    def corrupt(self, data):
+        """
+        Returns data, or a corrupted copy of it: a bytearray, changed in place
+        after the one copy, which receivers read like bytes
+        """
+        if not next(self.trials) or not data:
+            return data
+        buf = bytearray(data)
+        buf[self.rng.randrange(len(buf))] = self.rng.randrange(256)
+        return buf
+
+
+class BitErrors(_Batched):
+    """
+    Flips each bit independently with probability ber, so longer packets are
+    more likely to be corrupted, and may have several bits flipped.  Only the
+    gaps between errors are drawn, so the cost is in the errors, not the bits.
+    """
+
+    def __init__(self, ber, seed=None, batch=4096):
+        super().__init__(seed, batch)
+        self.ber = ber
+        self.gaps = iter(self)
+        self.next_error = None  # bits from the start of the next packet
+
+    def draw(self, n):
+        if self.ber <= 0:
+            return [math.inf] * n
+        if numpy is not None:
+            return self.rng.geometric(self.ber, n).tolist()
+        return [self.geometric(self.ber) for i in range(n)]
+
+    def corrupt(self, data):
+        """
+        Returns data, or a corrupted copy of it: a bytearray, changed in place
+        after the one copy, which receivers read like bytes
+        """
+        if self.next_error is None:
+            self.next_error = next(self.gaps) - 1
+        nbits = len(data) * 8
+        if self.next_error >= nbits:
+            self.next_error -= nbits
+            return data
+        buf = bytearray(data)
+        while self.next_error < nbits:
+            pos = self.next_error
+            buf[pos >> 3] ^= 1 << (pos & 7)
+            self.next_error += next(self.gaps)
+        self.next_error -= nbits
+        return buf
 
 
 def _hexdump(data):
@@ -22,18 +199,424 @@ def _hexdump(data):
     print('%08x' % (len(data),), file=sys.stderr)
 
 
+class Simulator:
+    """
+    Discrete-event simulation in virtual time
+
+    Application code runs in processes started with spawn(), and run() gives
+    them turns one at a time: a process runs until it blocks in a socket call
+    (or sleep()), and the clock only moves on, straight to the next event, once
+    every process is blocked.  Events are packet deliveries, which Network.tx
+    schedules instead of delivering on the sender's stack, and protocol timers.
+    Time spent waiting therefore costs no real time, and as only one thread
+    runs at once, a run is reproducible given the seed.
+
+    Code running in a process, or in an event, uses the simulator's clock and
+    waits through now(), wait_for() and queue_get() below; anywhere else they
+    are wall-clock time and ordinary thread waits.
+    """
+
+    def __init__(self, seed=None):
+        """
+        Creates a simulator with its clock at 0.  If a seed is given, the random
+        module is seeded with it; Networks created after that draw their loss
+        and corruption models' seeds, and Links their delays, from it.
+        """
+        if seed is not None:
+            random.seed(seed)
+        self.now = 0.0
+        self.heap = []  # [time, tiebreaker, callback, args]
+        self.counter = itertools.count()
+        self.procs = []  # processes which haven't finished, in the order they were spawned
+        self.running = None
+        self.switched = threading.Event()  # set when the running process blocks or ends
+
+    def schedule(self, delay, callback, *args):
+        """
+        Calls callback(*args) after delay seconds of virtual time.  Returns a
+        handle which can be passed to cancel().  Events due at the same time
+        run in the order they were scheduled.
+        """
+        timer = [self.now + delay, next(self.counter), callback, args]
+        heapq.heappush(self.heap, timer)
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def spawn(self, target, *args):
+        """Starts a process which will call target(*args) once run() begins"""
+        proc = _Process(self, target, args)
+        self.procs.append(proc)
+        proc.thread.start()
+        return proc
+
+    def run(self, until=None):
+        """
+        Runs processes and events until every process has finished or is
+        blocked with nothing left that could wake it, or until the clock would
+        pass until.  Returns the time on the clock.  An exception raised in a
+        process is raised again here.
+        """
+        _simulators[threading.get_ident()] = (self, None)
+        try:
+            while True:
+                proc = self.ready()
+                if proc is not None:
+                    self.switch(proc)
+                    continue
+                if not self.heap:
+                    break
+                if until is not None and self.heap[0][0] > until:
+                    self.now = until
+                    break
+                timer = heapq.heappop(self.heap)
+                if timer[2] is not None:
+                    self.now = max(self.now, timer[0])
+                    timer[2](*timer[3])
+        finally:
+            del _simulators[threading.get_ident()]
+        return self.now
+
+    def ready(self):
+        """The first process which can run now, if any"""
+        for proc in self.procs:
+            if (proc.predicate is None or
+                    (proc.deadline is not None and proc.deadline <= self.now) or
+                    proc.predicate()):
+                return proc
+        return None
+
+    def switch(self, proc):
+        # Let proc run until it blocks again or ends
+        self.running = proc
+        proc.resume.set()
+        self.switched.wait()
+        self.switched.clear()
+        self.running = None
+        if proc.done:
+            self.procs.remove(proc)
+            if proc.error is not None:
+                raise proc.error
+
+    def wait_for(self, cond, predicate, timeout=None):
+        """
+        Blocks the running process until predicate() is true or timeout seconds
+        of virtual time have passed, releasing cond (if not None) meanwhile.
+        Returns the last value of predicate(), as Condition.wait_for does.
+        """
+        result = predicate()
+        if result:
+            return result
+        proc = self.running
+        proc.predicate = predicate
+        timer = None
+        if timeout is not None:
+            proc.deadline = self.now + timeout
+            timer = self.schedule(timeout, _noop)  # makes sure the clock gets there
+        if cond is not None:
+            cond.release()
+        try:
+            self.switched.set()
+            proc.resume.wait()
+            proc.resume.clear()
+        finally:
+            if cond is not None:
+                cond.acquire()
+            if timer is not None:
+                self.cancel(timer)
+            proc.predicate = proc.deadline = None
+        return predicate()
+
+    def sleep(self, delay):
+        """Blocks the running process for delay seconds of virtual time"""
+        self.wait_for(None, lambda: False, delay)
+
+
+class _Process:
+    """A thread whose code runs only when its Simulator gives it a turn"""
+
+    def __init__(self, sim, target, args):
+        self.sim = sim
+        self.target = target
+        self.args = args
+        self.predicate = None  # while blocked, what it's waiting for
+        self.deadline = None
+        self.done = False
+        self.error = None
+        self.resume = threading.Event()
+        self.thread = threading.Thread(target=self.main, daemon=True)
+
+    def main(self):
+        _simulators[threading.get_ident()] = (self.sim, self)
+        self.resume.wait()
+        self.resume.clear()
+        try:
+            self.target(*self.args)
+        except BaseException as ex:
+            self.error = ex
+        finally:
+            del _simulators[threading.get_ident()]
+            self.done = True
+            self.sim.switched.set()
+
+
+def _noop():
+    pass
+
+
+# Thread ident -> (Simulator, process or None) for the threads a simulator runs
+# code on: its processes, and the thread in run() which handles events
+_simulators = {}
+
+
+def simulator():
+    """The Simulator running the calling code, or None outside a simulation"""
+    return _simulators.get(threading.get_ident(), (None, None))[0]
+
+
+def now():
+    """Seconds on the clock: virtual time in a simulation, otherwise time.time()"""
+    sim = simulator()
+    return time.time() if sim is None else sim.now
+
+
+def wait_for(cond, predicate, timeout=None):
+    """
+    cond.wait_for(predicate, timeout), with cond held by the caller; in a
+    simulation process the wait is in virtual time instead.
+    """
+    sim, proc = _simulators.get(threading.get_ident(), (None, None))
+    if proc is None:
+        return cond.wait_for(predicate, timeout)
+    return sim.wait_for(cond, predicate, timeout)
+
+
+def queue_get(q):
+    """q.get(), waiting in virtual time in a simulation process"""
+    sim, proc = _simulators.get(threading.get_ident(), (None, None))
+    if proc is not None:
+        sim.wait_for(None, lambda: q.qsize())
+        return q.get_nowait()
+    return q.get()
+
+
+class TimerService:
+    """
+    A heap of pending timers served by a single thread.  Callbacks are
+    scheduled for a delay from now, and the thread sleeps on a condition
+    variable until the earliest deadline (or until an earlier timer is added),
+    so idle timers use no CPU no matter how many of them there are.  Protocols
+    use one for retransmission timeouts, and Network one for delayed deliveries.
+
+    Timers scheduled from code run by a Simulator go on the simulator's event
+    queue instead, and expire in virtual time.
+    """
+
+    def __init__(self):
+        self.heap = []  # [deadline, tiebreaker, callback, args]
+        self.cond = threading.Condition()
+        self.counter = itertools.count()
+        self.thread = None
+
+    def schedule(self, delay, callback, *args):
+        """
+        Calls callback(*args) on the timer thread after delay seconds.  Returns
+        a handle which can be passed to cancel().
+        """
+        sim = simulator()
+        if sim is not None:
+            return sim.schedule(delay, callback, *args)
+        timer = [time.time() + delay, next(self.counter), callback, args]
+        with self.cond:
+            heapq.heappush(self.heap, timer)
+            if self.thread is None:  # started lazily so unused services cost nothing
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            elif self.heap[0] is timer:
+                self.cond.notify()
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancelled timers stay in the heap and are thrown away when they reach
+        the top.  This works the same for timers on a simulator's queue.
+        """
+        timer[2] = None
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.heap:
+                        self.cond.wait()
+                    elif self.heap[0][2] is None:
+                        heapq.heappop(self.heap)
+                    else:
+                        delay = self.heap[0][0] - time.time()
+                        if delay <= 0:
+                            timer = heapq.heappop(self.heap)
+                            break
+                        self.cond.wait(delay)
+
+            # Run the callback without the lock held so it can schedule more timers
+            callback, args = timer[2], timer[3]
+            if callback is not None:
+                callback(*args)
+
+
+class Link:
+    """
+    The path packets take from one host to another, as a router would see it
+
+    A packet waits in the router's queue behind the packets sent before it, is
+    serialised onto the wire at the link's bandwidth, and arrives latency
+    seconds (give or take the jitter) after that.  Parameters:
+
+     - latency: one-way propagation delay in seconds
+     - jitter, distribution: the delay varies by up to +/- jitter seconds
+       ('uniform') or with jitter as its standard deviation ('normal'), but is
+       never negative.  Jitter on its own can reorder packets, as in netem.
+     - bandwidth: bits per second, or None for packets to take no time to send
+       (and so never queue)
+     - queue: the most packets the router holds at once, the one being sent
+       included; any more are dropped from the tail.  None for no limit.
+     - red: (min_th, max_th, max_p) to drop packets early with Random Early
+       Detection: with probability rising from 0 to max_p as the average
+       queue length goes from min_th to max_th packets, and always above it
+     - reorder, reorder_delay: the probability that a packet is held back for
+       reorder_delay seconds more (default: the latency, or 1ms if there is
+       none), so that packets sent after it overtake it
+
+    A Link keeps the state of one direction of one path; Network copies the
+    one it is given for every pair of hosts with clone().
+    """
+
+    # Weight of each new sample in RED's moving average of the queue length
+    red_weight = 0.002
+
+    def __init__(self, latency=0.0, jitter=0.0, distribution='uniform',
+                 bandwidth=None, queue=None, red=None, reorder=0.0,
+                 reorder_delay=None):
+        if distribution not in ('uniform', 'normal'):
+            raise ValueError("Unknown delay distribution %r" % (distribution,))
+        if red is not None and not 0 <= red[0] < red[1]:
+            raise ValueError("RED needs 0 <= min_th < max_th")
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.bandwidth = bandwidth
+        self.queue = queue
+        self.red = red
+        self.reorder = reorder
+        if reorder_delay is None:
+            reorder_delay = latency or 0.001
+        self.reorder_delay = reorder_delay
+        self.backlog = deque()  # when each packet in the router finishes sending
+        self.average = 0.0  # RED's moving average of len(backlog)
+        self.sent = 0
+        self.dropped = 0
+        self.reordered = 0
+
+    def clone(self):
+        """A link with the same parameters and nothing in flight"""
+        link = Link(self.latency, self.jitter, self.distribution,
+                    self.bandwidth, self.queue, self.red, self.reorder,
+                    self.reorder_delay)
+        link.red_weight = self.red_weight
+        return link
+
+    def transmit(self, size, t):
+        """
+        Sends a packet of size bytes at time t.  Returns the number of seconds
+        after t at which it arrives, or None if the queue dropped it.  Draws
+        from the random module, so the caller serialises calls.
+        """
+        finish = t
+        if self.bandwidth is not None:
+            backlog = self.backlog
+            while backlog and backlog[0] <= t:
+                backlog.popleft()
+            if self.red is not None and self.drop_early(len(backlog)):
+                self.dropped += 1
+                return None
+            if self.queue is not None and len(backlog) >= self.queue:
+                self.dropped += 1
+                return None
+            finish = (backlog[-1] if backlog else t) + size * 8 / self.bandwidth
+            backlog.append(finish)
+        self.sent += 1
+
+        delay = finish - t + self.latency
+        if self.jitter:
+            if self.distribution == 'uniform':
+                delay += random.uniform(-self.jitter, self.jitter)
+            else:
+                delay += random.gauss(0, self.jitter)
+        if self.reorder and random.random() < self.reorder:
+            self.reordered += 1
+            delay += self.reorder_delay
+        return max(delay, finish - t)
+
+    def drop_early(self, qlen):
+        min_th, max_th, max_p = self.red
+        self.average += self.red_weight * (qlen - self.average)
+        if self.average < min_th:
+            return False
+        if self.average >= max_th:
+            return True
+        return random.random() < max_p * (self.average - min_th) / (max_th - min_th)
+
+
 class Network:
-    def __init__(self, loss=0.0, per=0.0, debug=None):
+    """
+    Carries packets between the hosts attached to it, losing some of them and
+    corrupting some of the rest.  loss is a probability or an iterator of
+    booleans, one taken per packet, or an iterable such as GilbertElliott for
+    burst loss.
+    per is a probability or iterator for PacketErrors, or an error model with
+    a corrupt() method such as BitErrors.  Both can be assigned again later,
+    e.g. net.per = itertools.repeat(True).  Corrupted packets are delivered as
+    bytearrays.
+
+    Packets are delivered at once unless there's a Link between their source
+    and destination: link is copied for every pair of hosts that hasn't been
+    given its own with set_link().  Delayed packets are delivered from a timer
+    thread, or as events in a simulation.
+    """
+
+    def __init__(self, loss=0.0, per=0.0, debug=None, link=None):
         if debug is None:
             debug = 'NET_DEBUG' in os.environ
-        if not hasattr(loss, '__next__'):
-            loss = _trialgen(loss)
-        if not hasattr(per, '__next__'):
-            per = _trialgen(per)
         self.hosts = {}
         self.loss = loss
         self.per = per
         self.debug = debug
+        self.link = link
+        self.links = {}  # (src, dst) -> Link
+        self.timers = TimerService()
+        # Generators can't be advanced from two threads at once
+        self.trialmut = threading.Lock()
+
+    @property
+    def loss(self):
+        return self._loss
+
+    @loss.setter
+    def loss(self, loss):
+        if isinstance(loss, (int, float)):
+            loss = Bernoulli(loss)
+        self._loss = iter(loss)
+
+    @property
+    def per(self):
+        return self._per
+
+    @per.setter
+    def per(self, per):
+        if not hasattr(per, 'corrupt'):
+            per = PacketErrors(per)
+        self._per = per
 
     def attach(self, host, ip):
         if ip in self.hosts:
@@ -41,23 +624,50 @@ class Network:
                              .format(ip))
         self.hosts[ip] = host
 
+    def set_link(self, src, dst, link):
+        """Sets the Link packets from src to dst take (None for no delay)"""
+        with self.trialmut:
+            self.links[src, dst] = link
+
+    def get_link(self, src, dst):
+        """The Link packets from src to dst take, or None if they aren't delayed"""
+        with self.trialmut:
+            return self._link(src, dst)
+
+    def _link(self, src, dst):
+        try:
+            return self.links[src, dst]
+        except KeyError:
+            link = self.links[src, dst] = (None if self.link is None
+                                           else self.link.clone())
+            return link
+
     def tx(self, proto, data, src, dst):
         # Ensure all transmitted data is encoded to bytes
         if not isinstance(data, bytes):
             raise TypeError("Network can only send bytes, not {}"
                             .format(type(data).__name__))
-        # TODO: add delay and reordering
-        lose = next(self.loss)
+        delay = 0
+        with self.trialmut:
+            lose = next(self.loss)
+            if not lose and dst in self.hosts:
+                data = self.per.corrupt(data)
+            link = self._link(src, dst) if dst in self.hosts else None
+            if link is not None:
+                # Lost packets still take up the link; dropped ones never get on it
+                delay = link.transmit(len(data), now())
         if self.debug:
-            print('%s -> %s%s' % (src, dst, ' (LOST!)' if lose else ''),
+            print('%s -> %s%s' % (src, dst, ' (DROPPED!)' if delay is None else
+                                  ' (LOST!)' if lose else ''),
                   file=sys.stderr)
             _hexdump(data)
-        if not lose and dst in self.hosts:
-            if next(self.per):
-                pos = random.randint(0, len(data) - 1)
-                byte = random.randint(0, 255)
-                data = data[:pos] + bytes((byte,)) + data[pos+1:]
-            self.hosts[dst].input(proto, data, src)
+        if not lose and delay is not None and dst in self.hosts:
+            if delay > 0 or simulator() is not None:
+                # Deliver from the timer thread or the simulator's event loop,
+                # not the sender's stack
+                self.timers.schedule(delay, self.hosts[dst].input, proto, data, src)
+            else:
+                self.hosts[dst].input(proto, data, src)
         return len(data)
 
 
@@ -67,13 +677,24 @@ class Network:
 #  - register(socketclass)
 #  - udt_sendto(proto, dst, seg)
 #  - udt_rcv(proto, src, seg)
+#
+# With a ring size, a host is like a NIC: incoming packets go in a bounded
+# queue (dropped, and counted, when it's full) which a thread of the host's own
+# drains into its protocols, so senders never run the receiver's code on their
+# stack.  Without one, or in a simulation (whose events already decouple
+# hosts), packets are handed to the protocol as they arrive.
 class Host:
-    def __init__(self, net, ip):
+    def __init__(self, net, ip, ring=None):
         self.net = net
         self.ip = ip
         self.protos = {}
         self.net.attach(self, ip)
         self.test_sock = None
+        self.ring = None if ring is None else Queue(ring)
+        self.ringmut = threading.Lock()
+        self.worker = None
+        self.received = 0
+        self.dropped = 0
 
     def register_protocol(self, class_):
         pid = class_.getid()
@@ -91,7 +712,157 @@ class Host:
         self.net.tx(proto, data, self.ip, dst)
 
     def input(self, proto, data, src):
-        self.protos[proto].input(data, src)
+        if self.ring is None or simulator() is not None:
+            self.received += 1
+            self.protos[proto].input(data, src)
+            return
+        with self.ringmut:
+            self.received += 1
+            try:
+                self.ring.put_nowait((proto, data, src))
+            except Full:
+                self.dropped += 1
+                return
+            if self.worker is None:  # started lazily so idle hosts cost nothing
+                self.worker = threading.Thread(target=self.drain, daemon=True)
+                self.worker.start()
+
+    def drain(self):
+        while True:
+            proto, data, src = self.ring.get()
+            try:
+                self.protos[proto].input(data, src)
+            except Exception:
+                # The sender is long gone, so there's no one to raise it to
+                traceback.print_exc()
+
+
+class Cluster:
+    """
+    Runs the hosts of one network in several processes, so that large
+    topologies aren't all held up by one interpreter's GIL
+
+    partitions is a list of lists of IP addresses, one list per worker
+    process.  run() calls target(net, ips, *args) in each worker, where net is
+    that worker's Network and ips its partition: target creates the Hosts with
+    those addresses on net, runs the application code for them and returns a
+    (picklable) result.  Packets between hosts in one partition are delivered
+    as on any Network; packets to a host in another go to that worker's inbox,
+    a multiprocessing queue, once the sender's Network has applied loss,
+    corruption and its Link to them.
+
+    The network parameters are as for Network.  With a seed, worker i seeds
+    the random module with seed + i.  Simulations can't span processes.
+    """
+
+    def __init__(self, partitions, loss=0.0, per=0.0, link=None, seed=None):
+        seen = set()
+        for ips in partitions:
+            for ip in ips:
+                if ip in seen:
+                    raise ValueError("Address {} is in more than one partition"
+                                     .format(ip))
+                seen.add(ip)
+        self.partitions = [list(ips) for ips in partitions]
+        self.params = (loss, per, link, seed)
+
+    def run(self, target, *args, timeout=None):
+        """
+        Runs target in every worker and returns their results in partition
+        order, once they have all returned.  Workers keep delivering packets
+        until then, so a host's peers can finish with it.  If target raises in
+        any worker, the first such exception is raised here.
+        """
+        # Not fork: the forked child would inherit other threads' locks
+        ctx = multiprocessing.get_context('spawn')
+        inboxes = [ctx.Queue() for ips in self.partitions]
+        results = ctx.Queue()
+        procs = [ctx.Process(target=_shard_main, daemon=True,
+                             args=(i, self.partitions, inboxes, results,
+                                   self.params, target, args))
+                 for i in range(len(self.partitions))]
+        for proc in procs:
+            proc.start()
+        deadline = None if timeout is None else time.time() + timeout
+        out = [None] * len(procs)
+        error = None
+        pending = set(range(len(procs)))
+        try:
+            while pending:
+                try:
+                    i, ok, value = results.get(timeout=0.1)
+                except Empty:
+                    for i in pending:
+                        if procs[i].exitcode is not None:
+                            raise RuntimeError("Worker %d exited with status %d"
+                                               % (i, procs[i].exitcode))
+                    if deadline is not None and time.time() > deadline:
+                        raise TimeoutError("Workers %s still running"
+                                           % sorted(pending))
+                    continue
+                pending.discard(i)
+                if ok:
+                    out[i] = value
+                elif error is None:
+                    error = value
+        finally:
+            for inbox in inboxes:
+                inbox.put(None)
+            for proc in procs:
+                proc.join(1)
+                if proc.is_alive():
+                    proc.terminate()
+        if error is not None:
+            raise error
+        return out
+
+
+class _RemoteHost:
+    """Stands in for a host in another worker of a Cluster"""
+
+    def __init__(self, inbox, ip):
+        self.inbox = inbox
+        self.ip = ip
+
+    def input(self, proto, data, src):
+        self.inbox.put((self.ip, proto, data, src))
+
+
+def _shard_main(index, partitions, inboxes, results, params, target, args):
+    loss, per, link, seed = params
+    if seed is not None:
+        random.seed(seed + index)
+    net = Network(loss, per, link=link)
+    for i, ips in enumerate(partitions):
+        if i != index:
+            for ip in ips:
+                net.attach(_RemoteHost(inboxes[i], ip), ip)
+
+    def receive():
+        inbox = inboxes[index]
+        while True:
+            msg = inbox.get()
+            if msg is None:
+                break
+            dst, proto, data, src = msg
+            # Packets may arrive before target has created their host
+            host = net.hosts.get(dst)
+            if host is not None:
+                host.input(proto, data, src)
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    try:
+        result = (index, True, target(net, partitions[index], *args))
+        pickle.dumps(result)
+    except BaseException as ex:
+        try:
+            pickle.dumps(ex)
+        except Exception:
+            ex = RuntimeError('%s in worker %d: %s' % (type(ex).__name__, index, ex))
+        result = (index, False, ex)
+    results.put(result)
+    receiver.join()
 
 
 class Socket:
@@ -163,7 +934,7 @@ class DatagramSocket(Socket):
         address of the source.
         """
 
-        data, addr = self.msgs.get()
+        data, addr = queue_get(self.msgs)
         if n is None:
             n = len(data)
         return data[:n], addr
@@ -208,8 +979,12 @@ class StreamSocket(Socket):
         """Initializes a new stream socket"""
 
         super().__init__(*args, **kwargs)
-        self.data = b''
+        # Delivered data is kept as a queue of chunks so that neither deliver
+        # nor recv has to copy the whole buffer
+        self.chunks = deque()
+        self.buflen = 0
         self.datamut = threading.Lock()
+        self.dataready = threading.Condition(self.datamut)
 
     # Provided methods (you should not override these)
     def deliver(self, data):
@@ -220,24 +995,44 @@ class StreamSocket(Socket):
         retrieve it later.
         """
 
+        if not data:
+            return
         with self.datamut:
-            self.data += data
+            self.chunks.append(data)
+            self.buflen += len(data)
+            self.dataready.notify()
 
-    def recv(self, n=None):
+    def recv(self, n=None, timeout=None):
         """
         Retrieves data from the stream buffer
 
         Returns n bytes or all currently buffered data, whichever is smaller.
-
-        TODO: If buffer is empty, the method should block until more data is
-        delivered.
+        If the buffer is empty, blocks until more data is delivered.  If a
+        timeout (in seconds) is given and expires first, returns b''.
         """
 
         with self.datamut:
-            if n is None:
-                n = len(self.data)
-            data, self.data = self.data[:n], self.data[n:]
-        return data
+            if not wait_for(self.dataready, lambda: self.buflen, timeout):
+                return b''
+            if n is None or n > self.buflen:
+                n = self.buflen
+
+            # Take whole chunks while they fit, then split the last one
+            parts = []
+            left = n
+            while left:
+                chunk = self.chunks.popleft()
+                if len(chunk) > left:
+                    chunk = memoryview(chunk)
+                    self.chunks.appendleft(chunk[left:])
+                    chunk = chunk[:left]
+                parts.append(chunk)
+                left -= len(chunk)
+            self.buflen -= n
+
+        if len(parts) == 1 and isinstance(parts[0], bytes):
+            return parts[0]
+        return b''.join(parts)
 
     # Abstract methods, to be overridden in subclasses
     def connect(self, addr):
@@ -2,65 +2,147 @@
 # Joshua DeMoss
 # Project 2 - RDT
 # 3/24/20
-# 
+#
 # Purpose: Construct a Reliable Data Transfer Protocol from scratch
 # using the given network simulator
 
 
-from network import Protocol, StreamSocket
+from network import Protocol, StreamSocket, TimerService, now, wait_for, queue_get
+from congestion import Reno
 import random
+import threading
 from queue import Queue
-import time
 
 # Reserved protocol number for experiments; see RFC 3692
 IPPROTO_RDT = 0xfe
 
-# This socket class is used in conjuction with the RDTProtocol class below it. 
+# Sequence numbers use the full 4 bytes of the header and wrap around
+SEQ_SPACE = 2 ** 32
+
+# Segment flags
+DATA = 0
+SYN = 1
+SYNACK = 2
+ACK = 3
+
+
+# Signed distance from sequence number b to sequence number a, taking
+# wrap-around into account (positive if a comes after b)
+def seqDiff(a, b):
+    diff = (a - b) % SEQ_SPACE
+    if diff >= SEQ_SPACE // 2:
+        diff -= SEQ_SPACE
+    return diff
+
+
+# This socket class is used in conjuction with the RDTProtocol class below it.
 # The purpose of the socket class is to provide functionality for typical socket functions
-# that can opperate with the stop-and-wait protol, reliable data transfer. Main functionality
-# of this class lies in the send function, which waits for a ACK message to make sure its sent
-# message was recieved, and both the accept anad connect functions which establish connections.
+# that can opperate with the reliable data transfer protocol. Main functionality of this
+# class lies in the send function, which hands segments to a selective repeat sliding window,
+# and both the accept anad connect functions which establish connections.
+#
+# send() splits the application's data into segments of at most MSS bytes (RDTProtocol.MSS,
+# or setMSS() per socket). The window size is taken from the protocol (RDTProtocol.WINDOW)
+# and may be changed per socket with setWindow(). A window of 1 is plain stop-and-wait:
+# send() does not return until its last segment has been acknowledged. With a larger window
+# send() returns as soon as there is room for another segment, and unacknowledged segments
+# are retransmitted individually by the protocol's timer service. The receiving side buffers
+# up to RDTProtocol.RCV_WINDOW segments past a gap whatever the socket's own window, as the
+# peer's window may be larger.
+#
+# The retransmission timeout (RTO) is estimated per connection from round trip samples as
+# in RFC 6298: a smoothed RTT and RTT variance, doubled on every timeout. Following Karn's
+# algorithm, segments which have been retransmitted are never used as samples. As in Linux
+# the backoff is cleared as soon as an ACK shows the peer is making progress again, instead
+# of waiting for the next clean sample, which under heavy loss could take many segments.
+#
+# On top of the window, a congestion control algorithm (see congestion.py) limits how many
+# segments may be unacknowledged at once (cwnd). Three duplicate ACKs - ACKs whose cumulative
+# part doesn't move while later segments are arriving - trigger a fast retransmit of the
+# missing segment without waiting for its timer.
 class RDTSocket(StreamSocket):
+    # Duplicate ACKs that trigger a fast retransmit
+    DUPACK_THRESHOLD = 3
+
+    # Seconds to wait for an ACK before the first RTT sample has been taken
+    INITIAL_RTO = .01
+    # Bounds on the retransmission timeout
+    MIN_RTO = .001
+    MAX_RTO = 60.0
+    # Gains for the smoothed RTT and RTT variance (RFC 6298)
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-       
-        # Inherited variables: 
-            # data (data)
-            # datamu (lock for threading)
+
+        # Inherited variables:
+            # chunks, buflen (receive buffer)
+            # datamut, dataready (lock and condition for threading)
             # proto (protocol)
 
         # Connection Queue
         self.requests = Queue()
-        
+
         # Source Port of this Socket
         self.sPort = None
-        
+
         # Destination Port once connected to another socket
         self.dPort = None
-        
+
         # Destination IP address once " " " "
         self.dIP = None
-        
+
         # Indicates if this socket is currently connected to another socket
         self.connected = False
 
-        # Used to distinguish packets between each other 1 = SYN, 2 = SYN ACK, 3 = ACK, 0 = Regular Message
-        self.flag = 0
+        # Set once the SYN ACK for our connection request has come back
+        self.established = False
+
+        # Protects the window state below; waited on by send() and connect()
+        self.cond = threading.Condition()
+
+        # Maximum number of segments in flight
+        self.window = self.proto.WINDOW
+
+        # Maximum number of data bytes per segment
+        self.mss = self.proto.MSS
+
+        # Sending side of the window
+        self.sendBase = 0   # oldest unacknowledged sequence number
+        self.nextSeq = 0    # sequence number for the next new segment
+        self.unacked = {}   # seq -> [segment, time sent (None once retransmitted), timer, rto used]
+
+        # Retransmission timeout estimate
+        self.srtt = None    # smoothed round trip time
+        self.rttvar = None  # round trip time variance
+        self.rto = self.INITIAL_RTO
+        self.backoff = 0    # number of times the RTO has been doubled
+
+        # Congestion control
+        self.cc = self.proto.CONGESTION()
+        self.lastCumAck = 0 # cumulative ACK most recently received
+        self.dupAcks = 0    # ACKs received since then which didn't move it
+        self.recover = None # cwnd isn't reduced again until this seq is ACKed
+
+        # Receiving side of the window. It's independent of the sending side, as
+        # nothing tells the peer our window: a peer with a larger one than ours
+        # must not have its out-of-order segments thrown away.
+        self.rcvWindow = self.proto.RCV_WINDOW
+        self.rcvNext = 0    # next in-order sequence number expected
+        self.rcvBuffer = {} # seq -> data received out of order
 
-        # Used to inform the "sending" socket whether it it's sent data was recieved
-        self.acked = Falses
-    
     # Binds this socket to a port number
     def bind(self, port): # only new definition - the rest are overrides of super class
-        
+
         # will be true if connect() was called or makenewsocket() is called in accept()
-        if self.connected: 
+        if self.connected:
             raise StreamSocket.AlreadyConnected
 
         # Checks to see if port has been used on this socket's host
-        elif port in self.proto.usedPorts and self.proto.usedPorts[port][0] == self.proto.host.ip: 
+        elif port in self.proto.usedPorts and self.proto.usedPorts[port][0] == self.proto.host.ip:
             raise StreamSocket.AddressInUse
-    
+
         self.sPort = port
         self.proto.usedPorts[port] = [self.proto.host.ip, self] # add port to protocol's used ports dictionary
 
@@ -70,19 +152,18 @@ class RDTSocket(StreamSocket):
             raise StreamSocket.NotBound
         elif self.connected:
             raise StreamSocket.AlreadyConnected
-        
+
         self.proto.listeningPorts.add(self.sPort)
-    
-    # Retrieves next request from request queue, makes a new socket, connects the new socket to the requesting socket   
+
+    # Retrieves next request from request queue, makes a new socket, connects the new socket to the requesting socket
     def accept(self):
         if self.sPort not in self.proto.listeningPorts:
             raise StreamSocket.NotListening
-        
-        addr = self.requests.get() # get info from request queue
+
+        addr = queue_get(self.requests) # get info from request queue
         s = self.proto.makeNewSocket(addr[1], self.sPort, addr[0]) # make a new socket w that info
-        
-        s.sendACK(2)
-        self.proto.connSockets[(addr[1], self.sPort, addr[0])][1] = 1 # set new socket's seq number to 1 (it recieved a 0 in the connect packet)
+
+        s.sendACK(SYNACK)
         return (s, (addr[0], addr[1]))
 
     # Makes Connection request to destination socket
@@ -93,7 +174,7 @@ class RDTSocket(StreamSocket):
             raise StreamSocket.AlreadyListening
 
         self.connected = True
-        if self.sPort == None: # Select a random port number for the socket 
+        if self.sPort == None: # Select a random port number for the socket
             randPort = random.randrange(49152, 65535)
             while randPort in self.proto.usedPorts:
                 randPort = random.randrange(49152, 65535)
@@ -102,62 +183,216 @@ class RDTSocket(StreamSocket):
 
         self.dIP = addr[0]
         self.dPort = addr[1]
-        self.sendACK(1) #used to make the initial connection request
+
+        # Keep sending the connection request until the SYN ACK arrives. The
+        # handshake gives the first RTT sample if the SYN wasn't retransmitted.
+        syn = self.makeSegment(SYN, 0, b'')
+        sentAt = now()
+        while True:
+            self.output(syn, self.dIP)
+            with self.cond:
+                if wait_for(self.cond, lambda: self.established, self.currentRTO()):
+                    if sentAt is not None:
+                        self.updateRTO(now() - sentAt)
+                    self.backoff = 0
+                    break
+                self.backoff += 1
+                sentAt = None
 
     # Used to send data between Sockets
     def send(self, data):
         if not self.connected:
             raise StreamSocket.NotConnected
 
+        # Split the data into segments of at most MSS bytes. The receiver delivers
+        # them back into the stream in order, so nothing else is needed to reassemble.
+        mss = self.mss
+        for ofs in range(0, len(data), mss):
+            self.sendSegment(data[ofs:ofs+mss])
+
+    # Sends one data segment reliably. Returns once there is room for another.
+    def sendSegment(self, data):
+        # Give the data the next sequence number and remember it until it is ACKed
+        with self.cond:
+            seqNum = self.nextSeq
+            self.nextSeq = (seqNum + 1) % SEQ_SPACE
+            seg = self.makeSegment(DATA, seqNum, data)
+            rto = self.currentRTO()
+            timer = self.proto.timers.schedule(rto, self.timeout, seqNum)
+            self.unacked[seqNum] = [seg, now(), timer, rto]
+
+        self.output(seg, self.dIP)
 
-        # If this packet is a SYN or SYN ACK packet
-        if self.flag == 1 or self.flag == 2: 
-            seqNum = 0
-        
-        # else if Packet is an ACK or reg msg
-        else: 
-            # get the cur seq num of the socket
-            seqNum = self.proto.connSockets[(self.dPort, self.sPort, self.dIP)][1] 
-        
-        # Calculate the checksum and then create the header (20 bytes)
-        checksum = self.proto.checksum(self.sPort, self.dPort, seqNum, self.flag, data)   
-        hdr = self.proto.packHeader(self.sPort, self.dPort, seqNum, self.flag, checksum) 
-
-        # If packet is a SYN ACK or reg ACK then send it without RDT
-        if self.flag == 2 or self.flag == 3: 
-            self.output(hdr+data, self.dIP)
-        # otherwise provide stop-and-wait RDT
+        # Block until there is room in the window for another segment and congestion
+        # control allows another one in flight. With a window of 1 this waits for the
+        # ACK of the segment just sent.
+        with self.cond:
+            wait_for(self.cond, lambda: (seqDiff(self.nextSeq, self.sendBase) < self.window and
+                                         len(self.unacked) < self.cc.cwnd))
+
+    # Changes the number of segments this socket may keep in flight
+    def setWindow(self, window):
+        if window < 1 or window >= SEQ_SPACE // 2:
+            raise ValueError("Window size must be between 1 and 2**31 - 1")
+        with self.cond:
+            self.window = window
+            self.cond.notify_all()
+
+    # Changes the largest payload this socket will put in a single segment
+    def setMSS(self, mss):
+        if mss < 1:
+            raise ValueError("MSS must be at least 1 byte")
+        self.mss = mss
+
+    # Replaces the congestion control algorithm for this connection
+    def setCongestionControl(self, class_):
+        with self.cond:
+            self.cc = class_()
+            self.cond.notify_all()
+
+    # Returns the current (congestion window, slow start threshold) in segments
+    def congestionState(self):
+        with self.cond:
+            return self.cc.cwnd, self.cc.ssthresh
+
+    # Returns the current (smoothed RTT, RTT variance, retransmission timeout) in
+    # seconds. The first two are None until an RTT sample has been taken.
+    def rttEstimate(self):
+        with self.cond:
+            return self.srtt, self.rttvar, self.currentRTO()
+
+    # The RTO including any exponential backoff. Must be called with self.cond held.
+    def currentRTO(self):
+        return min(self.rto * 2 ** self.backoff, self.MAX_RTO)
+
+    # Folds a round trip time sample into the RTO estimate (RFC 6298 section 2).
+    # Must be called with self.cond held.
+    def updateRTO(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
         else:
-            # Wait till this socket recieves an ACK before exiting the fun call
-            while not self.acked:
-                self.output(hdr+data, self.dIP)
-                start = time.time()
-                while time.time() - start < .01:
-                    # The RDT protocl will update this value when it recieves an ACK see input()
-                    if self.acked:
-                        break
-            self.acked = False
-
-        # Sequence numbers are used to gaurd against duplicate messages
-        if self.flag != 1: 
-            self.proto.connSockets[(self.dPort, self.sPort, self.dIP)][1] = 1 - seqNum
-
-    # Helper function used to reduce code associated with sending an ack
-    def sendACK(self, flag):
-        self.flag = flag
-        self.send(b'')
-        self.flag = 0
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.MIN_RTO), self.MAX_RTO)
+
+    # Called on the timer thread when a segment has gone an RTO without an ACK
+    def timeout(self, seqNum):
+        with self.cond:
+            entry = self.unacked.get(seqNum)
+            if entry is None:
+                return
+
+            # Back off exponentially, but only once for all the segments which were
+            # sent under the same RTO rather than once for every one of them
+            if entry[3] >= self.currentRTO():
+                if self.currentRTO() < self.MAX_RTO:
+                    self.backoff += 1
+                self.cc.onTimeout(len(self.unacked))
+                self.recover = self.nextSeq
+            entry[1] = None # Karn's algorithm: no RTT sample from this segment now
+            entry[3] = self.currentRTO()
+            entry[2] = self.proto.timers.schedule(entry[3], self.timeout, seqNum)
+
+        # Never hold the lock while sending: the network delivers synchronously and
+        # the ACK may come back into input() on this same thread
+        self.output(entry[0], self.dIP)
+
+    # Called by the protocol when an ACK arrives. seqNum is the segment being
+    # acknowledged and cumAck is the next sequence number the peer expects, so
+    # everything before it has been received as well.
+    def ackReceived(self, seqNum, cumAck):
+        with self.cond:
+            # Only the segment named by the ACK gives an unambiguous RTT sample
+            entry = self.unacked.get(seqNum)
+            if entry is not None and entry[1] is not None:
+                self.updateRTO(now() - entry[1])
+
+            acked = 0
+            for seq in list(self.unacked):
+                if seq == seqNum or seqDiff(seq, cumAck) < 0:
+                    self.proto.timers.cancel(self.unacked.pop(seq)[2])
+                    acked += 1
+            if acked:
+                self.backoff = 0
+                self.cc.onAck(acked, self.srtt)
+
+            # Slide the window up to the oldest segment still in flight
+            while self.sendBase != self.nextSeq and self.sendBase not in self.unacked:
+                self.sendBase = (self.sendBase + 1) % SEQ_SPACE
+            if self.recover is not None and seqDiff(cumAck, self.recover) >= 0:
+                self.recover = None
+
+            # Count ACKs which show later segments arriving while cumAck is stuck
+            retransmit = None
+            if seqDiff(cumAck, self.lastCumAck) > 0:
+                self.lastCumAck = cumAck
+                self.dupAcks = 0
+            elif cumAck in self.unacked:
+                self.dupAcks += 1
+                if self.dupAcks == self.DUPACK_THRESHOLD:
+                    retransmit = self.fastRetransmit(cumAck)
+            self.cond.notify_all()
+
+        if retransmit is not None:
+            self.output(retransmit, self.dIP)
+
+    # Restarts the timer of a segment presumed lost and returns it to be resent.
+    # Congestion control reduces cwnd once per window of data. Must be called with
+    # self.cond held.
+    def fastRetransmit(self, seqNum):
+        entry = self.unacked[seqNum]
+        if self.recover is None:
+            self.cc.onLoss(len(self.unacked))
+            self.recover = self.nextSeq
+        self.proto.timers.cancel(entry[2])
+        entry[1] = None
+        entry[3] = self.currentRTO()
+        entry[2] = self.proto.timers.schedule(entry[3], self.timeout, seqNum)
+        return entry[0]
+
+    # Called by the protocol when a data segment arrives. Buffers segments that arrive
+    # out of order and delivers every segment that is now in order. Returns False if
+    # the segment lies beyond the receive window and should not be acknowledged.
+    def dataReceived(self, seqNum, data):
+        with self.cond:
+            offset = seqDiff(seqNum, self.rcvNext)
+            if offset >= self.rcvWindow:
+                return False
+            if offset >= 0:
+                self.rcvBuffer[seqNum] = data
+                while self.rcvNext in self.rcvBuffer:
+                    self.deliver(self.rcvBuffer.pop(self.rcvNext))
+                    self.rcvNext = (self.rcvNext + 1) % SEQ_SPACE
+            # Anything before rcvNext is a duplicate whose ACK was lost; ACK it again
+            return True
+
+    # Builds a segment with this socket's ports
+    def makeSegment(self, flag, seqNum, data):
+        checksum = self.proto.checksum(self.sPort, self.dPort, seqNum, flag, data)
+        hdr = self.proto.packHeader(self.sPort, self.dPort, seqNum, flag, checksum)
+        return hdr + data
+
+    # Helper function used to reduce code associated with sending an ack. ACKs are
+    # never retransmitted; a lost ACK is replaced when the peer retransmits.
+    def sendACK(self, flag, seqNum=0):
+        if flag == ACK:
+            # Piggyback the cumulative ACK in the payload
+            data = self.rcvNext.to_bytes(4, 'big')
+        else:
+            data = b''
+        self.output(self.makeSegment(flag, seqNum, data), self.dIP)
 
 
 # ----------------------------------------------------------------------------------------------------------------------------------------------------
 
 
-# This is a custom RDT protocol. It is stop and wait, meaning each host waits until it recieves
-# a rsponse from the device it is communicating with before continuing to send more data. IF the
-# host waits more than 10 miliseconds, it resends the message it sent assuming the device it is
-# communicating with never recieved its earlier message. The stop and wait functionality is
-# implemented in the RDT socket above, specifically in the send function. The main functionality
-# of this class is in input which decides what should be done when the host recieves data.
+# This is a custom RDT protocol using a selective repeat sliding window. Each data segment
+# carries a 32 bit sequence number and is acknowledged individually, and the ACK also carries
+# the next sequence number the receiver expects (a cumulative ACK). IF the sender waits longer
+# than the connection's retransmission timeout for an ACK, it resends only that segment, assuming
+# the device it is communicating with never recieved it. The sliding window is implemented in the RDT
+# socket above. With the default window of 1 the protocol is stop and wait.
 #
 # The main functionality provided by this class is in input which parses packets recieved at the
 # transport layer, demultiplexes the message based on the custom header, and then performs the appropriate
@@ -167,11 +402,26 @@ class RDTProtocol(Protocol):
     PROTO_ID = IPPROTO_RDT
     SOCKET_CLS = RDTSocket
 
+    # Default number of segments a socket may have in flight; override in a subclass
+    # (or call setWindow() on a socket) to enable the windowed mode
+    WINDOW = 1
+
+    # Number of segments past the next in-order one that a socket buffers when they
+    # arrive out of order; later ones are dropped without an ACK
+    RCV_WINDOW = 1024
+
+    # Default maximum segment size, in bytes of payload. send() splits larger buffers
+    # so that a lost or corrupted segment only costs MSS bytes to resend.
+    MSS = 1400
+
+    # Default congestion control algorithm for new connections (see congestion.py)
+    CONGESTION = Reno
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        
+
         # Dictionary of all connections on this host
-        self.connSockets = {} #(sPort, dPort, sIP)
+        self.connSockets = {} #(sPort, dPort, sIP) -> socket
 
         # Dictionary of used ports on this host
         self.usedPorts = {}
@@ -179,56 +429,68 @@ class RDTProtocol(Protocol):
         # Set of listening ports
         self.listeningPorts = set()
 
+        # Retransmission timers for every socket on this host
+        self.timers = TimerService()
+
+        # Connection requests which are queued but not yet accepted, and the lock
+        # which keeps them consistent with connSockets
+        self.pendingConns = set()
+        self.connLock = threading.Lock()
+
     def input(self, seg, host):
         sPort, dPort, seqNum, flag, checksum, data = self.parseRDT(seg)
 
         # Check for corruption
-        if checksum == self.checksum(sPort, dPort, seqNum, flag, data):
-            
-            # if its a regular message
-            if flag == 0: 
-                # Demux by fetching the right socket
-                if (sPort, dPort, host) in self.connSockets:
-                    correctSocket = self.connSockets[(sPort, dPort, host)][0]
-                    if seqNum == self.connSockets[(sPort, dPort, host)][1]:
-                        correctSocket.deliver(data)
-                        correctSocket.sendACK(3)
-                    else:
-                        self.connSockets[(sPort, dPort, host)][1] = 1 - self.connSockets[(sPort, dPort, host)][1]
-                        correctSocket.sendACK(3)
-            
-            # If it is a SYN or ACK message
-            else: 
-                if dPort in self.usedPorts:
-                    correctSocket = self.usedPorts[dPort][1]
-                    
-                    # Setting up a connection
-                    if flag == 1: # SYN request
-                        if ((host, sPort) not in list(correctSocket.requests.queue)) and ((sPort, dPort, host) not in self.connSockets): #not in queue or connSockets
-                            correctSocket.requests.put((host, sPort)) #
-                        elif (host, sPort) not in list(correctSocket.requests.queue): #if the connection is already made (queue doesn't contain it though)
-                            correctSocket = self.connSockets[(sPort, dPort, host)][0]
-                            self.connSockets[(sPort, dPort, host)][1] = 1 - self.connSockets[(sPort, dPort, host)][1] #get the opposite sequence number of that connection
-                            correctSocket.sendACK(2) #use that sequence number to send an ACK
-                    
-                    # Responding to a connection request (aka SYN Request)        
-                    elif flag == 2:
-                        self.connSockets[(sPort, dPort, host)] = [correctSocket, 1]
-                        correctSocket.acked = True # will be set false again by send
-                    
-                    # Responding to normal messages after connection is already established
-                    elif (flag == 3) and ((sPort, dPort, host) in self.connSockets) and (seqNum == self.connSockets[(sPort, dPort, host)][1]):
-                        correctSocket = self.connSockets[(sPort, dPort, host)][0]
-                        correctSocket.acked = True # Notify the sender that it recieved an ACK by setting acked to true
+        if checksum != self.checksum(sPort, dPort, seqNum, flag, data):
+            return
+
+        key = (sPort, dPort, host)
+
+        # if its a regular message
+        if flag == DATA:
+            # Demux by fetching the right socket
+            if key in self.connSockets:
+                correctSocket = self.connSockets[key]
+                if correctSocket.dataReceived(seqNum, data):
+                    correctSocket.sendACK(ACK, seqNum)
+
+        # Responding to normal messages after connection is already established
+        elif flag == ACK:
+            if key in self.connSockets and len(data) == 4:
+                self.connSockets[key].ackReceived(seqNum, int.from_bytes(data, 'big'))
+
+        # If it is a SYN or SYN ACK message
+        elif dPort in self.usedPorts:
+            correctSocket = self.usedPorts[dPort][1]
+
+            # Setting up a connection
+            if flag == SYN: # SYN request
+                with self.connLock:
+                    existing = self.connSockets.get(key)
+                    if existing is None and key not in self.pendingConns: # not in queue or connSockets
+                        self.pendingConns.add(key)
+                        correctSocket.requests.put((host, sPort))
+                if existing is not None: # if the connection is already made our SYN ACK was lost
+                    existing.sendACK(SYNACK)
+
+            # Responding to a connection request (aka SYN Request)
+            elif flag == SYNACK and correctSocket.connected:
+                self.connSockets[key] = correctSocket
+                with correctSocket.cond:
+                    correctSocket.established = True
+                    correctSocket.cond.notify_all()
 
     # Helper function for accept to make a new socket
     def makeNewSocket(self, sPort, dPort, sIP):
         toReturn = RDTSocket(self)
         toReturn.connected = True
+        toReturn.established = True
         toReturn.sPort = dPort
         toReturn.dPort = sPort
         toReturn.dIP = sIP
-        self.connSockets[(sPort, dPort, sIP)] = [toReturn, 0] #reference to self and sequence number
+        with self.connLock:
+            self.connSockets[(sPort, dPort, sIP)] = toReturn
+            self.pendingConns.discard((sPort, dPort, sIP))
         return toReturn
 
     # Helper function to help pack the header bytes
@@ -250,6 +512,7 @@ class RDTProtocol(Protocol):
         data = seg[20:]
         return sPort, dPort, seqNum, flag, checksum, data
 
-    # Helper function to creat the checksum
+    # Helper function to creat the checksum. The sequence number is covered too, since
+    # a corrupted sequence number would otherwise put the data in the wrong place.
     def checksum(self, sPort, dPort, seqNum, flag, data):
-        return (sPort + dPort + flag + sum(data)) % ((2 ** 32) - 1)
+        return (sPort + dPort + seqNum + flag + sum(data)) % ((2 ** 32) - 1)
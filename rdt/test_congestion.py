@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#
+# Tests for the congestion control algorithms in congestion.py
+
+import sys
+import os.path
+sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
+
+from network import *
+from rdt import *
+from congestion import *
+from exthread import *
+
+import itertools
+import unittest
+
+class A_RenoTest(unittest.TestCase):
+    CC = Reno
+
+    def setUp(self):
+        self.cc = type(self).CC()
+
+    def test_slowstart(self):
+        """cwnd grows by one segment per segment ACKed in slow start"""
+        cwnd = self.cc.cwnd
+        for i in range(20):
+            self.cc.onAck(1, 0.01)
+        self.assertEqual(self.cc.cwnd, cwnd + 20)
+
+    def test_loss(self):
+        """Duplicate-ACK losses reduce the window and end slow start"""
+        for i in range(30):
+            self.cc.onAck(1, 0.01)
+        self.cc.onLoss(40)
+        self.assertLess(self.cc.cwnd, 40)
+        self.assertGreaterEqual(self.cc.cwnd, CongestionControl.MIN_SSTHRESH)
+        self.assertEqual(self.cc.cwnd, self.cc.ssthresh)
+
+    def test_timeout(self):
+        """A timeout drops back to a window of one segment"""
+        self.cc.onTimeout(16)
+        self.assertEqual(self.cc.cwnd, 1)
+        self.assertLess(self.cc.ssthresh, 16)
+
+    def test_avoidance(self):
+        """Above ssthresh the window keeps growing, but less than one segment per ACK"""
+        self.cc.onLoss(40)
+        cwnd = self.cc.cwnd
+        for i in range(int(cwnd)):
+            self.cc.onAck(1, 0.01)
+        self.assertGreater(self.cc.cwnd, cwnd)
+        self.assertLess(self.cc.cwnd, cwnd + 2)
+
+class B_CubicTest(A_RenoTest):
+    CC = Cubic
+
+    def test_wmax(self):
+        """Cubic remembers the window where the loss happened"""
+        for i in range(30):
+            self.cc.onAck(1, 0.01)
+        cwnd = self.cc.cwnd
+        self.cc.onLoss(cwnd)
+        self.assertEqual(self.cc.wMax, cwnd)
+        self.assertAlmostEqual(self.cc.cwnd, cwnd * Cubic.BETA)
+
+class FastRetransmitRDT(RDTProtocol):
+    WINDOW = 32
+
+class C_FastRetransmitTest(unittest.TestCase):
+    def setUp(self):
+        self.n = Network()
+        self.h1 = Host(self.n, '192.168.10.1')
+        self.h2 = Host(self.n, '192.168.10.2')
+        self.h1.register_protocol(FastRetransmitRDT)
+        self.h2.register_protocol(FastRetransmitRDT)
+        ls = self.h2.socket(IPPROTO_RDT)
+        ls.bind(5000)
+        ls.listen()
+        self.c = self.h1.socket(IPPROTO_RDT)
+        with ExThread(target=self.c.connect, args=(('192.168.10.2', 5000),)):
+            self.s, _ = ls.accept()
+
+    def test_fastretransmit(self):
+        """Three duplicate ACKs resend a lost segment before its timer expires"""
+        # Make sure the retransmission timer can't be what recovers the segment
+        self.c.rto = RDTSocket.MAX_RTO
+        cwnd, ssthresh = self.c.congestionState()
+        self.assertEqual(ssthresh, float('inf'))
+
+        # Lose the first segment only
+        self.n.loss = itertools.chain([True], itertools.repeat(False))
+        for i in range(5):
+            self.c.send(b'test-fastrxmit' + str(i).encode())
+        self.assertEqual(self.s.recv(),
+                b''.join(b'test-fastrxmit' + str(i).encode() for i in range(5)))
+
+        cwnd, ssthresh = self.c.congestionState()
+        self.assertLess(ssthresh, float('inf'))
+
+    def test_setcc(self):
+        """The congestion control algorithm can be changed per connection"""
+        self.c.setCongestionControl(Cubic)
+        self.assertIsInstance(self.c.cc, Cubic)
+        self.assertIsInstance(self.s.cc, Reno)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,9 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
 
 from network import *
 
+import itertools
+import random
+import threading
 import unittest
 import unittest.mock as mock
 
@@ -285,5 +288,372 @@ class H_StreamSocketTest(unittest.TestCase):
         self.assertEqual(self.ss.recv(4), b"lo w")
         self.assertEqual(self.ss.recv(), b"orld")
 
+    def test_recv_blocks(self):
+        t = threading.Timer(0.05, self.ss.deliver, args=(b"late",))
+        t.start()
+        self.assertEqual(self.ss.recv(), b"late")
+        t.join()
+
+    def test_recv_timeout(self):
+        self.assertEqual(self.ss.recv(timeout=0.01), b"")
+        self.ss.deliver(b"hello")
+        self.assertEqual(self.ss.recv(timeout=0.01), b"hello")
+
+    def test_deliver_many(self):
+        data = b"".join(str(i).encode() for i in range(10000))
+        for i in range(10000):
+            self.ss.deliver(str(i).encode())
+        received = b""
+        while len(received) < len(data):
+            received += self.ss.recv(7)
+        self.assertEqual(received, data)
+
+def _ping(net, ips):
+    # Cluster target: 192.168.50.1 pings until 192.168.50.2 answers
+    from sdp import SampleDatagramProtocol as SDP
+    h = Host(net, ips[0])
+    h.register_protocol(SDP)
+    s = h.socket(SDP.PROTO_ID)
+    if ips[0] == '192.168.50.2':
+        msg, src = s.recvfrom()
+        s.sendto(b'pong ' + msg, src)
+        return os.getpid()
+    answered = threading.Event()
+    def pinger():
+        while not answered.wait(0.05):
+            s.sendto(b'ping', '192.168.50.2')
+    threading.Thread(target=pinger, daemon=True).start()
+    msg, src = s.recvfrom()
+    answered.set()
+    return msg, src, os.getpid()
+
+def _fail(net, ips):
+    raise ValueError(ips[0])
+
+class I_SimulatorTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = Simulator()
+        self.log = []
+
+    def test_events(self):
+        """Events run in virtual time order, ties in scheduling order"""
+        self.sim.schedule(2.0, self.log.append, 'c')
+        self.sim.schedule(1.0, self.log.append, 'a')
+        self.sim.schedule(1.0, self.log.append, 'b')
+        t = self.sim.schedule(1.5, self.log.append, 'cancelled')
+        self.sim.cancel(t)
+        self.assertEqual(self.sim.run(), 2.0)
+        self.assertEqual(self.log, ['a', 'b', 'c'])
+
+    def test_until(self):
+        """run() stops when the clock would pass until"""
+        self.sim.schedule(5.0, self.log.append, 'late')
+        self.assertEqual(self.sim.run(until=3.0), 3.0)
+        self.assertEqual(self.log, [])
+        self.sim.run()
+        self.assertEqual(self.log, ['late'])
+
+    def test_processes(self):
+        """Processes take turns and sleep in virtual time"""
+        def proc(name, delay):
+            for i in range(3):
+                self.log.append((name, now()))
+                self.sim.sleep(delay)
+        self.sim.spawn(proc, 'a', 1.0)
+        self.sim.spawn(proc, 'b', 1.5)
+        t = time.time()
+        self.assertEqual(self.sim.run(), 4.5)
+        self.assertLess(time.time() - t, 1.0)
+        self.assertEqual(self.log, [('a', 0.0), ('b', 0.0), ('a', 1.0), ('b', 1.5),
+                                    ('a', 2.0), ('b', 3.0)])
+
+    def test_error(self):
+        """An exception in a process is raised by run()"""
+        def proc():
+            raise ValueError('test-error')
+        self.sim.spawn(proc)
+        with self.assertRaises(ValueError):
+            self.sim.run()
+
+    def test_tx(self):
+        """In a simulation tx() schedules delivery instead of delivering on the sender's stack"""
+        n = Network()
+        mh = mock.MagicMock(name='host 1', spec=Host)
+        n.attach(mh, '192.168.10.1')
+        def proc():
+            n.tx(8, b'test-simtx', '192.168.10.2', '192.168.10.1')
+            mh.input.assert_not_called()
+        self.sim.spawn(proc)
+        self.sim.run()
+        mh.input.assert_called_once_with(8, b'test-simtx', '192.168.10.2')
+
+    def test_recv(self):
+        """Blocking recv() waits in virtual time"""
+        p = mock.MagicMock(name='protocol', spec=Protocol)
+        ss = StreamSocket(p)
+        def proc():
+            self.assertEqual(ss.recv(timeout=10), b'')
+            self.log.append(now())
+            self.assertEqual(ss.recv(), b'late')
+            self.log.append(now())
+        self.sim.schedule(12.0, ss.deliver, b'late')
+        self.sim.spawn(proc)
+        self.sim.run()
+        self.assertEqual(self.log, [10.0, 12.0])
+
+class J_LinkTest(unittest.TestCase):
+    def test_latency(self):
+        """Packets arrive latency seconds after they're sent"""
+        link = Link(latency=0.05)
+        self.assertEqual(link.transmit(1000, 0.0), 0.05)
+        self.assertEqual(link.transmit(1000, 0.0), 0.05)
+
+    def test_bandwidth(self):
+        """Packets are serialised one after another at the link's bandwidth"""
+        link = Link(latency=0.01, bandwidth=8000)  # 1000 bytes/s
+        self.assertAlmostEqual(link.transmit(100, 0.0), 0.11)
+        self.assertAlmostEqual(link.transmit(100, 0.0), 0.21)
+        self.assertAlmostEqual(link.transmit(100, 0.05), 0.26)
+        # Once the queue has drained a packet goes straight out
+        self.assertAlmostEqual(link.transmit(100, 1.0), 0.11)
+
+    def test_taildrop(self):
+        """Packets beyond the queue's size are dropped"""
+        link = Link(bandwidth=8000, queue=3)
+        delays = [link.transmit(100, 0.0) for i in range(5)]
+        self.assertEqual(delays[3:], [None, None])
+        self.assertEqual((link.sent, link.dropped), (3, 2))
+        self.assertIsNotNone(link.transmit(100, 0.1))
+
+    def test_red(self):
+        """RED drops everything once the average queue passes max_th"""
+        link = Link(bandwidth=8000, red=(1, 2, 0.5))
+        link.red_weight = 1.0
+        self.assertIsNotNone(link.transmit(100, 0.0))
+        self.assertIsNotNone(link.transmit(100, 0.0))
+        self.assertIsNone(link.transmit(100, 0.0))
+        self.assertEqual(link.dropped, 1)
+
+    def test_jitter(self):
+        """Jitter keeps the delay within bounds, and never below zero"""
+        link = Link(latency=0.05, jitter=0.01)
+        for i in range(100):
+            self.assertTrue(0.04 <= link.transmit(100, 0.0) <= 0.06)
+        link = Link(latency=0.001, jitter=0.01, distribution='normal')
+        for i in range(100):
+            self.assertGreaterEqual(link.transmit(100, 0.0), 0.0)
+        with self.assertRaises(ValueError):
+            Link(distribution='pareto')
+
+    def test_reorder(self):
+        """Reordered packets are held back"""
+        link = Link(latency=0.05, reorder=1.0)
+        self.assertEqual(link.transmit(100, 0.0), 0.1)
+        self.assertEqual(link.reordered, 1)
+
+    def test_clone(self):
+        """Clones share parameters but not queues"""
+        link = Link(bandwidth=8000, queue=1)
+        link.transmit(100, 0.0)
+        copy = link.clone()
+        self.assertIsNotNone(copy.transmit(100, 0.0))
+        self.assertIsNone(link.transmit(100, 0.0))
+
+    def test_simulated(self):
+        """Deliveries over a link happen in virtual time"""
+        sim = Simulator()
+        n = Network(link=Link(latency=0.1, bandwidth=8000))
+        mh = mock.MagicMock(name='host 1', spec=Host)
+        n.attach(mh, '192.168.10.1')
+        times = []
+        mh.input.side_effect = lambda *args: times.append(now())
+        def proc():
+            for i in range(3):
+                n.tx(8, b'x' * 100, '192.168.10.2', '192.168.10.1')
+        sim.spawn(proc)
+        sim.run()
+        self.assertEqual([round(t, 6) for t in times], [0.2, 0.3, 0.4])
+        self.assertIsNot(n.get_link('192.168.10.2', '192.168.10.1'), n.link)
+
+    def test_realtime(self):
+        """Outside a simulation delayed packets arrive on the timer thread"""
+        n = Network()
+        n.set_link('192.168.10.2', '192.168.10.1', Link(latency=0.05))
+        mh = mock.MagicMock(name='host 1', spec=Host)
+        n.attach(mh, '192.168.10.1')
+        arrived = threading.Event()
+        mh.input.side_effect = lambda *args: arrived.set()
+        t = time.time()
+        n.tx(8, b'test-delayed', '192.168.10.2', '192.168.10.1')
+        mh.input.assert_not_called()
+        self.assertTrue(arrived.wait(1.0))
+        self.assertGreaterEqual(time.time() - t, 0.05)
+        mh.input.assert_called_once_with(8, b'test-delayed', '192.168.10.2')
+        # Other pairs of hosts aren't delayed
+        self.assertIsNone(n.get_link('192.168.10.1', '192.168.10.2'))
+
+    def test_dropped(self):
+        """Packets a queue drops aren't delivered"""
+        sim = Simulator()
+        n = Network(link=Link(bandwidth=8000, queue=2))
+        mh = mock.MagicMock(name='host 1', spec=Host)
+        n.attach(mh, '192.168.10.1')
+        def proc():
+            for i in range(4):
+                n.tx(8, b'x' * 100, '192.168.10.2', '192.168.10.1')
+        sim.spawn(proc)
+        sim.run()
+        self.assertEqual(mh.input.call_count, 2)
+        self.assertEqual(n.get_link('192.168.10.2', '192.168.10.1').dropped, 2)
+
+class K_HostRingTest(unittest.TestCase):
+    def setUp(self):
+        self.n = Network()
+        self.h = Host(self.n, '192.168.10.1', ring=4)
+        self.h.register_protocol(PC1)
+        self.p = PC1.last_inst
+        self.threads = []
+        self.arrived = threading.Semaphore(0)
+        self.release = threading.Event()
+        self.release.set()
+        def input(data, src):
+            self.release.wait()
+            self.threads.append(threading.current_thread())
+            self.arrived.release()
+        self.p.input = input
+
+    def test_worker(self):
+        """Packets are handed to the protocol by the host's own thread"""
+        self.n.tx(1, b'test-ring', '192.168.10.2', '192.168.10.1')
+        self.assertTrue(self.arrived.acquire(timeout=1))
+        self.assertIsNot(self.threads[0], threading.current_thread())
+        self.assertEqual((self.h.received, self.h.dropped), (1, 0))
+
+    def test_overflow(self):
+        """Packets are dropped while the ring is full"""
+        self.release.clear()
+        self.n.tx(1, b'test-ring', '192.168.10.2', '192.168.10.1')
+        while self.h.ring.qsize():
+            time.sleep(0.001)
+        # The worker holds the first packet, so the ring takes four more
+        for i in range(9):
+            self.n.tx(1, b'test-ring', '192.168.10.2', '192.168.10.1')
+        self.assertEqual((self.h.received, self.h.dropped), (10, 5))
+        self.release.set()
+        for i in range(5):
+            self.assertTrue(self.arrived.acquire(timeout=1))
+
+    def test_error(self):
+        """The worker carries on after a protocol raises"""
+        with mock.patch('traceback.print_exc') as print_exc:
+            self.n.tx(2, b'test-unregistered', '192.168.10.2', '192.168.10.1')
+            self.n.tx(1, b'test-ring', '192.168.10.2', '192.168.10.1')
+            self.assertTrue(self.arrived.acquire(timeout=1))
+            print_exc.assert_called_once()
+
+    def test_simulated(self):
+        """In a simulation packets go to the protocol as events run"""
+        sim = Simulator()
+        def proc():
+            self.n.tx(1, b'test-ring', '192.168.10.2', '192.168.10.1')
+        sim.spawn(proc)
+        sim.run()
+        self.assertEqual(len(self.threads), 1)
+        self.assertIsNone(self.h.worker)
+
+class L_ClusterTest(unittest.TestCase):
+    def test_ping(self):
+        """Hosts in different worker processes exchange packets"""
+        c = Cluster([['192.168.50.1'], ['192.168.50.2']])
+        (msg, src, pid1), pid2 = c.run(_ping, timeout=30)
+        self.assertEqual((msg, src), (b'pong ping', '192.168.50.2'))
+        self.assertNotEqual(pid1, pid2)
+        self.assertNotIn(os.getpid(), (pid1, pid2))
+
+    def test_error(self):
+        """An exception in a worker is raised by run()"""
+        c = Cluster([['192.168.50.1'], ['192.168.50.2']])
+        with self.assertRaises(ValueError):
+            c.run(_fail, timeout=30)
+
+    def test_duplicate(self):
+        with self.assertRaises(ValueError):
+            Cluster([['192.168.50.1'], ['192.168.50.1']])
+
+class M_ErrorModelTest(unittest.TestCase):
+    def test_bernoulli(self):
+        """Batched trials succeed at the given rate, reproducibly"""
+        trials = list(itertools.islice(Bernoulli(0.2, seed=1, batch=100), 10000))
+        self.assertAlmostEqual(sum(trials) / 10000, 0.2, delta=0.02)
+        self.assertEqual(trials, list(itertools.islice(Bernoulli(0.2, seed=1), 10000)))
+        self.assertNotEqual(trials, list(itertools.islice(Bernoulli(0.2, seed=2), 10000)))
+
+    def test_seeded_by_random(self):
+        """Without a seed, models are seeded from the random module"""
+        random.seed(5)
+        a = list(itertools.islice(Bernoulli(0.5), 100))
+        random.seed(5)
+        self.assertEqual(a, list(itertools.islice(Bernoulli(0.5), 100)))
+
+    def test_gilbert_elliott(self):
+        """Burst losses have the chain's long-run rate and burst length"""
+        ge = GilbertElliott(0.01, 0.25, seed=3)
+        lost = list(itertools.islice(ge, 200000))
+        self.assertAlmostEqual(sum(lost) / len(lost), 0.01 / 0.26, delta=0.01)
+        bursts = [len(list(g)) for k, g in itertools.groupby(lost) if k]
+        self.assertAlmostEqual(sum(bursts) / len(bursts), 4, delta=0.5)
+        # Never leaving the good state loses nothing
+        self.assertFalse(any(itertools.islice(GilbertElliott(0, 1, seed=3), 10000)))
+
+    def test_packet_errors(self):
+        """PacketErrors changes at most one byte of a packet"""
+        pe = PacketErrors(itertools.cycle([True, False]), seed=4)
+        data = bytes(range(100))
+        bad = pe.corrupt(data)
+        self.assertEqual(len(bad), 100)
+        self.assertLessEqual(sum(a != b for a, b in zip(data, bad)), 1)
+        self.assertIs(pe.corrupt(data), data)
+        self.assertEqual(pe.corrupt(b''), b'')
+
+    def test_bit_errors(self):
+        """BitErrors flips bits at the given rate, more of them in longer packets"""
+        be = BitErrors(1e-4, seed=6)
+        data = bytes(1000)
+        flipped = 0
+        corrupted = 0
+        for i in range(1000):
+            out = be.corrupt(data)
+            if out is not data:
+                corrupted += 1
+                flipped += sum(bin(b).count('1') for b in out)
+        self.assertAlmostEqual(flipped / 8e6, 1e-4, delta=2e-5)
+        # P(a packet has an error) = 1 - (1 - ber) ** 8000
+        self.assertAlmostEqual(corrupted / 1000, 0.55, delta=0.06)
+        short = sum(be.corrupt(bytes(10)) != bytes(10) for i in range(1000))
+        self.assertLess(short, 50)
+        self.assertIs(BitErrors(0.0).corrupt(data), data)
+
+    def test_network_models(self):
+        """Network applies the models it's given"""
+        n = Network(loss=GilbertElliott(0.0, 1.0), per=BitErrors(1.0))
+        mh = mock.MagicMock(name='host 1', spec=Host)
+        n.attach(mh, '192.168.10.1')
+        n.tx(8, b'\x00\x0f', '192.168.10.2', '192.168.10.1')
+        mh.input.assert_called_once_with(8, b'\xff\xf0', '192.168.10.2')
+
+    def test_reassign(self):
+        """loss and per take the same kinds of values when assigned later"""
+        n = Network()
+        mh = mock.MagicMock(name='host 1', spec=Host)
+        n.attach(mh, '192.168.10.1')
+        n.per = itertools.repeat(True)
+        n.tx(8, b'test', '192.168.10.2', '192.168.10.1')
+        data = mh.input.call_args[0][1]
+        self.assertIsInstance(data, bytearray)
+        self.assertLessEqual(sum(a != b for a, b in zip(data, b'test')), 1)
+        n.loss = 1.0
+        n.tx(8, b'test', '192.168.10.2', '192.168.10.1')
+        self.assertEqual(mh.input.call_count, 1)
+
 if __name__ == '__main__':
     unittest.main()
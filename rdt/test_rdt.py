@@ -13,6 +13,7 @@ import os.path
 sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
 from network import *
 from rdt import *
+from congestion import *
 from exthread import *
 
 class BaseNetworkTest(unittest.TestCase):
@@ -22,6 +23,8 @@ class BaseNetworkTest(unittest.TestCase):
     # Provide defaults
     LOSS = 0.00
     PER = 0.00
+    # Inbound ring size of each host (None to deliver on the sender's stack)
+    RING = None
     # List of client socket addresses (bound if port is not None)
     CLIENTS = []
     # List of listening socket addresses (port must be set)
@@ -65,7 +68,7 @@ class BaseNetworkTest(unittest.TestCase):
         self.h = {}
         # Use set comprehension to eliminate duplicates
         for ip in {fst for fst, _ in itertools.chain(caddrs, laddrs)}:
-            h = Host(n, ip)
+            h = Host(n, ip, ring=type(self).RING)
             h.register_protocol(type(self).PROTO)
             self.h[ip] = h
 
@@ -509,5 +512,254 @@ class H7_Corrupt10Lose10_ManyConns(A7_Lossless_ManyConns):
     LOSS = 0.10
     PER = 0.10
 
+class WindowedRDTProtocol(RDTProtocol):
+    WINDOW = 32
+
+class I1_Windowed_1x1(BaseNetworkTest):
+    PROTO = WindowedRDTProtocol
+    CLIENTS = [('192.168.20.1', None)]
+    LISTEN = [('192.168.20.2', 7243)]
+    CONNS = {'c': (0, 0)}
+
+    def client_recvall(self, sock, data):
+        # send() returns before the data is ACKed, so keep reading until it
+        # has all arrived
+        incoming = b''
+        while len(incoming) < len(data):
+            incoming += sock.recv()
+        self.assertEqual(incoming, data)
+
+    def test_01_window(self):
+        """Window size comes from the protocol and can be changed"""
+        self.assertEqual(self.c['c'].window, 32)
+        self.c['c'].setWindow(4)
+        self.assertEqual(self.c['c'].window, 4)
+        with self.assertRaises(ValueError):
+            self.c['c'].setWindow(0)
+
+    def test_02_stress(self):
+        """A lot of data can be sent with many segments in flight"""
+        MIN, MAX, TOTAL = 1, 1400, 2 ** 20
+        data = bytes(random.randrange(256) for i in range(TOTAL))
+        with ExThread(target=self.client_recvall, args=(self.s['c'], data)):
+            count = 0
+            while count < TOTAL:
+                b = random.randint(MIN, MAX)
+                self.c['c'].send(data[count:count+b])
+                count += b
+
+    def test_03_seqwrap(self):
+        """Sequence numbers wrap around at 2**32"""
+        self.c['c'].sendBase = self.c['c'].nextSeq = SEQ_SPACE - 40
+        self.s['c'].rcvNext = SEQ_SPACE - 40
+        data = b''.join(b'test-seqwrap' + str(i).encode() for i in range(100))
+        with ExThread(target=self.client_recvall, args=(self.s['c'], data)):
+            for i in range(100):
+                self.c['c'].send(b'test-seqwrap' + str(i).encode())
+        self.assertEqual(self.c['c'].nextSeq, 60)
+
+    def test_04_segmentation(self):
+        """Large sends are split into MSS-sized segments"""
+        self.c['c'].setMSS(100)
+        data = bytes(random.randrange(256) for i in range(10050))
+        with ExThread(target=self.client_recvall, args=(self.s['c'], data)):
+            self.c['c'].send(data)
+        self.assertEqual(self.c['c'].nextSeq, 101)
+        with self.assertRaises(ValueError):
+            self.c['c'].setMSS(0)
+
+    def test_05_receive_window(self):
+        """Segments a larger window than the receiver's own sent early are still buffered"""
+        self.s['c'].setWindow(1)
+        data = [b'test-rcvwindow' + str(i).encode() for i in range(8)]
+        with ExThread(target=self.client_recvall, args=(self.s['c'], b''.join(data))):
+            base = self.s['c'].rcvNext
+            for i in reversed(range(8)):
+                self.assertTrue(self.s['c'].dataReceived((base + i) % SEQ_SPACE, data[i]))
+        self.assertFalse(self.s['c'].dataReceived(
+            (self.s['c'].rcvNext + self.s['c'].rcvWindow) % SEQ_SPACE, b'too far'))
+
+class I2_Windowed_Lose10_1x1(I1_Windowed_1x1):
+    LOSS = 0.10
+class I3_Windowed_Corrupt10Lose10_1x1(I1_Windowed_1x1):
+    LOSS = 0.10
+    PER = 0.10
+
+class CubicRDTProtocol(WindowedRDTProtocol):
+    CONGESTION = Cubic
+
+class I4_WindowedCubic_Lose10_1x1(I2_Windowed_Lose10_1x1):
+    PROTO = CubicRDTProtocol
+
+class K1_AdaptiveRTO(BaseNetworkTest):
+    CLIENTS = [('192.168.30.1', None)]
+    LISTEN = [('192.168.30.2', 4312)]
+    CONNS = {'c': (0, 0)}
+
+    def test_01_estimate(self):
+        """RTO follows the measured round trip time"""
+        srtt, rttvar, rto = self.c['c'].rttEstimate()
+        # The handshake provides the first sample
+        self.assertIsNotNone(srtt)
+        for i in range(100):
+            self.c['c'].send(b'test-rto' + str(i).encode())
+        srtt, rttvar, rto = self.c['c'].rttEstimate()
+        self.assertLess(rto, RDTSocket.INITIAL_RTO)
+        self.assertGreaterEqual(rto, RDTSocket.MIN_RTO)
+        self.assertGreaterEqual(rto, srtt)
+
+    def test_02_backoff(self):
+        """RTO doubles while segments keep timing out"""
+        net = self.h[type(self).CLIENTS[0][0]].net
+        self.c['c'].rto = 0.001
+        net.loss = itertools.repeat(True)
+        with ExThread(target=self.c['c'].send, args=(b'test-backoff',)):
+            time.sleep(0.1)
+            self.assertGreaterEqual(self.c['c'].rttEstimate()[2], 0.008)
+            net.loss = itertools.repeat(False)
+        self.assertEqual(self.s['c'].recv(), b'test-backoff')
+
+class L1_Simulated_Corrupt10Lose10(unittest.TestCase):
+    """Transfers run in virtual time by a network Simulator"""
+    LOSS = 0.10
+    PER = 0.10
+    LINK = None
+
+    def transfer(self, seed, nbytes, window=1):
+        # Checks the data arrives intact, and returns the virtual time the transfer ended at
+        sim = Simulator(seed)
+        net = Network(loss=type(self).LOSS, per=type(self).PER, link=type(self).LINK)
+        hosts = [Host(net, ip) for ip in ('192.168.40.1', '192.168.40.2')]
+        for h in hosts:
+            h.register_protocol(RDTProtocol)
+        ls = hosts[1].socket(RDTProtocol.PROTO_ID)
+        ls.bind(8080)
+        ls.listen()
+        cs = hosts[0].socket(RDTProtocol.PROTO_ID)
+        data = bytes(random.randrange(256) for i in range(nbytes))
+        received = []
+
+        def server():
+            s, _ = ls.accept()
+            incoming = b''
+            while len(incoming) < nbytes:
+                incoming += s.recv()
+            received.append(incoming)
+
+        def client():
+            cs.connect(('192.168.40.2', 8080))
+            cs.setWindow(window)
+            cs.send(data)
+
+        sim.spawn(server)
+        sim.spawn(client)
+        end = sim.run()
+        self.assertEqual(received, [data])
+        return end
+
+    def test_01_transfer(self):
+        """A lossy stop-and-wait transfer completes"""
+        self.transfer(1, 100000)
+
+    def test_02_reproducible(self):
+        """Runs with the same seed take exactly the same virtual time"""
+        self.assertEqual(self.transfer(2, 50000, 16), self.transfer(2, 50000, 16))
+
+class L2_Simulated_Link(L1_Simulated_Corrupt10Lose10):
+    """Transfers over a link with a bandwidth-delay product"""
+    LOSS = 0.0
+    PER = 0.0
+    LINK = Link(latency=0.02, bandwidth=10e6, queue=64)
+
+    def test_03_window(self):
+        """A window keeps more of the pipe full than stop-and-wait"""
+        self.assertLess(self.transfer(3, 100000, 16) * 3, self.transfer(3, 100000, 1))
+
+class M1_Ring_Corrupt10Lose10_1x1(H1_Corrupt10Lose10_1x1):
+    RING = 64
+class M3_Ring_1x2(A3_Lossless_1x2):
+    RING = 64
+class M5_Ring_Windowed_Lose10_1x1(I2_Windowed_Lose10_1x1):
+    # Small enough to overflow while a window is in flight
+    RING = 4
+
+def _shard_ring(net, ips, ring, nbytes):
+    # Cluster target: every host sends nbytes to the next one in ring, which
+    # may be in another process.  Returns what each host received.
+    pid = RDTProtocol.PROTO_ID
+    received = {}
+
+    def server(ls, ip):
+        s, _ = ls.accept()
+        incoming = b''
+        while len(incoming) < nbytes:
+            incoming += s.recv()
+        received[ip] = incoming
+
+    def client(cs, ip):
+        cs.connect((ring[(ring.index(ip) + 1) % len(ring)], 8080))
+        cs.send((ip.encode() * nbytes)[:nbytes])
+
+    threads = []
+    for ip in ips:
+        h = Host(net, ip)
+        h.register_protocol(RDTProtocol)
+        ls = h.socket(pid)
+        ls.bind(8080)
+        ls.listen()
+        threads.append(ExThread(target=server, args=(ls, ip)))
+        threads.append(ExThread(target=client, args=(h.socket(pid), ip)))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return received
+
+class N1_Sharded_Lose10(unittest.TestCase):
+    """Transfers between hosts in different worker processes"""
+    PARTITIONS = [['10.60.0.%d' % (4 * i + j + 1) for j in range(4)] for i in range(3)]
+
+    def test_01_ring(self):
+        """Every host gets its neighbour's data, across processes"""
+        ring = [ip for ips in type(self).PARTITIONS for ip in ips]
+        # Interleave so most neighbours are in different partitions
+        ring = ring[0::3] + ring[1::3] + ring[2::3]
+        results = Cluster(type(self).PARTITIONS, loss=0.10).run(
+            _shard_ring, ring, 20000, timeout=60)
+        received = {}
+        for r in results:
+            received.update(r)
+        self.assertEqual(sorted(received), sorted(ring))
+        for i, ip in enumerate(ring):
+            self.assertEqual(received[ring[(i + 1) % len(ring)]],
+                             (ip.encode() * 20000)[:20000])
+
+class J_TimerServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.timers = TimerService()
+        self.fired = []
+        self.done = threading.Event()
+
+    def fire(self, name):
+        self.fired.append(name)
+        if name == 'last':
+            self.done.set()
+
+    def test_01_order(self):
+        """Timers fire in deadline order regardless of scheduling order"""
+        self.timers.schedule(0.03, self.fire, 'last')
+        self.timers.schedule(0.02, self.fire, 'second')
+        self.timers.schedule(0.01, self.fire, 'first')
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual(self.fired, ['first', 'second', 'last'])
+
+    def test_02_cancel(self):
+        """Cancelled timers never fire"""
+        t = self.timers.schedule(0.01, self.fire, 'cancelled')
+        self.timers.schedule(0.02, self.fire, 'last')
+        self.timers.cancel(t)
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual(self.fired, ['last'])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file